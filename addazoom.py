@@ -13,6 +13,20 @@ one zoom level, to be both the min and max, i.e., the only zoom level for the
 new theme).  Explicit specification of min and max zoom (or just one) is also
 allowed if the .pik file is already there; in that case, tiles will be done (and
 put in place of the old ones) for the zoom level[s] you specified.
+
+At zoom levels at least as high as the theme's lowest partition zoom, if any,
+each tile is drawn by itself, from just the fragments of outlines for it in
+the theme's Partfile (see partition.py), which is built if missing.
+
+The known themes, in dict themes, are set up (and their files made, when
+missing) as follows; to build files as before, remove the settings:
+  USA: Polyfile cont_us_state.ply, ZIPCA: Polyfile cazip.ply; both made with
+    levels of detail (lod_zooms) and with topology=True, i.e., storing each
+    boundary that neighbours share just once (see shp2polys.py), so they
+    differ from Polyfiles made without; an existing Polyfile is used as it is
+  partition_zooms (10, 13): from zoom 10 up, a Partfile is made and used,
+    cont_us_state.ptn for USA, cazip.ptn for ZIPCA (delete it whenever the
+    Polyfile changes, as retile.py does, so it gets made anew)
 """
 from __future__ import with_statement
 
@@ -25,6 +39,7 @@ import sys
 
 from PIL import Image, ImageDraw, ImageFont, ImagePath
 
+import partition
 import shp2polys
 import tile
 PIK_FORMAT = 'gae/%s_dict.pik'
@@ -37,11 +52,19 @@ themes = dict(
                 oufile='cont_us_state.ply',
                 nameid='STUSPS',
                 excluded_ids=set('HI AK VI GU PR AS MP'.split()),
+                lod_zooms=(4, 6, 8, 10, 12),
+                topology=True,
+                partfile='cont_us_state.ptn',
+                partition_zooms=(10, 13),
                 ),
   ZIPCA=ThemeData(infile='ca/zt06_d00.shp',
                   oufile='cazip.ply',
                   nameid='ZTCA',
                   valid=str.isdigit,
+                  lod_zooms=(6, 8, 10, 12),
+                  topology=True,
+                  partfile='cazip.ptn',
+                  partition_zooms=(10, 13),
                   ),
   )
 
@@ -147,17 +170,33 @@ def main():
     c = shp2polys.Converter(**meta)
     c.doit()
 
-  # make a Reader for the polyfile, and do all required tiles
+  # make a Reader for the polyfile (and partfile, if needed), and do all
+  # required tiles
   r = shp2polys.PolyReader(infile=meta.oufile)
+  pr = None
+  partition_zooms = meta.get('partition_zooms')
+  if partition_zooms and maxzoom >= min(partition_zooms):
+    if not os.path.isfile(meta.partfile):
+      logging.info('Building partfile %r', meta.partfile)
+      p = partition.Partitioner(infile=meta.oufile, oufile=meta.partfile,
+                                zooms=partition_zooms)
+      p.doit()
+    pr = partition.PartitionReader(infile=meta.partfile)
   for zoom in range(minzoom, maxzoom+1):
-    do_all_tiles(m, r, zoom, name_format, persister)
+    do_all_tiles(m, r, zoom, name_format, persister, pr)
 
   persister.close()
 
 
-def do_all_tiles(m, r, zoom, name_format, persister):
+def do_all_tiles(m, r, zoom, name_format, persister, pr=None):
+    r.zoom = zoom
     bb = r.get_tiles_ranges(zoom)
-    do_tiles(m, r, zoom, name_format, bb, persister)
+    cover = r.get_tiles_cover(zoom)
+    logging.info('zoom %s: %d tiles with content', zoom, len(cover))
+    if pr is not None and zoom >= pr.zooms[0]:
+      do_partitioned_tiles(m, pr, zoom, name_format, persister, cover)
+    else:
+      do_tiles(m, r, zoom, name_format, bb, persister, cover)
 
 
 MAX_SIZE = 1000 * 1000 * 1000
@@ -172,15 +211,19 @@ def _dodivide(bb, dd, minind):
   bbs[1][minind] = midbb+1
   return bbs
 
-def do_tiles(m, r, zoom, name_format, bb, persister):
+def do_tiles(m, r, zoom, name_format, bb, persister, cover=None):
   dx = bb[2] - bb[0]
   dy = bb[3] - bb[1]
+  if cover is not None and not any(bb[0] <= tx <= bb[2] and
+                                   bb[1] <= ty <= bb[3] for tx, ty in cover):
+    logging.info('zoom %s: no tiles with content in %s', zoom, bb)
+    return
   size = 256*(dx+1), 256*(dy+1)
   logging.info('zoom %s: tiles %s, size %s', zoom, bb, size)
   if size[0]*size[1] > MAX_SIZE:
     logging.info('splitting along %s', 'XY'[dx<dy])
     bbs = _dodivide(bb, max(dx, dy), int(dx<dy))
-    for abb in bbs: do_tiles(m, r, zoom, name_format, abb, persister)
+    for abb in bbs: do_tiles(m, r, zoom, name_format, abb, persister, cover)
     return
   logging.info('Computing %d tiles', (dx+1)*(dy+1))
 
@@ -191,14 +234,17 @@ def do_tiles(m, r, zoom, name_format, bb, persister):
   green = 2
   im.putpalette(palette)
 
-  # draw all polygons -> prepare 1 large image with all tiles side by side
+  # draw the outlines of all polygons that may touch these tiles (only those
+  # are read; with topology, each boundary just once) ->
+  # prepare 1 large image with all tiles side by side
   matrix = m.getMetersToPixelsXform(zoom, bb)
   draw = ImageDraw.Draw(im)
-  for name, bbox, starts, lengths, meters in r:
-    for s, l in zip(starts, lengths):
-      p = ImagePath.Path(meters[s:s+l])
-      p.transform(matrix)
-      draw.polygon(p, outline=red)
+  r.set_select_tiles(bb, zoom)
+  for meters in r.iter_arcs():
+    p = ImagePath.Path(meters)
+    p.transform(matrix)
+    draw.line(p, fill=red)
+  r.select_bbox = None
   del draw 
 
   # save all tiles (obtained by chopping the 1 large image in 256x256 squares)
@@ -206,6 +252,7 @@ def do_tiles(m, r, zoom, name_format, bb, persister):
     left = (tx-bb[0]) * 256
     right = left+255
     for ty in range(bb[1], bb[3]+1):
+      if cover is not None and (tx, ty) not in cover: continue
       top = (bb[3]-ty) * 256
       bottom = top+255
       tileim = im.crop((left, top, right, bottom))
@@ -221,6 +268,33 @@ def do_tiles(m, r, zoom, name_format, bb, persister):
       out.close()
       persister.add_data(data, name)
 
+def do_partitioned_tiles(m, pr, zoom, name_format, persister, cover):
+  """ Draw each tile in cover by itself, from its fragments in a Partfile. """
+  white = 0
+  palette = [255]*3 + [255, 0, 0] + [0, 255, 0]
+  red = 1
+  for tx, ty in sorted(cover):
+    im = Image.new('P', (256, 256), white)
+    im.putpalette(palette)
+    matrix = m.getMetersToPixelsXform(zoom, (tx, ty, tx, ty))
+    draw = ImageDraw.Draw(im)
+    for name, meters in pr.get_fragments(tx, ty, zoom):
+      p = ImagePath.Path(meters)
+      p.transform(matrix)
+      draw.line(p, fill=red)
+    del draw
+    # explicitly skip tiles with no pixels drawn on them
+    if im.getbbox() is None:
+      logging.debug('Skip empty tile %s/%s', tx, ty)
+      continue
+    gtx, gty = m.GoogleTile(tx, ty, zoom)
+    name = name_format % (zoom, gtx, gty)
+    out = cStringIO.StringIO()
+    im.save(out, format='PNG', transparency=white)
+    data = out.getvalue()
+    out.close()
+    persister.add_data(data, name)
+
 if __name__ == '__main__':
   main()
 
@@ -6,17 +6,16 @@
 import struct
 import datetime
 import decimal
+import doctest
 import itertools
+try: import numpy
+except ImportError: numpy = None
 
-def dbfreader(f):
-  """Returns an iterator over records in a Xbase DBF file.
+def _read_header(f):
+  """ Read a DBF file's header, return numrec and a list of field infos.
 
-  The first row returned contains the field names.
-  The second row contains field specs: (type, size, decimal places).
-  Subsequent rows contain the data records.
-  If a record is marked as deleted, it is skipped.
-
-  File should be opened for binary reads.
+  Each field info is a tuple (name, type, size, decimal places).  The file is
+  left positioned at the start of the first record.
   """
   # See DBF format spec at:
   #    http://www.pgts.com.au/download/public/xbase.htm#DBF_STRUCT
@@ -30,11 +29,45 @@ def dbfreader(f):
     name, typ, size, deci = struct.unpack('<11sc4xBB14x', f.read(32))
     name = name.replace('\0', '')
     fields.append((name, typ, size, deci))
-  yield [field[0] for field in fields]
-  yield [tuple(field[1:]) for field in fields]
 
   terminator = f.read(1)
   assert terminator == '\r'
+  return numrec, fields
+
+
+def convert(typ, deci, value):
+  """ Convert the str value of a field of the given type and decimal places.
+  """
+  if typ == 'N':
+    value = value.replace('\0', '').lstrip()
+    if value == '':
+      value = 0
+    elif deci:
+      value = decimal.Decimal(value)
+    else:
+      value = int(value)
+  elif typ == 'D':
+    y, m, d = int(value[:4]), int(value[4:6]), int(value[6:8])
+    value = datetime.date(y, m, d)
+  elif typ == 'L':
+    value = (value in 'YyTt' and 'T') or (
+             value in 'NnFf' and 'F') or '?'
+  return value
+
+
+def dbfreader(f):
+  """Returns an iterator over records in a Xbase DBF file.
+
+  The first row returned contains the field names.
+  The second row contains field specs: (type, size, decimal places).
+  Subsequent rows contain the data records.
+  If a record is marked as deleted, it is skipped.
+
+  File should be opened for binary reads.
+  """
+  numrec, fields = _read_header(f)
+  yield [field[0] for field in fields]
+  yield [tuple(field[1:]) for field in fields]
 
   fields.insert(0, ('DeletionFlag', 'C', 1, 0))
   fmt = ''.join('%ds' % fieldinfo[2] for fieldinfo in fields)
@@ -46,24 +79,175 @@ def dbfreader(f):
     for (name, typ, size, deci), value in itertools.izip(fields, record):
       if name == 'DeletionFlag':
         continue
-      if typ == 'N':
-        value = value.replace('\0', '').lstrip()
-        if value == '':
-          value = 0
-        elif deci:
-          value = decimal.Decimal(value)
-        else:
-          value = int(value)
-      elif typ == 'D':
-        y, m, d = int(value[:4]), int(value[4:6]), int(value[6:8])
-        value = datetime.date(y, m, d)
-      elif typ == 'L':
-        value = (value in 'YyTt' and 'T') or (
-                 value in 'NnFf' and 'F') or '?'
-      result.append(value)
+      result.append(convert(typ, deci, value))
     yield result
 
 
+def dbfprojector(f, wanted, bulk=True, chunksize=1024*1024, converting=True):
+  """Returns an iterator over some of the fields of records in a DBF file.
+
+  Just like dbfreader, the first row returned contains the names of all the
+  fields, and the second row contains specs for all the fields; subsequent
+  rows, however, only contain the values of the wanted fields (in the order
+  in which they're listed in wanted): only those bytes of each record are
+  sliced out and converted.  Deleted records are skipped.
+
+  If bulk is true, the records are read chunksize bytes at a time (rounded
+  to whole records) rather than with one read per record.  If converting is
+  false, values are left as the raw str slices of the records (function
+  convert can turn them into what dbfreader would give).
+
+  File should be opened for binary reads.
+
+  >>> import StringIO
+  >>> f = StringIO.StringIO()
+  >>> dbfwriter(f, ['A', 'B', 'C'], [('C', 2, 0), ('N', 3, 0), ('C', 1, 0)],
+  ...           [('ab', 12, 'x'), ('cd', 345, 'y')])
+  >>> for bulk in (False, True):
+  ...   f.seek(0)
+  ...   print list(dbfprojector(f, ['C', 'B'], bulk, chunksize=1))
+  [['A', 'B', 'C'], [('C', 2, 0), ('N', 3, 0), ('C', 1, 0)], ['x', 12], ['y', 345]]
+  [['A', 'B', 'C'], [('C', 2, 0), ('N', 3, 0), ('C', 1, 0)], ['x', 12], ['y', 345]]
+  >>>
+
+  Raises:
+    ValueError (when records are first asked for) if a wanted field is missing
+  """
+  numrec, fields = _read_header(f)
+  names = [field[0] for field in fields]
+  yield names
+  yield [tuple(field[1:]) for field in fields]
+
+  missing = [name for name in wanted if name not in names]
+  if missing:
+    raise ValueError, 'No field named %s' % ', '.join(map(repr, missing))
+  # struct format with the deletion flag, then pads except for wanted fields
+  fmt = ['<c']
+  picked = []
+  for name, typ, size, deci in fields:
+    if name in wanted:
+      fmt.append('%ds' % size)
+      picked.append(name)
+    else:
+      fmt.append('%dx' % size)
+  recstruct = struct.Struct(''.join(fmt))
+  fmtsiz = 1 + sum(field[2] for field in fields)
+  # for each wanted field, where its value is among the unpacked ones, and
+  # how to convert it
+  infos = dict((field[0], field) for field in fields)
+  convs = [(picked.index(name)+1, infos[name][1], infos[name][3])
+           for name in wanted]
+
+  if bulk:
+    perchunk = max(1, chunksize // fmtsiz)
+  else:
+    perchunk = 1
+  for first in xrange(0, numrec, perchunk):
+    num = min(perchunk, numrec - first)
+    data = f.read(num * fmtsiz)
+    for offset in xrange(0, num * fmtsiz, fmtsiz):
+      record = recstruct.unpack_from(data, offset)
+      if record[0] != ' ': continue # deleted record
+      if converting:
+        yield [convert(typ, deci, record[i]) for i, typ, deci in convs]
+      else:
+        yield [record[i] for i, typ, deci in convs]
+
+
+def dbfarrays(f, wanted=None):
+  """Reads (some of) the fields of all records in a DBF file as NumPy arrays.
+
+  The whole record area is read at once and viewed through a NumPy structured
+  dtype that picks out just the wanted fields; deleted records are dropped by
+  a vectorized mask, and columns are converted in bulk by field type:
+    N: int64 array (float64 if the field has decimal places; blanks are 0)
+    F: float64 array
+    D: datetime64[D] array (blanks are NaT)
+    L: masked bool array, True for YyTt, masked if neither YyTt nor NnFf
+    other types: raw str array, just like the values given by dbfreader
+
+  File should be opened for binary reads.
+
+  >>> import StringIO
+  >>> f = StringIO.StringIO()
+  >>> dbfwriter(f, ['N', 'D', 'L', 'C'],
+  ...           [('N', 3, 0), ('D', 8, 0), ('L', 1, 0), ('C', 2, 0)],
+  ...           [(12, datetime.date(2008, 9, 7), 'T', 'ab'),
+  ...            (345, datetime.date(1999, 12, 31), '?', 'cd')])
+  >>> f.seek(0)
+  >>> names, specs, cols = dbfarrays(f, ['C', 'N', 'D', 'L'])
+  >>> names
+  ['N', 'D', 'L', 'C']
+  >>> cols['N'], cols['C']
+  (array([ 12, 345]), array(['ab', 'cd'], dtype='|S2'))
+  >>> cols['D']
+  array(['2008-09-07', '1999-12-31'], dtype='datetime64[D]')
+  >>> cols['L'].tolist()
+  [True, None]
+  >>>
+
+  Args:
+    f: file-like object positioned at the start of the DBF file
+    wanted: names of the fields to read (None, default, means all fields)
+  Returns:
+    tuple of: list of all field names, list of all field specs (like the
+      first two rows from dbfreader), dict mapping each wanted field name to
+      the array of its values in all non-deleted records
+  Raises:
+    ImportError if NumPy is not available
+    ValueError if a wanted field is missing
+  """
+  if numpy is None:
+    raise ImportError, 'dbfarrays needs NumPy'
+  numrec, fields = _read_header(f)
+  names = [field[0] for field in fields]
+  if wanted is None: wanted = names
+  missing = [name for name in wanted if name not in names]
+  if missing:
+    raise ValueError, 'No field named %s' % ', '.join(map(repr, missing))
+
+  # structured dtype: deletion flag (as f0), and each wanted field (as fN)
+  offset = 1
+  dt_names = ['f0']
+  dt_formats = ['S1']
+  dt_offsets = [0]
+  for i, (name, typ, size, deci) in enumerate(fields):
+    if name in wanted:
+      dt_names.append('f%d' % (i+1))
+      dt_formats.append('S%d' % size)
+      dt_offsets.append(offset)
+    offset += size
+  dtype = numpy.dtype(dict(names=dt_names, formats=dt_formats,
+                           offsets=dt_offsets, itemsize=offset))
+  data = f.read(numrec * offset)
+  records = numpy.frombuffer(data, dtype, len(data) // offset)
+  records = records[records['f0'] == ' ']
+
+  columns = dict()
+  for i, (name, typ, size, deci) in enumerate(fields):
+    if name not in wanted: continue
+    col = records['f%d' % (i+1)]
+    if typ in 'NF':
+      col = numpy.char.strip(numpy.char.replace(col, '\0', ''))
+      col[col == ''] = '0'
+      col = col.astype(numpy.float64 if typ == 'F' or deci else numpy.int64)
+    elif typ == 'D':
+      blank = numpy.char.strip(col) == ''
+      ymd = numpy.ascontiguousarray(col).view(
+          [('y', 'S4'), ('m', 'S2'), ('d', 'S2')])
+      iso = numpy.char.add(numpy.char.add(ymd['y'], '-'),
+                           numpy.char.add(numpy.char.add(ymd['m'], '-'),
+                                          ymd['d']))
+      iso[blank] = 'NaT'
+      col = iso.astype('M8[D]')
+    elif typ == 'L':
+      true = numpy.in1d(col, list('YyTt'))
+      known = true | numpy.in1d(col, list('NnFf'))
+      col = numpy.ma.masked_array(true, mask=~known)
+    columns[name] = col
+  return names, [tuple(field[1:]) for field in fields], columns
+
+
 def dbfwriter(f, fieldnames, fieldspecs, records, numrec=None):
   """ Writes to a newly created binary DBF file f.
 
@@ -79,34 +263,91 @@ def dbfwriter(f, fieldnames, fieldspecs, records, numrec=None):
       L for logical values 'T', 'F', or '?'
     size is the field width
     deci is the number of decimal places in the provided decimal object
-  Records can be an iterable over the records (sequences of field values)
-    but only if numrec is passed explicitly (else len(records) is taken).
+  Records can be an iterable over the records (sequences of field values);
+    if numrec is not passed explicitly, and records has no len, then file f
+    must be seekable (the header's record count is patched at the end).
   """
-  # header info
-  ver = 3
-  now = datetime.datetime.now()
-  yr, mon, day = now.year-1900, now.month, now.day
-  if numrec is None: numrec = len(records)
-  numfields = len(fieldspecs)
-  lenheader = numfields * 32 + 33
-  lenrecord = sum(field[1] for field in fieldspecs) + 1
-  hdr = struct.pack('<BBBBLHH20x', ver, yr, mon, day,
-                                   numrec, lenheader, lenrecord)
-  f.write(hdr)
-
-  # field specs
-  for name, (typ, size, deci) in itertools.izip(fieldnames, fieldspecs):
-    name = name.ljust(11, '\x00')
-    fld = struct.pack('<11sc4xBB14x', name, typ, size, deci)
-    f.write(fld)
-
-  # terminator
-  f.write('\r')
-
-  # records
-  for record in records:
-    f.write(' ')                        # deletion flag
-    for (typ, size, deci), value in itertools.izip(fieldspecs, record):
+  if numrec is None:
+    try: numrec = len(records)
+    except TypeError: pass
+  writer = DbfWriter(f, fieldnames, fieldspecs, numrec)
+  writer.extend(records)
+  writer.close()
+
+
+class DbfWriter(object):
+  """ Writes records to a newly created binary DBF file, in large blocks.
+
+  Records are packed into a reusable bytearray, which is written to the file
+  whenever it fills up; the number of records need not be known in advance,
+  since close() patches the header's record count (if it was not given, or
+  turns out to be wrong) -- in that case the file must be seekable.
+
+  >>> import StringIO
+  >>> f = StringIO.StringIO()
+  >>> w = DbfWriter(f, ['ID', 'N'], [('C', 3, 0), ('N', 4, 0)], bufsize=20)
+  >>> w.append(('ab', 1))
+  >>> w.extend(('x%d' % i, i*i) for i in range(10, 14))
+  >>> w.close()
+  >>> f.seek(0)
+  >>> for row in dbfreader(f): print row
+  ['ID', 'N']
+  [('C', 3, 0), ('N', 4, 0)]
+  ['ab ', 1]
+  ['x10', 100]
+  ['x11', 121]
+  ['x12', 144]
+  ['x13', 169]
+  >>>
+  """
+
+  def __init__(self, f, fieldnames, fieldspecs, numrec=None,
+               bufsize=1024*1024):
+    """ Write the header, field specs and terminator, prepare the buffer.
+
+    Args:
+      f: file open for writing in a binary mode
+      fieldnames, fieldspecs: as for function dbfwriter
+      numrec: number of records to be written, if known in advance
+      bufsize: approximate size in bytes of each block written to f
+    """
+    self._f = f
+    self._fieldspecs = fieldspecs
+    self._numrec = numrec
+    self._count = 0
+    self._closed = False
+
+    # header info
+    ver = 3
+    now = datetime.datetime.now()
+    yr, mon, day = now.year-1900, now.month, now.day
+    numfields = len(fieldspecs)
+    lenheader = numfields * 32 + 33
+    lenrecord = sum(field[1] for field in fieldspecs) + 1
+    hdr = struct.pack('<BBBBLHH20x', ver, yr, mon, day,
+                                     numrec or 0, lenheader, lenrecord)
+    f.write(hdr)
+
+    # field specs
+    for name, (typ, size, deci) in itertools.izip(fieldnames, fieldspecs):
+      name = name.ljust(11, '\x00')
+      fld = struct.pack('<11sc4xBB14x', name, typ, size, deci)
+      f.write(fld)
+
+    # terminator
+    f.write('\r')
+
+    # buffer of whole records, each with a deletion flag and all fields
+    self._record = struct.Struct('<c' + ''.join(
+        '%ds' % size for typ, size, deci in fieldspecs))
+    self._perbuf = max(1, bufsize // lenrecord)
+    self._buf = bytearray(self._perbuf * lenrecord)
+    self._used = 0
+
+  def append(self, record):
+    """ Add one record (a sequence of field values) to the file. """
+    values = []
+    for (typ, size, deci), value in itertools.izip(self._fieldspecs, record):
       if typ == 'N':
         value = str(value).rjust(size, ' ')
       elif typ == 'D':
@@ -116,8 +357,44 @@ def dbfwriter(f, fieldnames, fieldspecs, records, numrec=None):
       else:
         value = str(value)[:size].ljust(size, ' ')
       assert len(value) == size
-      f.write(value)
+      values.append(value)
+    self._record.pack_into(self._buf, self._used * self._record.size,
+                           ' ', *values)
+    self._used += 1
+    self._count += 1
+    if self._used == self._perbuf: self.flush()
+
+  def extend(self, records):
+    """ Add records (an iterable of sequences of field values) to the file. """
+    for record in records: self.append(record)
+
+  def flush(self):
+    """ Write to the file all the records that are still in the buffer. """
+    if self._used:
+      self._f.write(buffer(self._buf, 0, self._used * self._record.size))
+      self._used = 0
+
+  def close(self):
+    """ Finish the file, patching the header's record count if needed.
+
+    The file itself is not closed.  Calling close() again is a noop.
+    """
+    if self._closed: return
+    self.flush()
+    # End of file
+    self._f.write('\x1A')
+    if self._count != self._numrec:
+      self._f.seek(4)
+      self._f.write(struct.pack('<L', self._count))
+      self._f.seek(0, 2)
+    self._closed = True
+
 
-  # End of file
-  f.write('\x1A')
+def _test():
+    numfailures, numtests = doctest.testmod()
+    if numfailures == 0:
+      print '%d tests passed successfully' % numtests
+    # if there are any failures, doctest does its own reporting!-)
 
+if __name__ == "__main__":
+    _test()
@@ -17,8 +17,17 @@ ZOOM = 12
 m = tile.GlobalMercator()
 # current global SHP object
 s = None
+# SHP objects opened by onetile and usatile, by filename (shareable, since
+# each tile reads via a cursor of its own, so tiles may be made in threads)
+_shps = {}
 
-def do_tile(xt, yt, zoom, name=None):
+def _get_shp(filename, **kw):
+  try: return _shps[filename]
+  except KeyError:
+    return _shps.setdefault(filename,
+        shpextract.Shp(filename, use_mmap=True, **kw))
+
+def do_tile(xt, yt, zoom, name=None, shp=None):
   # print>>sys.stderr, ' Creating file %s' % name
   minlat, minlon, maxlat, maxlon = m.TileLatLonBounds(xt, yt, zoom)
   logging.debug('Tile %s/%s/%s bounds %s',
@@ -26,15 +35,15 @@ def do_tile(xt, yt, zoom, name=None):
   # print 'Til bnds:', minlat, minlon, maxlat, maxlon
   # print>>sys.stderr, ' BB:', minlat, minlon, maxlat, maxlon
   # careful with the order of params to s: it wants lon, lat (x, y) order!
-  s.set_select_bbox((minlon, minlat, maxlon, maxlat))
-  s.rewind()
+  if shp is None: shp = s
+  reader = shp.cursor((minlon, minlat, maxlon, maxlat))
   # note min/max lat must be swapped in PNG drawing to get the Y axis right!
   # also, lat=y axis, lon=y axis, so careful with the arguments order...!!!
   png = pypng.PNG(minlon, maxlat, maxlon, minlat)
   red = png.get_color(255, 0, 0)
-  for r in s:
+  for r in reader:
     for d in r[1:]:
-      png.polyline(d, red)
+      png.polyline(shpextract.as_doubles(d), red)
   data = png.dump()
   if name is not None:
     with open(name, 'wb') as f:
@@ -58,7 +67,15 @@ def what_tiles(zoom, minlat, minlon, maxlat, maxlon):
         continue
       do_tile(xt, yt, zoom, name)
 
-def tile_coords_generator(zoom, minlat, minlon, maxlat, maxlon):
+def shp_tiles_cover(shp, zoom, margin=1.0):
+  """ Get the set of (TMS) tiles that the records of a Shp touch at a zoom. """
+  cover = set()
+  for r in shp.cursor():
+    for d in r[1:]:
+      m.LonLatTilesCover(shpextract.as_doubles(d), zoom, margin, cover)
+  return cover
+
+def tile_coords_generator(zoom, minlat, minlon, maxlat, maxlon, cover=None):
   logging.debug('Tiles covering %s', sbb((minlat,minlon,maxlat,maxlon)))
   meters = m.LatLonToMeters(minlat, minlon)
   minx_tile, miny_tile = m.LatLonToTile(minlat, minlon, zoom)
@@ -76,6 +93,8 @@ def tile_coords_generator(zoom, minlat, minlon, maxlat, maxlon):
       minx_tile, maxx_tile, miny_tile, maxy_tile)
   for xt in range(minx_tile, maxx_tile+1):
     for yt in range(miny_tile, maxy_tile+1):
+      # if given a cover (see shp_tiles_cover), skip tiles without content
+      if cover is not None and (xt, yt) not in cover: continue
       gxt, gyt = m.GoogleTile(xt, yt, zoom)
       yield gxt, gyt, xt, yt, zoom
 
@@ -92,17 +111,15 @@ def main():
   what_tiles(ZOOM, bb[1], bb[0], bb[3], bb[2])
 
 def onetile(x, y, z, name):
-  global s
-  s = shpextract.Shp('ca/zt06_d00.shp', id_field_name='ZCTA')
+  shp = _get_shp('ca/zt06_d00.shp', id_field_name='ZCTA')
   gx, gy = m.GoogleTile(x, y, z)
-  return do_tile(gx, gy, z, name)
+  return do_tile(gx, gy, z, name, shp)
 
 def usatile(x, y, z, name):
-  global s
-  s = shpextract.Shp('fe_2007_us_state/fe_2007_us_state.shp',
-                     id_field_name='STUSPS', id_check=lambda x: True)
+  shp = _get_shp('fe_2007_us_state/fe_2007_us_state.shp',
+                 id_field_name='STUSPS', id_check=lambda x: True)
   gx, gy = m.GoogleTile(x, y, z)
-  return do_tile(gx, gy, z, name)
+  return do_tile(gx, gy, z, name, shp)
 
 if __name__ == '__main__':
   main()
@@ -102,8 +102,9 @@ def main():
       n += 1
     logging.info('Zoom %d: up to %d tiles', zoom, n)
     n = 0
+    cover = dopngtile.shp_tiles_cover(s, zoom)
     for gx, gy, x, y, z in dopngtile.tile_coords_generator(
-        zoom, *usabb):
+        zoom, *(usabb + (cover,))):
       name = name_format % (gx, gy, z)
       try:
         data = dopngtile.do_tile(x, y, z)
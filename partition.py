@@ -0,0 +1,348 @@
+""" Partition a Polyfile's outlines into per-tile fragments, for fast drawing.
+
+Copyright (C) 2008 Alex Martelli, aleaxit@gmail.com
+Licensed under Apache License 2.0, http://www.apache.org/licenses/LICENSE-2.0
+
+Drawing a tile from a Polyfile (see shp2polys) means going through whole
+records (e.g., a state's whole outline, with all of its coastline) even when
+just a few of their points are anywhere near the tile.  A Partitioner does the
+clipping once and for all: for each of some "partition zooms" it clips the
+records' outlines to each tile at that zoom they go through (plus a margin, by
+default 1 pixel, for the rounding done in drawing), keeping whole the segments
+that cross the tile's border, and saves the resulting fragments (polylines,
+which paint exactly the same pixels on the tile as the whole records do) in a
+Partfile, bucketed by tile.  Then, to draw a tile at a zoom at least as high
+as some partition zoom, a PartitionReader just reads the one bucket of the
+tile's ancestor (or the tile itself) at the highest such partition zoom, so
+the work per tile does not depend on how large records are.
+
+With a Polyfile with topology (see shp2polys), what gets clipped is its arcs
+rather than its records' outlines, so each boundary that neighbours share is
+in a bucket just once; fragments of arcs belong to no single record, and have
+the reserved idnum ARC_IDNUM.
+
+Each partition zoom starts a "band" of zooms, up to the next partition zoom
+(excluded), and its fragments come from the coarsest level of detail of the
+Polyfile (if it has any) that's good for drawing at all zooms in the band.
+
+Like those of shp2polys, the two classes are customized by subclassing them
+or by passing named args to their ctors: infile, oufile, zooms, margin for
+the Partitioner (which, like shp2polys.Converter, needs numpy), infile for
+the PartitionReader.
+
+A Partfile is a binary file (all numbers little-endian) with sections each
+starting at a multiple of 8 bytes from the start of the file:
+     header (48 bytes): 8-bytes magic string GEPYPTN1; 3 unsigned ints:
+       numzooms, numtiles, idsleng; 4 bytes of padding; double margin (in
+       pixels); 2 unsigned 8-bytes ints: offsets of directory and data
+     zooms: numzooms unsigned ints, the partition zooms in increasing order
+     ID table: idsleng bytes, the same text as ids.txt in a Polyfile
+     directory: numtiles unsigned 8-bytes ints, the IDs of the tiles with
+       fragments in increasing order (see tile.tile_id), then numtiles entries,
+       each: unsigned 8-bytes int offset, unsigned int number of fragments of
+       the tile's bucket, 4 bytes of padding
+     data: for each tile, at its offset, its bucket: for each fragment 6 ints:
+       unsigned idnum (ARC_IDNUM for arcs), unsigned length (number of ints:
+       2 per point), signed bbox (minx, miny, maxx, maxy); then the x then y
+       of each point of each fragment, signed ints (meters)
+"""
+from __future__ import with_statement
+
+import array
+import bisect
+import logging
+import mmap
+import struct
+
+try: import numpy
+except ImportError: numpy = None
+
+import shp2polys
+import tile
+
+m = tile.GlobalMercator()
+
+MAGIC = 'GEPYPTN1'
+_header = struct.Struct('<8sIII4xdQQ')
+_entry = struct.Struct('<QI4x')
+_fragment = struct.Struct('<II4i')
+# idnum of the fragments of arcs, in Partfiles from Polyfiles with topology
+ARC_IDNUM = 0xFFFFFFFF
+
+
+def _visible_segments(x0, y0, dx, dy, xmin, ymin, xmax, ymax):
+  """ Liang-Barsky on segments x0+t*dx, y0+t*dy for t in 0 to 1, vs boxes.
+
+  Args:
+    x0, y0, dx, dy: numpy arrays of floats, one item per segment
+    xmin, ymin, xmax, ymax: the box (numbers), or one box per segment (arrays)
+  Returns:
+    numpy array of bools, True for the segments that intersect their box
+  """
+  t0 = numpy.zeros(len(dx))
+  t1 = numpy.ones(len(dx))
+  inside = numpy.ones(len(dx), bool)
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    for p, q in ((-dx, x0 - xmin), (dx, xmax - x0),
+                 (-dy, y0 - ymin), (dy, ymax - y0)):
+      # a segment parallel to a border, on its outer side, is all out
+      inside &= (p != 0) | (q >= 0)
+      r = q / p
+      entering = p < 0
+      t0[entering] = numpy.maximum(t0[entering], r[entering])
+      leaving = p > 0
+      t1[leaving] = numpy.minimum(t1[leaving], r[leaving])
+  return inside & (t0 <= t1)
+
+
+def _runs(visible):
+  """ Get (first, stop) point indices of the pieces of a polyline made of runs
+  of consecutive segments, from the increasing indices of those segments
+  """
+  firsts = numpy.flatnonzero(numpy.diff(visible) != 1) + 1
+  firsts = numpy.append(0, firsts)
+  lasts = numpy.append(firsts[1:], len(visible)) - 1
+  return zip(visible[firsts].tolist(), (visible[lasts] + 2).tolist())
+
+
+def clip_polyline(xs, ys, bbox):
+  """ Clip a polyline to a box, by Liang-Barsky on all segments at once.
+
+  Segments are kept whole (rather than cut where they cross the box's
+  border), so the pieces are made of the polyline's own points, and drawing
+  them paints exactly the same pixels in the box as drawing the polyline.
+
+  Args:
+    xs, ys: numpy arrays, the coordinates of the polyline's points
+    bbox: the box, minx, miny, maxx, maxy
+  Returns:
+    list of (first, stop) pairs of indices, in order, one per piece of the
+      polyline (its points from first to stop-1) that intersects the box
+  """
+  xs = numpy.asarray(xs, float)
+  ys = numpy.asarray(ys, float)
+  visible = numpy.flatnonzero(_visible_segments(
+      xs[:-1], ys[:-1], numpy.diff(xs), numpy.diff(ys), *bbox))
+  if not len(visible): return []
+  # a piece is a run of consecutive segments intersecting the box
+  return _runs(visible)
+
+
+class Partitioner(object):
+  """ Performs Polyfile -> Partfile partitioning. """
+  # class-overridable data
+  infile = 'cont_us_state.ply'
+  oufile = 'cont_us_state.ptn'
+  # partition zooms, each starting a band of zooms up to the next one
+  zooms = (10,)
+  # pixels of margin around each tile (at its zoom) to keep in its bucket
+  margin = 1.0
+
+  def __init__(self, **kwds):
+    """ Open input Polyfile. """
+    if numpy is None:
+      raise ImportError, 'Partitioner needs numpy'
+    self.__dict__.update(kwds)
+    self.zooms = sorted(self.zooms)
+    self.reader = shp2polys.PolyReader(infile=self.infile)
+    self.num_by_name = dict((name, num) for num, name in
+                            self.reader.name_by_num.iteritems())
+
+  def close(self):
+    """ Close the open files (noop if called more than once). """
+    self.reader.close()
+
+  def _polylines(self, lod_zoom):
+    """ Iterate on the polylines to partition, at the level of detail for a
+    zoom: (idnum, meters) per part of each record, where meters is a numpy
+    array of ints x, y, x, y, ... or, if the Polyfile has topology, per arc
+    (with idnum ARC_IDNUM), so boundaries shared by neighbours go in the
+    buckets just once
+    """
+    r = self.reader
+    if r.topology:
+      starts, lengths, meters = r._get_arcs(r._lod_level(lod_zoom))
+      for s, l in zip(starts, lengths): yield ARC_IDNUM, meters[s:s+l]
+      return
+    r.zoom = lod_zoom
+    for name, bbox, starts, lengths, meters in r.iter_arrays():
+      idnum = self.num_by_name[name]
+      for s, l in zip(starts, lengths): yield idnum, meters[s:s+l]
+
+  def _buckets(self, zoom, lod_zoom):
+    """ Get the buckets of fragments for the tiles at a partition zoom.
+
+    Each polyline is clipped to all tiles in one pass: the padded bbox of
+    each segment gives the few tiles it may go through, Liang-Barsky checks
+    all of those (segment, tile) pairs at once, and each tile gets the runs
+    of consecutive segments that go through it.
+
+    Args:
+      zoom: the partition zoom
+      lod_zoom: the zoom the records' level of detail must be good for
+    Returns:
+      dict from tile ID to list of (idnum, bbox, meters) per fragment, where
+        meters is a numpy array of ints x, y, x, y, ...
+    """
+    pad = self.margin * m.Resolution(zoom)
+    # tile coordinates are meters from the map's bottom left, in tiles
+    scale = 1.0 / (m.Resolution(zoom) * m.tileSize)
+    padt = float(self.margin) / m.tileSize
+    last = 2**zoom - 1
+    buckets = dict()
+    for idnum, part in self._polylines(lod_zoom):
+      xs, ys = part[0::2], part[1::2]
+      if len(xs) < 2: continue
+      x0, y0 = xs[:-1].astype(float), ys[:-1].astype(float)
+      dx, dy = numpy.diff(xs).astype(float), numpy.diff(ys).astype(float)
+      u = (xs + m.originShift) * scale
+      v = (ys + m.originShift) * scale
+      u0, u1 = numpy.minimum(u[:-1], u[1:]), numpy.maximum(u[:-1], u[1:])
+      v0, v1 = numpy.minimum(v[:-1], v[1:]), numpy.maximum(v[:-1], v[1:])
+      tx0 = numpy.clip(numpy.ceil(u0 - 1 - padt), 0, last).astype(int)
+      tx1 = numpy.clip(numpy.floor(u1 + padt), 0, last).astype(int)
+      ty0 = numpy.clip(numpy.ceil(v0 - 1 - padt), 0, last).astype(int)
+      ty1 = numpy.clip(numpy.floor(v1 + padt), 0, last).astype(int)
+      # one (segment, tile) pair per tile in the range of each segment
+      nx = tx1 - tx0 + 1
+      counts = nx * (ty1 - ty0 + 1)
+      seg = numpy.repeat(numpy.arange(len(counts)), counts)
+      within = numpy.arange(len(seg)) - numpy.repeat(
+          numpy.cumsum(counts) - counts, counts)
+      tx = tx0[seg] + within % nx[seg]
+      ty = ty0[seg] + within // nx[seg]
+      minx, miny, maxx, maxy = m.TileBoundsArray(tx, ty, zoom)
+      visible = _visible_segments(x0[seg], y0[seg], dx[seg], dy[seg],
+                                  minx-pad, miny-pad, maxx+pad, maxy+pad)
+      seg = seg[visible]
+      tids = m.TileToIdArray(tx[visible], ty[visible], zoom)
+      order = numpy.lexsort((seg, tids))
+      seg, tids = seg[order], tids[order]
+      # a piece is a run of consecutive segments going through the same tile
+      starts = numpy.append(0, numpy.flatnonzero(numpy.diff(tids)) + 1)
+      ends = numpy.append(starts[1:], len(tids))
+      for start, end in zip(starts, ends):
+        bucket = buckets.setdefault(int(tids[start]), [])
+        for first, stop in _runs(seg[start:end]):
+          fbbox = (xs[first:stop].min(), ys[first:stop].min(),
+                   xs[first:stop].max(), ys[first:stop].max())
+          bucket.append((idnum, fbbox, part[2*first:2*stop]))
+    return buckets
+
+  def doit(self):
+    """ Perform all of the partitioning and close all open files. """
+    buckets = dict()
+    for i, zoom in enumerate(self.zooms):
+      if i + 1 < len(self.zooms): lod_zoom = self.zooms[i+1] - 1
+      else: lod_zoom = None
+      band = self._buckets(zoom, lod_zoom)
+      logging.info('zoom %s: %d tiles with fragments', zoom, len(band))
+      buckets.update(band)
+    tids = sorted(buckets)
+    ids_text = ''.join('%s %d\n' % (name, num) for num, name in
+                       sorted(self.reader.name_by_num.iteritems()))
+
+    zooms_at = _header.size
+    ids_at = shp2polys._align8(zooms_at + 4*len(self.zooms))
+    dir_at = shp2polys._align8(ids_at + len(ids_text))
+    data_at = dir_at + (8 + _entry.size) * len(tids)
+    with open(self.oufile, 'wb') as out:
+      out.write(_header.pack(MAGIC, len(self.zooms), len(tids),
+                             len(ids_text), self.margin, dir_at, data_at))
+      out.write(struct.pack('<%dI' % len(self.zooms), *self.zooms))
+      out.seek(ids_at)
+      out.write(ids_text)
+      out.seek(dir_at)
+      out.write(struct.pack('<%dQ' % len(tids), *tids))
+      # buckets go in the order of their tiles' IDs, right after the directory
+      offset = data_at
+      for tid in tids:
+        bucket = buckets[tid]
+        out.write(_entry.pack(offset, len(bucket)))
+        offset += sum(_fragment.size + 4*len(frag) for i, b, frag in bucket)
+      for tid in tids:
+        bucket = buckets[tid]
+        out.write(''.join(_fragment.pack(idnum, len(frag), *fbbox)
+                          for idnum, fbbox, frag in bucket))
+        out.write(''.join(frag.tostring() for i, b, frag in bucket))
+    self.close()
+
+
+class PartitionReader(object):
+  """ Read the fragments to draw each tile from a Partfile. """
+  # class-overridable data
+  infile = 'cont_us_state.ptn'
+
+  def __init__(self, **kwds):
+    """ Memory-map the Partfile, read and prepare preliminary data """
+    self.__dict__.update(kwds)
+    with open(self.infile, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self._closed = False
+    if self._map[:len(MAGIC)] != MAGIC:
+      self.close()
+      raise ValueError, 'No Partfile %r' % self.infile
+    fields = _header.unpack_from(self._map)
+    magic, num_zooms, num_tiles, ids_len, self.margin, dir_at = fields[:6]
+    self.zooms = list(struct.unpack_from('<%dI' % num_zooms, self._map,
+                                         _header.size))
+    ids_at = shp2polys._align8(_header.size + 4*num_zooms)
+    self.name_by_num = dict()
+    for line in self._map[ids_at:ids_at+ids_len].splitlines():
+      name, num = line.split()
+      self.name_by_num[int(num)] = name
+    self._tids = struct.unpack_from('<%dQ' % num_tiles, self._map, dir_at)
+    self._entries_at = dir_at + 8*num_tiles
+
+  def close(self):
+    """ Close the open file (noop if called more than once). """
+    if self._closed: return
+    self._map.close()
+    self._closed = True
+
+  def partition_zoom(self, zoom):
+    """ Get the partition zoom whose buckets serve to draw at a zoom level.
+
+    Raises:
+      ValueError if zoom is lower than all partition zooms
+    """
+    i = bisect.bisect_right(self.zooms, zoom)
+    if not i: raise ValueError, 'No partition for zoom %s' % zoom
+    return self.zooms[i-1]
+
+  def get_fragments(self, tx, ty, zoom):
+    """ Get the fragments of outlines that may be drawn on a tile.
+
+    Args:
+      tx, ty: TMS tile coordinates
+      zoom: zoom level of the tile (at least the lowest partition zoom)
+    Returns:
+      list with (name, meters) per fragment, where meters is a list of ints,
+        x, y, x, y, ... the points of a polyline to draw on the tile, and name
+        is None for the fragments of arcs (from a Polyfile with topology)
+    Raises:
+      ValueError if zoom is lower than all partition zooms
+    """
+    pzoom = self.partition_zoom(zoom)
+    tid = m.TileToId(tx, ty, zoom)
+    for i in range(zoom - pzoom): tid = tile.tile_parent(tid)
+    i = bisect.bisect_left(self._tids, tid)
+    if i == len(self._tids) or self._tids[i] != tid: return []
+    offset, count = _entry.unpack_from(self._map,
+                                       self._entries_at + _entry.size*i)
+    # at zooms higher than the partition zoom, skip fragments off the tile
+    minx, miny, maxx, maxy = m.TileBounds(tx, ty, zoom)
+    pad = self.margin * m.Resolution(zoom)
+    minx, miny, maxx, maxy = minx-pad, miny-pad, maxx+pad, maxy+pad
+    result = []
+    points_at = offset + _fragment.size*count
+    for j in range(count):
+      fields = _fragment.unpack_from(self._map, offset + _fragment.size*j)
+      idnum, length, bx0, by0, bx1, by1 = fields
+      if not (bx0 > maxx or bx1 < minx or by0 > maxy or by1 < miny):
+        meters = array.array('i')
+        meters.fromstring(self._map[points_at:points_at+4*length])
+        shp2polys.normalize_arrays(meters)
+        result.append((self.name_by_num.get(idnum), list(meters)))
+      points_at += 4*length
+    return result
@@ -23,6 +23,7 @@ class Converter(shp2polys.Converter):
   infile = 'ca/zt06_d00.shp'
   oufile = 'cazip.ply'
   nameid = 'ZCTA'
+  lod_zooms = (6, 8, 10)
   @classmethod
   def valid(cls, id): return id.isdigit()
 
@@ -62,6 +63,7 @@ def main():
 
   r = PolyReader(infile=POLYFILE)
   for zoom in range(MIN_ZOOM, MAX_ZOOM+1):
+    r.zoom = zoom
     bb = r.get_tiles_ranges(zoom)
     size = 256*(bb[2]-bb[0]+1), 256*(bb[3]-bb[1]+1)
     logging.info('zoom %s: tiles %s, size %s', r.zoom, bb, size)
@@ -33,7 +33,7 @@ def main():
   m = tile.GlobalMercator()
 
   for zoom in range(MIN_ZOOM, MAX_ZOOM+1):
-    r = shp2polys.PolyReader()
+    r = shp2polys.PolyReader(zoom=zoom)
     bb = r.get_tiles_ranges(zoom)
     size = 256*(bb[2]-bb[0]+1), 256*(bb[3]-bb[1]+1)
     logging.info('zoom %s: tiles %s, size %s', r.zoom, bb, size)
@@ -47,22 +47,24 @@ def main():
     matrix = m.getMetersToPixelsXform(zoom, bb)
     # font = ImageFont.truetype('/Library/Fonts/ChalkboardBold.ttf', 24)
     draw = ImageDraw.Draw(im)
-    for name, bbox, starts, lengths, meters in r:
-      # text-writing is currently commented out...:
-      #
-      # print name, s(starts), s(lengths), len(meters), s(bbox)
-      # p = ImagePath.Path(bbox)
-      # print 'bef:', s(p.tolist(1))
-      # p.transform(matrix)
-      # print 'aft:', s(p.tolist(1))
-      # tsz = draw.textsize(name, font=font)
-      # tdc = [(p[1][i]+p[0][i]-tsz[i])/2.0 for i in (0,1)]
-      # logging.info('txt %s: %s %s %s', name, tsz, s(p.tolist(1)), s(tdc))
-      # draw.text(tdc, name, fill=green, font=font)
-      for s, l in zip(starts, lengths):
-        p = ImagePath.Path(meters[s:s+l])
-        p.transform(matrix)
-        draw.polygon(p, outline=red)
+    # text-writing is currently commented out...:
+    #
+    # for name, bbox, starts, lengths, meters in r:
+    #   print name, s(starts), s(lengths), len(meters), s(bbox)
+    #   p = ImagePath.Path(bbox)
+    #   print 'bef:', s(p.tolist(1))
+    #   p.transform(matrix)
+    #   print 'aft:', s(p.tolist(1))
+    #   tsz = draw.textsize(name, font=font)
+    #   tdc = [(p[1][i]+p[0][i]-tsz[i])/2.0 for i in (0,1)]
+    #   logging.info('txt %s: %s %s %s', name, tsz, s(p.tolist(1)), s(tdc))
+    #   draw.text(tdc, name, fill=green, font=font)
+    #
+    # draw the outlines (with topology, each boundary just once)
+    for meters in r.iter_arcs():
+      p = ImagePath.Path(meters)
+      p.transform(matrix)
+      draw.line(p, fill=red)
     del draw 
 
     # save all tiles
@@ -8,7 +8,9 @@ Writes, also in /tmp:
   - a pickled dict with string z_x_y as key and N as value (when
     tile_<theme>_z_x_y is in zipfile <theme>_N.zip) named <theme>_dict.pik
 Principles of operation:
-  - build zipfiles sequentially (sorting filenames numerically theme-z-x-y)
+  - build zipfiles sequentially (sorting filenames by theme, then by integer
+    tile ID, i.e. by zoom and then along a Z-order curve, so each zipfile
+    holds tiles that are mostly close together on the map)
   - keep track of the total (compressed) size of the current zipfile
   - ensure <1MB by checking that the next tile-file would fit UNcompressed (!),
     else close the current zipfile and open a fresh one for the next tile +
@@ -21,6 +23,8 @@ import os
 import sys
 import zipfile
 
+import tile
+
 # use a prudent size as we also need space for the zipfile directory &c
 MAX_SIZE = 1000*1000 - 50*1000
 
@@ -48,13 +52,19 @@ def namekey(filename):
   return theme, int(z), int(x), int(y)
 
 
+def sortkey(filename):
+  """ Return key (theme, tile ID) for a filename 'tile_theme_z_x_y.png'. """
+  theme, z, x, y = namekey(filename)
+  return theme, tile.tile_id(z, x, y)
+
+
 def main(working_directory='/tmp'):
   """ Prepare zipfiles and .pik dictionary index from .png tile files. """
   setlogging(dodebug=True)
 
   # get all filenames, properly sorted, and the theme
   os.chdir(working_directory)
-  filenames = sorted(glob.iglob('tile_*.png'), key=namekey)
+  filenames = sorted(glob.iglob('tile_*.png'), key=sortkey)
   theme = namekey(filenames[0])[0]
   # check that all filenames are for the same theme
   lastheme = namekey(filenames[-1])[0]
@@ -0,0 +1,330 @@
+""" Re-render just the tiles that changes to a theme's boundaries affect.
+
+Copyright (C) 2008 Alex Martelli, aleaxit@gmail.com
+Licensed under Apache License 2.0, http://www.apache.org/licenses/LICENSE-2.0
+
+Invoke this script from gepy's repo root with an argument, the theme name (one
+of those known to addazoom.py), and optionally another, the path to an older
+Polyfile for the theme.  Without the latter, the script first updates the
+theme's Polyfile from its Shapefile (see shp2polys.Converter's update), keeping
+a copy of it as it was before as the older Polyfile.  Either way, the script
+then finds the tiles that differ between the older and current Polyfile, at
+every zoom level the theme has tiles for in gae/<theme>_dict.pik, re-renders
+just those (as addazoom.py would), and updates in place the zipfiles and index
+made by prepzips.py (and maybe updated since by this script): the tiles that
+are now empty get removed, the others replaced or added.  The theme's
+Partfile, if any, is removed too, as it's stale (addazoom.py makes it anew).
+
+The tiles that differ are found exactly, by function dirty_tiles: the ones
+that some outline (as the renderers draw them, see PolyReader.iter_arcs) goes
+through, at the level of detail for the zoom, which is in one of the two
+Polyfiles but not the other.  When just the bboxes of the changed records are
+known (e.g. Converter.changed_bboxes), function bbox_tiles gives the tiles
+they overlap, a superset of those.
+"""
+from __future__ import with_statement
+
+import contextlib
+import cPickle
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+import addazoom
+import shp2polys
+import tile
+
+m = tile.GlobalMercator()
+
+# as in prepzips, a prudent max size for each zipfile
+MAX_SIZE = 1000*1000 - 50*1000
+
+
+def bbox_tiles(bboxes, zoom, margin=1.0):
+  """ Get the tiles that some bounding boxes overlap.
+
+  Args:
+    bboxes: iterable of bounding boxes in meters, minx, miny, maxx, maxy
+    zoom: zoom level of the tiles
+    margin: also get tiles within this many pixels of a bounding box (the
+      default, 1.0, allows for the rounding done in drawing the outlines)
+  Returns:
+    set of (tx, ty) tuples, TMS tile coordinates
+  """
+  pad = margin * m.Resolution(zoom)
+  tiles = set()
+  for minx, miny, maxx, maxy in bboxes:
+    mintx, minty = m.MetersToTile(minx - pad, miny - pad, zoom)
+    maxtx, maxty = m.MetersToTile(maxx + pad, maxy + pad, zoom)
+    for tx in range(max(mintx, 0), min(maxtx, 2**zoom - 1) + 1):
+      for ty in range(max(minty, 0), min(maxty, 2**zoom - 1) + 1):
+        tiles.add((tx, ty))
+  return tiles
+
+
+def _outlines(r, zoom):
+  """ Get the set of outlines (tuples of int meters) drawn for a Polyfile's
+  records at a zoom level, see PolyReader.iter_arcs
+  """
+  r.zoom = zoom
+  r.select_bbox = None
+  return set(tuple(meters) for meters in r.iter_arcs())
+
+
+def dirty_tiles(old, new, zooms, margin=1.0):
+  """ Get the tiles that differ between two Polyfiles, at some zoom levels.
+
+  Args:
+    old, new: shp2polys.PolyReader on the two Polyfiles
+    zooms: iterable of zoom levels
+    margin: as for bbox_tiles
+  Returns:
+    dict from each zoom level to the set of (tx, ty) tuples, TMS coordinates
+      of the tiles that some outline is on in one Polyfile but not the other
+  """
+  result = dict()
+  # outlines differing at each level of detail, by the levels' prefixes
+  differing = dict()
+  for zoom in zooms:
+    key = old.lod_prefix(zoom), new.lod_prefix(zoom)
+    if key not in differing:
+      differing[key] = _outlines(old, zoom) ^ _outlines(new, zoom)
+    cover = set()
+    for meters in differing[key]:
+      m.MetersTilesCover(meters, zoom, margin, cover)
+    result[zoom] = cover
+  return result
+
+
+class _TilesCollector(object):
+  """ Persister for addazoom.do_tiles, collecting the tiles' data by name """
+  def __init__(self):
+    self.data_by_name = dict()
+
+  def add_data(self, data, name):
+    self.data_by_name[name] = data
+
+
+def render_tiles(r, zoom, tiles, group_size=8):
+  """ Render some tiles, as addazoom does.
+
+  Tiles are drawn a group at a time (on one image, for the range of tiles
+  of the group, see addazoom.do_tiles), where a group has the tiles within
+  the same square of group_size by group_size tiles.
+
+  Args:
+    r: shp2polys.PolyReader for the Polyfile to draw
+    zoom: zoom level of the tiles
+    tiles: iterable of (tx, ty) tuples, TMS coordinates of the tiles to draw
+    group_size: side, in tiles, of the squares of tiles drawn together
+  Returns:
+    dict from 'z_x_y' (Google coordinates of the tile, as in the index of
+      prepzips) to PNG data, for the tiles that have something drawn on them
+  """
+  groups = dict()
+  for tx, ty in tiles:
+    groups.setdefault((tx // group_size, ty // group_size), set()).add((tx, ty))
+  collector = _TilesCollector()
+  r.zoom = zoom
+  for group in groups.itervalues():
+    bb = [min(t[0] for t in group), min(t[1] for t in group),
+          max(t[0] for t in group), max(t[1] for t in group)]
+    addazoom.do_tiles(m, r, zoom, '%s_%s_%s', bb, collector, group)
+  return collector.data_by_name
+
+
+def _replace_file(tmpname, filename):
+  """ Rename tmpname to filename, even if the latter exists (on Windows too)
+  """
+  try: os.rename(tmpname, filename)
+  except OSError:
+    os.remove(filename)
+    os.rename(tmpname, filename)
+
+
+class TileArchive(object):
+  """ The zipfiles and index of a theme's tiles, as made by prepzips. """
+  def __init__(self, theme, directory='gae'):
+    """ Read the index, gae/<theme>_dict.pik by default.
+
+    The index maps 'z_x_y' of each tile to N, where the zipfile holding the
+    tile is <theme>_N.zip; in some older indices, to that zipfile's name.
+    """
+    self.theme = theme
+    self.directory = directory
+    self.index_name = os.path.join(directory, '%s_dict.pik' % theme)
+    with open(self.index_name, 'rb') as f:
+      self.index = cPickle.load(f)
+    self._named = any(isinstance(v, str) for v in self.index.itervalues())
+
+  def zooms(self):
+    """ Get the sorted list of the zoom levels of the tiles in the archive """
+    return sorted(set(int(zxy.split('_')[0]) for zxy in self.index))
+
+  def _zipnum(self, value):
+    """ Get the number of a zipfile from its value in the index """
+    if isinstance(value, str): return int(value[len(self.theme)+1:-4])
+    return value
+
+  def _zipname(self, zipnum):
+    """ Get the path of a zipfile from its number """
+    return os.path.join(self.directory, '%s_%d.zip' % (self.theme, zipnum))
+
+  def _member(self, zxy):
+    """ Get the name of a tile's member in its zipfile """
+    return 'tile_%s_%s.png' % (self.theme, zxy)
+
+  def update(self, removed, added):
+    """ Remove, replace and add tiles, and write the updated index.
+
+    Each zipfile losing tiles is rewritten without them (copying the others
+    still compressed); then, each added tile is appended to the zipfile it
+    was in, if it fits, else to the last zipfile, or a new one when that's
+    full (like prepzips does).
+
+    Args:
+      removed: iterable of 'z_x_y' strings, tiles to remove (if there)
+      added: dict from 'z_x_y' to PNG data, tiles to add (or replace)
+    """
+    gone = dict()
+    for zxy in set(removed).union(added):
+      if zxy in self.index:
+        gone.setdefault(self._zipnum(self.index.pop(zxy)), set()).add(
+            self._member(zxy))
+    home = dict()
+    sizes = dict()
+    for zipnum, names in gone.iteritems():
+      zipname = self._zipname(zipnum)
+      fd, tmpname = tempfile.mkstemp(dir=self.directory)
+      os.close(fd)
+      sizes[zipnum] = 0
+      with open(zipname, 'rb') as f:
+        old = zipfile.ZipFile(f)
+        new = zipfile.ZipFile(tmpname, 'w', zipfile.ZIP_DEFLATED)
+        for name in old.namelist():
+          if name in names: continue
+          size, crc, compressed = shp2polys._read_deflated(old, name)
+          shp2polys._write_deflated(new, name, size, crc, compressed)
+          sizes[zipnum] += len(compressed)
+        new.close()
+        old.close()
+      _replace_file(tmpname, zipname)
+      logging.info('Rewrote %r without %d tiles', zipname, len(names))
+      for name in names:
+        home[name[len('tile_%s_' % self.theme):-4]] = zipnum
+
+    last = max([self._zipnum(v) for v in self.index.itervalues()] +
+               gone.keys() or [1])
+    zips = dict()
+    for zxy in sorted(added, key=lambda zxy: tile.tile_id(
+        *map(int, zxy.split('_')))):
+      data = added[zxy]
+      zipnum = home.get(zxy)
+      if zipnum is None or sizes[zipnum] + len(data) > MAX_SIZE:
+        zipnum = last
+        if zipnum not in sizes:
+          try:
+            with contextlib.closing(zipfile.ZipFile(
+                self._zipname(zipnum))) as z:
+              sizes[zipnum] = sum(zinfo.compress_size
+                                  for zinfo in z.infolist())
+          except IOError: sizes[zipnum] = 0
+        if sizes[zipnum] + len(data) > MAX_SIZE:
+          last = zipnum = last + 1
+          sizes[zipnum] = 0
+      if zipnum not in zips:
+        zipname = self._zipname(zipnum)
+        mode = 'a' if os.path.exists(zipname) else 'w'
+        zips[zipnum] = zipfile.ZipFile(zipname, mode, zipfile.ZIP_DEFLATED)
+      zips[zipnum].writestr(self._member(zxy), data)
+      sizes[zipnum] += zips[zipnum].getinfo(self._member(zxy)).compress_size
+      if self._named: self.index[zxy] = '%s_%d.zip' % (self.theme, zipnum)
+      else: self.index[zxy] = zipnum
+    for z in zips.itervalues(): z.close()
+
+    fd, tmpname = tempfile.mkstemp(dir=self.directory)
+    with os.fdopen(fd, 'wb') as f:
+      cPickle.dump(self.index, f)
+    _replace_file(tmpname, self.index_name)
+
+
+def retile(old, new, archive, zooms=None):
+  """ Re-render the tiles that differ between two Polyfiles, and update the
+  archive of the tiles accordingly.
+
+  Args:
+    old, new: shp2polys.PolyReader on the two Polyfiles
+    archive: TileArchive with the tiles drawn from the old Polyfile
+    zooms: iterable of zoom levels (default: all those in archive)
+  Returns:
+    the number of tiles re-rendered
+  """
+  if zooms is None: zooms = archive.zooms()
+  removed = []
+  added = dict()
+  for zoom, tiles in sorted(dirty_tiles(old, new, zooms).iteritems()):
+    logging.info('zoom %s: %d tiles to re-render', zoom, len(tiles))
+    for tx, ty in tiles:
+      removed.append('%s_%s_%s' % ((zoom,) + m.GoogleTile(tx, ty, zoom)))
+    added.update(render_tiles(new, zoom, tiles))
+  archive.update(removed, added)
+  return len(removed)
+
+
+def retile_theme(theme, meta, oldfile=None, directory='gae'):
+  """ Re-render a theme's tiles that changed, and update its archive.
+
+  Args:
+    theme: name of the theme, e.g. 'USA'
+    meta: the theme's data (see addazoom.themes)
+    oldfile: path of the older Polyfile for the theme (default: update the
+      theme's Polyfile from its Shapefile, comparing it to a copy of itself
+      as it was before)
+    directory: the directory of the theme's archive
+  Returns:
+    the number of tiles re-rendered
+  """
+  tmpdir = None
+  readers = []
+  try:
+    if oldfile is None:
+      # keep a copy of the Polyfile as it was, then update it
+      tmpdir = tempfile.mkdtemp()
+      oldfile = os.path.join(tmpdir, os.path.basename(meta.oufile))
+      shutil.copy2(meta.oufile, oldfile)
+      c = shp2polys.Converter(update=True, **meta)
+      c.doit()
+      logging.info('%d changed bboxes', len(c.changed_bboxes))
+    for infile in oldfile, meta.oufile:
+      readers.append(shp2polys.PolyReader(infile=infile))
+    old, new = readers
+    result = retile(old, new, TileArchive(theme, directory))
+  finally:
+    for r in readers: r.close()
+    if tmpdir is not None: shutil.rmtree(tmpdir)
+  partfile = meta.get('partfile')
+  if partfile and os.path.exists(partfile):
+    logging.info('Removing stale partfile %r', partfile)
+    os.remove(partfile)
+  return result
+
+
+def main():
+  """ Perform the script's tasks. """
+  shp2polys.setlogging(logging.INFO)
+  if len(sys.argv) not in (2, 3) or sys.argv[1] not in addazoom.themes:
+    logging.error('Usage: %s theme [oldpolyfile]', sys.argv[0])
+    logging.error('Known themes are: %s', ' '.join(sorted(addazoom.themes)))
+    sys.exit(1)
+  theme = sys.argv[1]
+  oldfile = None
+  if len(sys.argv) == 3: oldfile = sys.argv[2]
+  count = retile_theme(theme, addazoom.themes[theme], oldfile)
+  logging.info('%d tiles re-rendered', count)
+
+
+if __name__ == '__main__':
+  main()
@@ -11,9 +11,37 @@ shp2polys.Converter provided by this module, and override:
      def valid(cls, id): method returning true if id is valid
    or:
      excluded_ids: set of ids to exclude (to use the provided 'valid' method)
-To perform the conversion, init x=ConverterSubclass(), and just call x.doit().
+To perform the conversion, init x=ConverterSubclass(), and just call x.doit()
+(the Converter needs numpy, which projects each record as a whole array).
+Overriding processes (default 1) makes x.doit() convert records in that many
+worker processes (None means one per CPU); the Polyfile is the same anyway.
+Overriding lod_zooms (default, empty) makes x.doit() also write, for each of
+those zooms, a level of detail simplified (by Douglas-Peucker) so each point
+is at most lod_pixels (default 0.5) pixels off at that zoom.
+Overriding version (default 1) as 2 makes x.doit() write a Polyfile v2.
+Overriding quantum (default 0) as an int q makes x.doit() round coordinates
+to multiples of q meters, and write them delta-encoded (a much smaller file).
+Overriding topology (default False) as True makes x.doit() break all rings
+into arcs (see build_arcs), so that each boundary that neighbours share is
+stored (and simplified, for levels of detail) once, and records just refer to
+their arcs.
+Overriding update (default False) as True makes x.doit() update oufile (if it
+exists), converting just the records that changed since it was made, as told
+by their fingerprints (see function fingerprint), and copying the others as
+they are.  Either way, x.doit() then sets x.changed_bboxes to the list of the
+bboxes of the records added and removed (a changed record is both).
 
-Similarly, class .PolyReader is customized by overriding infile.
+Similarly, class .PolyReader is customized by overriding infile, zoom
+(default None: the zoom level the records are to be drawn at, to pick the
+coarsest level of detail that's good enough for it, if the Polyfile has any),
+and select_bbox (default None: if not None, a bounding box in meters, and then
+only records whose bounding boxes intersect it are read; method
+set_select_tiles sets it to the bounding box of a range of tiles).
+A PolyReader reads either version of Polyfile (telling them apart by their
+first bytes); iterating on it gives lists, method iter_arrays gives numpy
+arrays instead (for a Polyfile v2, without copying: they're views on the file).
+Method iter_arcs gives the outlines to draw: in a Polyfile with topology, each
+arc once (however many records share it), else each part of each record.
 
 All of these customizations can also be done per-instance by providing named
 args to the ctors of Converter and PolyReader (valid must be a 1-arg callable).
@@ -29,6 +57,20 @@ A Polyfile is a zipfile with the following internal organization:
      ids.txt: textfile, each line '<idstring> <idnumber>\n'
      bbox.bin: 4 little-endian 4 bytes ints: bounding box for the whole
        file, meters, in order minx, miny, maxx, maxy
+     bboxes.bin: 4 little-endian 4 bytes ints per record, in order: bounding
+       box of each record, like the one in its .pol member (older Polyfiles
+       may lack this member)
+     fingerprints.bin: 20 bytes per record, in order: the fingerprint of the
+       Shapefile record it was made from (older Polyfiles may lack this member)
+     lods.txt (optional): textfile, each line '<zoom> <tolerance>\n' for a
+       level of detail, i.e., a simplified copy of all records, in members
+       named z<zoom>/<idstring>_<recno>.pol, which is good enough to draw at
+       zooms up to <zoom> (its points are at most <tolerance> meters off)
+     quantum.txt (optional): textfile, one line '<quantum>\n', if points are
+       delta-encoded (see below) in units of <quantum> meters
+     arcs.bin (only with topology): the arcs, laid out just like a .pol
+       member (see below) whose parts are the arcs, with idnum 0; levels of
+       detail have their own, simplified arcs in members z<zoom>/arcs.bin
    and a collection of little-end bin files named <idstring>_<recno>.pol, each:
      (4-byte ints...):
      3 unsigned ints: idnum, numparts, totleng
@@ -36,18 +78,73 @@ A Polyfile is a zipfile with the following internal organization:
      numparts unsigned ints: starts of each part
      numparts unsigned ints: lengths of each part
      totleng signed ints: x then y for each point in each part (meters)
+   or, in a Polyfile with a quantum, instead of those totleng ints: bytes of
+   the deltas of the points' coordinates, in units of quantum meters (each x
+   minus the x before it, y minus the y before it; the first point's x and y
+   minus 0), each zig-zag encoded (0, -1, 1, -2, ... -> 0, 1, 2, 3, ...) and
+   written as a varint (7 bits per byte, least significant first, with the
+   high bit set in every byte but the last), see encode_varint_deltas.
+   In a Polyfile with topology, each record's member has, instead of points,
+   references to arcs (one signed int each, never delta-encoded: i for the
+   i-th arc, ~i for it reversed), and starts and lengths of parts count
+   those; each part is a ring made of its arcs in order, joined at their
+   shared end points.  Members of records are then the same at all levels of
+   detail, so there are no z<zoom>/<idstring>_<recno>.pol members.
+
+A Polyfile v2 holds the same data in one uncompressed binary file, which the
+PolyReader memory-maps rather than reads, with sections (each starting at a
+multiple of 8 bytes from the start of the file):
+     header (64 bytes): 8-bytes magic string GEPYPLY2; 4 unsigned ints:
+       numrecords, numlods, idsleng, quantum (0 if none, as in quantum.txt);
+       4 signed ints: bbox for the whole file; 3 unsigned 8-bytes ints:
+       offsets of directory, data, and arcs directory (0 without topology)
+     ID table: idsleng bytes, the same text as ids.txt above
+     LOD table: for each of numlods levels of detail, as in lods.txt above:
+       signed int zoom, 4 bytes of padding, double tolerance
+     fingerprints: numrecords times 20 bytes, as in fingerprints.bin above
+       (older Polyfiles lack this section: then, the directory comes first)
+     directory: (1+numlods)*numrecords entries, i.e., one per record for the
+       full records, then one per record for each level of detail, each:
+       unsigned 8-bytes int offset, unsigned int size of the record's data,
+       unsigned int idnum, 4 signed ints: bbox for the record
+     arcs directory (only with topology): 1+numlods entries like those of
+       the directory, for the arcs of the full records then of each level of
+       detail (data like arcs.bin above), with idnum 0
+     data: each record's data, just like a .pol member above, where the
+       directory says (with topology, all levels' entries for a record point
+       to the same data), then the arcs; each padded with 0 bytes to a
+       multiple of 4 bytes (needed just with a quantum, as delta-encoded
+       points may have any length), so int arrays are 4-bytes aligned
 """
+from __future__ import with_statement
+
 import array
-import cStringIO
+import hashlib
 import logging
+import mmap
+import multiprocessing
+import os
+import stat
 import struct
+import tempfile
+import time
 import zipfile
+import zlib
+
+try: import numpy
+except ImportError: numpy = None
 
 import shpextract
+import spindex
 import tile
 
 m = tile.GlobalMercator()
 
+MAGIC2 = 'GEPYPLY2'
+_header2 = struct.Struct('<8sIIII4iQQQ')
+_lod2 = struct.Struct('<i4xd')
+_entry2 = struct.Struct('<QII4i')
+
 # ensure all arrays are little-endian
 if shpextract.big_endian:
   # we're on a bid-endian machine, make "normalizing" swap bytes of numbers
@@ -59,6 +156,17 @@ else:
     pass
 
 
+def _align8(offset):
+  """ Round offset up to a multiple of 8 (where a Polyfile v2 section starts)
+  """
+  return (offset + 7) & ~7
+
+
+def _padding4(size):
+  """ Get the 0 bytes to pad data of a size to a multiple of 4 bytes """
+  return '\0' * (-size % 4)
+
+
 def merge_bbox(bb, obb, mima=(min,min,max,max)):
   """ Enlarge a bounding box to encompass another one as well.
 
@@ -81,7 +189,7 @@ def encode_bbox(bbox):
     str code for 4 little-endian ints, the bbox in meters
   """
   ll2m = m.LatLonToMeters
-  bbout = array.array('l')
+  bbout = array.array('i')
   for i in (0, 2):
     x, y = ll2m(bbox[i+1], bbox[i])
     bbout.append(int(x))
@@ -90,6 +198,426 @@ def encode_bbox(bbox):
   return bbout.tostring()
 
 
+def simplify_mask(xs, ys, tolerance, ends=None):
+  """ Find the points Douglas-Peucker simplification keeps in polylines.
+
+  Rather than recursing on one span of points at a time, each round splits
+  at once all spans with some point farther than tolerance from the segment
+  joining the span's ends (at their farthest point), so the work is a few
+  numpy operations on all points per round, for a number of rounds that's
+  the depth of the recursion (typically, a few dozens).
+
+  Args:
+    xs, ys: numpy arrays with the coordinates of the polylines' points
+    tolerance: max distance of a dropped point from the simplified polyline
+    ends: increasing indices at which each polyline ends, the last being
+      len(xs) (default: xs, ys are one polyline)
+  Returns:
+    numpy array of bool, true for the points to keep (the first and last of
+      each polyline are always kept, so closed rings stay closed)
+  """
+  n = len(xs)
+  if ends is None: ends = [n]
+  keep = numpy.zeros(n, bool)
+  ends = numpy.asarray(ends, int)
+  keep[ends - 1] = True
+  keep[numpy.append(0, ends[:-1])] = True
+  xs = xs.astype(float)
+  ys = ys.astype(float)
+  tol2 = float(tolerance) ** 2
+  while True:
+    # each point's span: between the last kept point before it, and the next
+    kept = numpy.flatnonzero(keep)
+    span = numpy.cumsum(keep) - 1
+    first = kept[span]
+    last = kept[numpy.minimum(span + 1, len(kept) - 1)]
+    x0, y0 = xs[first], ys[first]
+    dx, dy = xs[last] - x0, ys[last] - y0
+    px, py = xs - x0, ys - y0
+    seglen2 = dx*dx + dy*dy
+    # distance from the segment (not the line): clip the projection to it
+    t = px*dx + py*dy
+    numpy.divide(t, seglen2, t, where=seglen2 > 0)
+    t[seglen2 == 0] = 0
+    numpy.clip(t, 0.0, 1.0, t)
+    px -= t*dx
+    py -= t*dy
+    dist2 = px*px + py*py
+    dist2[keep] = 0
+    # in each span (kept points start spans), the farthest point, if too far
+    spanmax = numpy.maximum.reduceat(dist2, kept)
+    far = numpy.flatnonzero((dist2 > tol2) & (dist2 == spanmax[span]))
+    if not len(far): return keep
+    # only split each span once per round (at its first farthest point)
+    far = far[numpy.unique(span[far], return_index=True)[1]]
+    keep[far] = True
+
+
+def encode_varint_deltas(values):
+  """ Get the zig-zag varint deltas encoding of x, y, x, y, ... ints.
+
+  Args:
+    values: sequence (or numpy array) of ints x, y, x, y, ...
+  Returns:
+    str with the encoding (see module docstring)
+  """
+  pairs = numpy.asarray(values, numpy.int64).reshape(-1, 2)
+  deltas = numpy.empty_like(pairs)
+  deltas[:1] = pairs[:1]
+  numpy.subtract(pairs[1:], pairs[:-1], deltas[1:])
+  deltas = deltas.ravel()
+  zigzag = (deltas << 1) ^ (deltas >> 63)
+  # how many bytes (of 7 bits each) each value needs
+  nbytes = numpy.ones(len(zigzag), int)
+  rest = zigzag >> 7
+  while rest.any():
+    nbytes += rest > 0
+    rest >>= 7
+  firsts = numpy.cumsum(nbytes) - nbytes
+  out = numpy.empty(nbytes.sum(), numpy.uint8)
+  # fill in the k-th byte of all values that have one, for k = 0, 1, ...
+  which = numpy.arange(len(zigzag))
+  k = 0
+  while len(which):
+    more = nbytes[which] > k + 1
+    out[firsts[which] + k] = (zigzag[which] >> 7*k) & 0x7f | more << 7
+    which = which[more]
+    k += 1
+  return out.tostring()
+
+
+def decode_varint_deltas(data, count, offset=0, size=-1):
+  """ Get the ints that encode_varint_deltas encoded, all at once.
+
+  Args:
+    data: str (or buffer, mmap...) with the encoding
+    count: the number of ints encoded
+    offset: where the encoding starts in data
+    size: length of the encoding (-1: all the rest of data)
+  Returns:
+    numpy array of int64 x, y, x, y, ...
+  Raises:
+    ValueError if data does not have count ints' encodings
+  """
+  codes = numpy.frombuffer(data, numpy.uint8, size, offset)
+  last = codes < 0x80
+  if last.sum() != count or (count and not last[-1]):
+    raise ValueError, 'Corrupt encoding of %d ints' % count
+  if not count: return numpy.zeros(0, numpy.int64)
+  ends = numpy.flatnonzero(last) + 1
+  firsts = ends - numpy.diff(numpy.append(0, ends))
+  # each byte's position within its value's encoding gives its shift
+  shifts = 7 * (numpy.arange(len(codes)) - numpy.repeat(firsts, ends-firsts))
+  bits = (codes & 0x7f).astype(numpy.int64) << shifts
+  zigzag = numpy.bitwise_or.reduceat(bits, firsts)
+  deltas = (zigzag >> 1) ^ -(zigzag & 1)
+  return deltas.reshape(-1, 2).cumsum(axis=0).ravel()
+
+
+def fingerprint(id, parts):
+  """ Get the fingerprint of a Shapefile record, to tell if it has changed.
+
+  Args:
+    id: the ID of the record
+    parts: the record's data, as from Shp.get_next_record
+  Returns:
+    str, the 20 bytes SHA-1 digest of the record's ID and data
+  """
+  digest = hashlib.sha1('%d:%s' % (len(id), id))
+  for part in parts:
+    part = buffer(part)
+    digest.update(struct.pack('<I', len(part)))
+    digest.update(part)
+  return digest.digest()
+
+
+def _member(idnum, bbox, parts_lengths, oudata, quantum=0):
+  """ Get the str data of a Polyfile member (see module docstring) """
+  parts_starts = numpy.zeros(len(parts_lengths), '<u4')
+  numpy.cumsum(parts_lengths[:-1], out=parts_starts[1:])
+  if quantum: points = encode_varint_deltas(oudata // quantum)
+  else: points = oudata.tostring()
+  return ''.join((
+      struct.pack('<LLL', idnum, len(parts_lengths), len(oudata)),
+      struct.pack('<4i', *bbox),
+      parts_starts.tostring(),
+      parts_lengths.tostring(),
+      points))
+
+
+def project_record(idnum, parts, quantum=0):
+  """ Project a Shapefile record's parts to int meters.
+
+  Args:
+    idnum: the ID number of the record
+    parts: the record's data, as from Shp.get_next_record (1+ buffers or
+      arrays of little-endian doubles, lon/lat/lon/lat/...)
+    quantum: if not 0, round meters to multiples of it
+  Returns:
+    tuple: the bbox of the record (4 ints, meters), numpy array of the
+      lengths of parts (in ints), numpy array of ints x, y, x, y, ...
+  Raises:
+    ValueError if some point can't be projected (e.g., latitude of 90)
+  """
+  # get lengths of parts (whatever they're made of), and total_length, in
+  # numbers
+  numparts = len(parts)
+  parts = [numpy.frombuffer(p, '<f8') for p in parts]
+  parts_lengths = numpy.array([len(p) for p in parts], '<u4')
+  total_length = int(parts_lengths.sum())
+
+  # project all points of all parts at once, truncating meters to ints
+  lonlat = numpy.concatenate(parts)
+  mx, my = m.LatLonToMetersArray(lonlat[1::2], lonlat[0::2])
+  if not (numpy.isfinite(mx).all() and numpy.isfinite(my).all()):
+    bad = ~(numpy.isfinite(mx) & numpy.isfinite(my))
+    logging.fatal('(%s,%s) -> (%s,%s)', lonlat[1::2][bad][0],
+        lonlat[0::2][bad][0], mx[bad][0], my[bad][0])
+    raise ValueError, 'Unprojectable points in record #%d' % idnum
+  oudata = numpy.empty(total_length, '<i4')
+  oudata[0::2] = mx
+  oudata[1::2] = my
+  if quantum:
+    oudata += quantum // 2
+    oudata -= oudata % quantum
+  xs, ys = oudata[0::2], oudata[1::2]
+  bbox = [int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max())]
+
+  logging.debug('#%d: %d@%d', idnum, numparts, total_length)
+  logging.debug(' Lalo=(%.2f %.2f) xy=(%d %d)', lonlat[1], lonlat[0],
+      oudata[0], oudata[1])
+  return bbox, parts_lengths, oudata
+
+
+def _simplify(parts_lengths, oudata, tolerance):
+  """ Simplify each of some polylines, keeping all of them and their ends.
+
+  Args:
+    parts_lengths: numpy array of the lengths of polylines (in ints)
+    oudata: numpy array of ints x, y, x, y, ... of all the polylines
+    tolerance: max distance of a dropped point from the simplified polyline
+  Returns:
+    tuple: numpy arrays of the lengths of the simplified polylines, and of
+      their ints x, y, x, y, ...
+  """
+  ends = numpy.cumsum(parts_lengths) // 2
+  keep = simplify_mask(oudata[0::2], oudata[1::2], tolerance, ends)
+  kept = numpy.append(0, numpy.cumsum(keep)[ends - 1])
+  lod_lengths = (2 * numpy.diff(kept)).astype('<u4')
+  return lod_lengths, oudata.reshape(-1, 2)[keep].ravel()
+
+
+def encode_record(idnum, parts, tolerances=(), quantum=0):
+  """ Project a Shapefile record's parts and make its Polyfile member[s].
+
+  Args:
+    idnum: the ID number of the record
+    parts: the record's data, as from Shp.get_next_record (1+ buffers or
+      arrays of little-endian doubles, lon/lat/lon/lat/...)
+    tolerances: meters of tolerance for each level of detail to make
+    quantum: if not 0, round meters to multiples of it, and delta-encode them
+  Returns:
+    tuple: the bbox of the record (4 ints, meters), str data of the member,
+      list with the str data of the member for each tolerance (in order)
+  Raises:
+    ValueError if some point can't be projected (e.g., latitude of 90)
+  """
+  bbox, parts_lengths, oudata = project_record(idnum, parts, quantum)
+  # simplified versions keep the bbox of the full one, and all of its parts
+  lods = []
+  for tolerance in tolerances:
+    lod_lengths, lod_data = _simplify(parts_lengths, oudata, tolerance)
+    lods.append(_member(idnum, bbox, lod_lengths, lod_data, quantum))
+  return bbox, _member(idnum, bbox, parts_lengths, oudata, quantum), lods
+
+
+def build_arcs(parts):
+  """ Break polylines into arcs, so that the stretches they share are one arc.
+
+  A point is a junction if it has different pairs of neighbours in different
+  polylines (or in the same one, when it passes there more than once), or if
+  it's an end of a polyline that's not closed (its first and last points are
+  different).  Each polyline is cut at its junctions (a closed one with no
+  junction is one arc, starting at its lowest point, so that identical rings
+  make identical arcs), and equal arcs, even if one is the other reversed,
+  are kept just once.
+
+  Args:
+    parts: list of numpy arrays of ints x, y, x, y, ..., the polylines (each
+      of at least 2 points)
+  Returns:
+    tuple: list of numpy arrays of ints x, y, x, y, ..., the arcs; list with,
+      for each polyline, the list of references to its arcs, in order (i for
+      the i-th arc, ~i for it reversed), such that joining them at their
+      shared end points gives back the polyline (if closed, starting from
+      another of its points, maybe)
+  """
+  # each point of each polyline (but the last of closed ones, the same as the
+  # first), as one int64 key, and the keys of its neighbours
+  keys, prevs, nexts, forced = [], [], [], []
+  for part in parts:
+    pairs = numpy.asarray(part, numpy.int64).reshape(-1, 2)
+    k = (pairs[:, 0] << 32) + (pairs[:, 1] & 0xffffffff)
+    if k[0] == k[-1] and len(k) > 2:
+      k = k[:-1]
+      prevs.append(numpy.roll(k, 1))
+      nexts.append(numpy.roll(k, -1))
+    else:
+      # neighbours of the ends don't matter: they're junctions anyway
+      prevs.append(numpy.append(k[:1], k[:-1]))
+      nexts.append(numpy.append(k[1:], k[-1:]))
+      forced.append(k[[0, -1]])
+    keys.append(k)
+  allkeys = numpy.concatenate(keys)
+  lo = numpy.minimum(numpy.concatenate(prevs), numpy.concatenate(nexts))
+  hi = numpy.maximum(numpy.concatenate(prevs), numpy.concatenate(nexts))
+  # sort by point then neighbours: junctions have more than one neighbours
+  order = numpy.lexsort((hi, lo, allkeys))
+  sk, slo, shi = allkeys[order], lo[order], hi[order]
+  samekey = sk[1:] == sk[:-1]
+  otherpair = (slo[1:] != slo[:-1]) | (shi[1:] != shi[:-1])
+  junctions = numpy.concatenate([sk[1:][samekey & otherpair]] + forced)
+  is_junction = numpy.in1d(allkeys, junctions)
+
+  arcs = []
+  arc_by_points = dict()
+  refs = []
+  first_key = 0
+  for k, part in zip(keys, parts):
+    pairs = numpy.asarray(part).reshape(-1, 2)
+    n = len(k)
+    cuts = numpy.flatnonzero(is_junction[first_key:first_key+n])
+    first_key += n
+    if n < len(pairs):
+      # closed: start at a junction (or the lowest point), and end there too
+      first = cuts[0] if len(cuts) else int(k.argmin())
+      pairs = numpy.roll(pairs[:-1], -first, axis=0)
+      pairs = numpy.append(pairs, pairs[:1], axis=0)
+      cuts = numpy.append((cuts - first) % n, n) if len(cuts) else [0, n]
+      cuts = numpy.unique(cuts)
+    part_refs = []
+    for start, stop in zip(cuts[:-1], cuts[1:]):
+      arc = pairs[start:stop+1]
+      key = arc.tostring()
+      if key in arc_by_points:
+        part_refs.append(arc_by_points[key])
+        continue
+      reverse_key = arc[::-1].tostring()
+      if reverse_key in arc_by_points:
+        part_refs.append(~arc_by_points[reverse_key])
+        continue
+      arc_by_points[key] = len(arcs)
+      part_refs.append(len(arcs))
+      arcs.append(arc.ravel())
+    refs.append(part_refs)
+  return arcs, refs
+
+
+def _deflate(data):
+  """ Get the CRC and the compressed data for a zipfile member, as writestr.
+  """
+  co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+  return zlib.crc32(data) & 0xffffffff, co.compress(data) + co.flush()
+
+
+def _read_deflated(zip, name):
+  """ Get a zipfile member's data, as _deflate would make it, without having
+  to decompress it (if it's deflated): the opposite of _write_deflated.
+
+  Args:
+    zip: zipfile.ZipFile open for reading
+    name: the name of the member
+  Returns:
+    tuple of length of the member's (uncompressed) data, CRC, compressed data
+  """
+  zinfo = zip.getinfo(name)
+  if zinfo.compress_type != zipfile.ZIP_DEFLATED:
+    data = zip.read(name)
+    return (len(data),) + _deflate(data)
+  # the data follow the local file header, with its name and extra field
+  zip.fp.seek(zinfo.header_offset)
+  header = zip.fp.read(30)
+  name_length, extra_length = struct.unpack('<HH', header[26:30])
+  zip.fp.seek(zinfo.header_offset + 30 + name_length + extra_length)
+  return zinfo.file_size, zinfo.CRC, zip.fp.read(zinfo.compress_size)
+
+
+def _write_deflated(zip, name, size, crc, compressed):
+  """ Add a member to a zipfile, given the results of _deflate on its data.
+
+  Args:
+    zip: zipfile.ZipFile open for writing
+    name: the name of the member
+    size: length of the member's (uncompressed) data
+    crc, compressed: as returned by _deflate on the member's data
+  """
+  zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+  zinfo.compress_type = zipfile.ZIP_DEFLATED
+  zinfo.external_attr = 0600 << 16
+  zinfo.file_size = size
+  zinfo.compress_size = len(compressed)
+  zinfo.CRC = crc
+  # as ZipFile.writestr does, after it's compressed the data
+  zinfo.header_offset = zip.fp.tell()
+  zip._didModify = True
+  zip.fp.write(zinfo.FileHeader())
+  zip.fp.write(compressed)
+  zip.filelist.append(zinfo)
+  zip.NameToInfo[name] = zinfo
+
+
+def _convert_records(shp, idnum_by_idvalue, tolerances, quantum, compress,
+                     topology, recnos):
+  """ Make the Polyfile members for some records of a Shp.
+
+  Args:
+    shp: a Shp, memory-mapped
+    idnum_by_idvalue: dict from the ID of each record to its ID number
+    tolerances: meters of tolerance for each level of detail to make
+    quantum: if not 0, meters per unit of the delta-encoded coordinates
+    compress: true to compress members (for a zipfile, i.e. a Polyfile v1)
+    topology: true to just project records (their members need all arcs)
+    recnos: list of the numbers of the records to convert (with valid IDs)
+  Returns:
+    list with (ID, bbox, members) per record, where members has, for the
+      full record then each level of detail, its str data or, if compress,
+      (uncompressed size, crc, compressed data); if topology, instead of
+      members, the list of numpy arrays of int meters of the record's parts
+  """
+  result = []
+  for rec in shp.get_records(recnos):
+    if topology:
+      bbox, parts_lengths, oudata = project_record(idnum_by_idvalue[rec[0]],
+                                                   rec[1:], quantum)
+      ends = numpy.cumsum(parts_lengths)[:-1]
+      result.append((rec[0], bbox, numpy.split(oudata, ends)))
+      continue
+    bbox, data, lods = encode_record(idnum_by_idvalue[rec[0]], rec[1:],
+                                     tolerances, quantum)
+    members = [data] + lods
+    if compress: members = [(len(d),) + _deflate(d) for d in members]
+    result.append((rec[0], bbox, members))
+  return result
+
+
+# in worker processes, the Shp being converted, and the IDs' numbers
+_worker_args = None
+
+def _init_worker(infile, nameid, valid_ids, idnum_by_idvalue, tolerances,
+                 quantum, compress, topology):
+  """ Open in a worker process its own Shp, to convert chunks of records
+  (those whose IDs are in set valid_ids)
+  """
+  global _worker_args
+  shp = shpextract.Shp(infile, None, nameid, valid_ids.__contains__,
+                       use_mmap=True)
+  _worker_args = shp, idnum_by_idvalue, tolerances, quantum, compress, topology
+
+def _convert_chunk(recnos):
+  """ Run _convert_records in a worker process (set up by _init_worker) """
+  return _convert_records(*_worker_args + (recnos,))
+
+
 class Converter(object):
   """ Performs Shapefile -> Polyfile conversion. """
   # class-overridable data and methods
@@ -98,105 +626,417 @@ class Converter(object):
   nameid = 'STUSPS'
   excluded_ids = set('HI AK VI GU PR AS MP'.split())
   def valid(self, id): return id not in self.excluded_ids
+  # number of worker processes converting records (None: one per CPU)
+  processes = 1
+  # number of records each worker converts at a time
+  chunk_size = 64
+  # zooms to make levels of detail for, and their tolerance, in pixels
+  lod_zooms = ()
+  lod_pixels = 0.5
+  # version of Polyfile to write (1: a zipfile, 2: one binary file)
+  version = 1
+  # meters per unit of delta-encoded coordinates (0: not delta-encoded)
+  quantum = 0
+  # true to store records as references to arcs, each shared boundary once
+  topology = False
+  # true to update oufile, if it exists, converting only the changed records
+  update = False
 
   def __init__(self, **kwds):
-    """ Open input shapefile and output polyfile. """
+    """ Open input shapefile and output polyfile (when updating one, a new
+    temporary file, next to it, to take its place when done).
+    """
+    if numpy is None:
+      raise ImportError, 'Converter needs numpy'
     self.__dict__.update(kwds)
-    self.shp = shpextract.Shp(self.infile, None, self.nameid, self.valid)
-    self.zip = zipfile.ZipFile(self.oufile, 'w', zipfile.ZIP_DEFLATED)
+    if self.version not in (1, 2):
+      raise ValueError, 'No Polyfile version %r' % self.version
+    self.shp = shpextract.Shp(self.infile, None, self.nameid, self.valid,
+                              use_mmap=True)
+    self.old = None
+    self._outname = self.oufile
+    if self.update and os.path.exists(self.oufile):
+      self.old = PolyReader(infile=self.oufile)
+      fd, self._outname = tempfile.mkstemp(
+          dir=os.path.dirname(self.oufile) or '.')
+      os.close(fd)
+      os.chmod(self._outname, stat.S_IMODE(os.stat(self.oufile).st_mode))
+    if self.version == 1:
+      self.zip = zipfile.ZipFile(self._outname, 'w', zipfile.ZIP_DEFLATED)
+    else:
+      self.out = open(self._outname, 'wb')
     self.idnum_by_idvalue = dict()
+    # bboxes of records added or removed (both, if changed) by doit
+    self.changed_bboxes = []
+    # the pool of worker processes, while they're converting
+    self._pool = None
     self._closed = False
 
   def close(self):
-    """ Close the open files (noop if called more than once). """
+    """ Close the open files (noop if called more than once); when updating,
+    replace the old Polyfile with the new one.
+    """
+    if self._closed: return
+    self.shp.close()
+    if self.version == 1: self.zip.close()
+    else: self.out.close()
+    if self.old is not None:
+      self.old.close()
+      try: os.rename(self._outname, self.oufile)
+      except OSError:
+        # e.g. on Windows, rename does not replace an existing file
+        os.remove(self.oufile)
+        os.rename(self._outname, self.oufile)
+    self._closed = True
+
+  def _abort(self):
+    """ Stop the worker processes, if any, and close the open files, after a
+    failure; when updating, remove the new Polyfile, leaving the old one as
+    it was.
+    """
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool.join()
+      self._pool = None
     if self._closed: return
     self.shp.close()
-    self.zip.close()
+    if self.version == 1: self.zip.close()
+    else: self.out.close()
+    if self.old is not None:
+      self.old.close()
+      os.remove(self._outname)
     self._closed = True
 
   def doit(self):
-    """ Perform all of the conversion and close all open files. """
-    ll2m = m.LatLonToMeters
-    def recno_id_bbox_data(s=self.shp):
-      """ Generator returning (index, ID, bbox, data) for Shapefile records """
-      i = 0
-      while True:
-        rec = s.get_next_record(bbox=1)
-        if rec is None: return
-        yield i, rec[0], rec[1], rec[2:]
-        i += 1
-
-    class Extreme(object):
-      """ Utility subclass: instances represent + or - infinity """
-      def __init__(self, allcmp): self.allcmp = allcmp
-      def __cmp__(self, other): return self.allcmp
-    # use + and - infinity to initialize the overall bounding box
-    High = Extreme(1); Low = Extreme(-1)
-    overall_bbox = [High, High, Low, Low]
-
-    # loop over all records in the Shapefile, making their polygons
-    for recno, id, bbox, indata in recno_id_bbox_data():
-      # translate ID values into increasing integers
+    """ Perform all of the conversion and close all open files (if it fails,
+    see _abort).
+
+    Records are converted in order of record number, and their data and ID
+    numbers don't depend on self.processes: with more than one process, each
+    worker converts (and compresses) chunks of records, while this process
+    just writes them to the Polyfile, in order.  With self.topology, workers
+    just project records, and this process, once it has them all, builds
+    their arcs (see _make_topology) before writing.
+
+    With self.update, records whose fingerprints are also in the old
+    Polyfile (if it was made with the same version, quantum, topology and
+    levels of detail) are not converted: their data are copied as they are
+    (still compressed, for a Polyfile v1), and their IDs keep their numbers
+    (new IDs get numbers higher than all old ones); with topology, just
+    their projection is skipped, as arcs are all built anew.  Either way,
+    self.changed_bboxes gets the bboxes of the new records that were
+    converted, then those of the old ones that were not reused.
+    """
+    try: self._convert()
+    except:
+      self._abort()
+      raise
+
+  def _convert(self):
+    """ Perform all of the conversion and close all open files (see doit) """
+    # find records with valid IDs
+    recnos = []
+    ids = []
+    recno = 1
+    while True:
+      id = self.shp.get_id(recno)
+      if id is False: break
+      if id is not None:
+        recnos.append(recno)
+        ids.append(id)
+      recno += 1
+    lod_zooms = sorted(self.lod_zooms)
+    tolerances = [self.lod_pixels * m.Resolution(z) for z in lod_zooms]
+    compress = self.version == 1
+
+    # find the records (by position) that an old Polyfile has already, and
+    # translate ID values to increasing ints (old ones keep their numbers)
+    fingerprints = self._fingerprints(recnos)
+    old_of = self._reusable(fingerprints, lod_zooms, tolerances)
+    old_idnums = dict()
+    if old_of:
+      old_idnums = dict((name, num) for num, name in
+                        self.old.name_by_num.iteritems())
+    next_idnum = max(old_idnums.values() or [-1]) + 1
+    for id in ids:
       if id not in self.idnum_by_idvalue:
-        self.idnum_by_idvalue[id] = len(self.idnum_by_idvalue)
-      idnum = self.idnum_by_idvalue[id]
-      # ensure overall_bbox also encloses the current record's bbox
-      merge_bbox(overall_bbox, bbox)
-      # translate 'indata' to arrays _starts and _lengths, and total_length
-      numparts = len(indata)
-      parts_starts = array.array('L', [0])
-      parts_lengths = array.array('L')
-      for p in indata:
-        parts_lengths.append(len(p))
-        parts_starts.append(parts_starts[-1] + len(p))
-      total_length = parts_starts.pop()
-      normalize_arrays(parts_starts, parts_lengths)
-      # start polygon file-like object with "header" information
-      out = cStringIO.StringIO()
-      out.write(struct.pack('<LLL', idnum, numparts, total_length))
-      out.write(encode_bbox(bbox))
-      out.write(parts_starts.tostring())
-      out.write(parts_lengths.tostring())
-
-      logging.debug('%s (%d): %d@%d', id, idnum, numparts, total_length)
-
-      # make polygon for each part in the data, write them all into 'out'
-      for p in indata:
-        lons = iter(p)
-        oudata = array.array('l', [0]*len(p))
-        i = 0
-        for lon in lons:
-          lat = lons.next()
-          x, y = ll2m(lat, lon)
-          if i==0:
-            logging.debug(' Lalo=(%.2f %.2f) xy=(%.2f %.2f)', lat, lon, x, y)
-          try:
-            oudata[i] = int(x)
-            oudata[i+1] = int(y)
-          except (OverflowError, ValueError), err:
-            logging.fatal('(%s,%s) -> (%s,%s)', lat, lon, x, y)
-            raise
-          i += 2
-        normalize_arrays(oudata)
-        out.write(oudata.tostring())
-      # save out's contents to the zipfile and close it
-      self.zip.writestr('%s_%d.pol' % (id, recno), out.getvalue())
-      out.close()
+        if id in old_idnums: self.idnum_by_idvalue[id] = old_idnums[id]
+        else:
+          self.idnum_by_idvalue[id] = next_idnum
+          next_idnum += 1
+    to_convert = [recno for i, recno in enumerate(recnos) if i not in old_of]
+    chunks = [to_convert[i:i+self.chunk_size]
+              for i in xrange(0, len(to_convert), self.chunk_size)]
+    if self.old is not None:
+      logging.info('%d records to convert, %d to copy, %d to remove',
+                   len(to_convert), len(old_of),
+                   len(self.old.filenames) - len(old_of))
+
+    # the ID values to ID numbers correspondence
+    ids_text = ''.join('%s %d\n' % (id, self.idnum_by_idvalue[id])
+                       for id in sorted(self.idnum_by_idvalue))
+
+    if self.version == 2:
+      # all sizes but the data's are known: data go at the end, and, as each
+      # record is written, its directory entries are made ready
+      lods_at = _align8(_header2.size + len(ids_text))
+      fingerprints_at = _align8(lods_at + _lod2.size * len(lod_zooms))
+      dir_at = _align8(fingerprints_at + 20 * len(recnos))
+      data_at = dir_at + _entry2.size * (1+len(lod_zooms)) * len(recnos)
+      directory = [[] for z in [None] + lod_zooms]
+      # with topology, the arcs directory goes right after the directory
+      arcs_at = 0
+      if self.topology:
+        arcs_at = data_at
+        data_at += _entry2.size * (1+len(lod_zooms))
+      self.out.seek(data_at)
+
+    if self.processes == 1:
+      converted = (_convert_records(self.shp, self.idnum_by_idvalue,
+                                    tolerances, self.quantum, compress,
+                                    self.topology, chunk)
+                   for chunk in chunks)
+    else:
+      # workers check IDs against those found valid here: self.valid, a
+      # bound method, can't be pickled (as needed without fork)
+      self._pool = multiprocessing.Pool(self.processes, _init_worker,
+          (self.infile, self.nameid, frozenset(ids), self.idnum_by_idvalue,
+           tolerances, self.quantum, compress, self.topology))
+      converted = self._pool.imap(_convert_chunk, chunks)
+    if self.old is not None:
+      converted = self._merge(ids, old_of, converted, lod_zooms)
+    if self.topology:
+      converted, arcs_bbox, arcs_members = self._make_topology(converted,
+          tolerances, compress)
+
+    # the overall bounding box (meters) starts empty, from + to - infinity
+    inf = float('inf')
+    overall_bbox = [inf, inf, -inf, -inf]
+
+    # write the records' polygons in order, numbering them from 0
+    seq = 0
+    record_bboxes = []
+    prefixes = [''] + ['z%d/' % z for z in lod_zooms]
+    for chunk in converted:
+      for id, bbox, members in chunk:
+        # ensure overall_bbox also encloses the current record's bbox
+        merge_bbox(overall_bbox, bbox)
+        if seq not in old_of: self.changed_bboxes.append(tuple(bbox))
+        record_bboxes.append(struct.pack('<4i', *bbox))
+        if self.version == 2:
+          idnum = self.idnum_by_idvalue[id]
+          for level, entries in enumerate(directory):
+            # with topology, the one member of a record serves at all levels
+            if level < len(members):
+              entry = _entry2.pack(self.out.tell(), len(members[level]), idnum,
+                                   *bbox)
+              self.out.write(members[level])
+              self.out.write(_padding4(len(members[level])))
+            entries.append(entry)
+        else:
+          for prefix, (size, crc, compressed) in zip(prefixes, members):
+            _write_deflated(self.zip, '%s%s_%d.pol' % (prefix, id, seq),
+                            size, crc, compressed)
+        seq += 1
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+    if self.old is not None:
+      reused = set(old_of.itervalues())
+      old_bboxes = self.old.get_bboxes()
+      for j in range(len(self.old.filenames)):
+        if j in reused: continue
+        if old_bboxes is None:
+          # no bboxes table: take the bbox in the record's own data instead
+          data, offset, size = self.old._record_data(0, j)
+          self.changed_bboxes.append(struct.unpack_from('<4i', data,
+                                                        offset + 12))
+        else: self.changed_bboxes.append(old_bboxes[j])
+
+    if self.version == 2:
+      # with topology, the arcs go after all records' data
+      arcs_entries = []
+      if self.topology:
+        for data in arcs_members:
+          arcs_entries.append(_entry2.pack(self.out.tell(), len(data), 0,
+                                           *arcs_bbox))
+          self.out.write(data)
+          self.out.write(_padding4(len(data)))
+      # the header, ID and LOD tables, directories, all go before the data
+      logging.debug(' OvaBB %s', ' '.join('%.2f'%x for x in overall_bbox))
+      self.out.seek(0)
+      self.out.write(_header2.pack(MAGIC2, len(recnos), len(lod_zooms),
+          len(ids_text), self.quantum,
+          *tuple(overall_bbox) + (dir_at, data_at, arcs_at)))
+      self.out.write(ids_text)
+      self.out.seek(lods_at)
+      for zoom, tolerance in zip(lod_zooms, tolerances):
+        self.out.write(_lod2.pack(zoom, tolerance))
+      self.out.seek(fingerprints_at)
+      self.out.write(''.join(fingerprints))
+      self.out.seek(dir_at)
+      for entries in directory:
+        self.out.write(''.join(entries))
+      self.out.write(''.join(arcs_entries))
+      self.close()
+      return
 
     # record in the polyfile the ID values to ID numbers correspondence
-    out = cStringIO.StringIO()
-    for id in sorted(self.idnum_by_idvalue):
-      idnum = self.idnum_by_idvalue[id]
-      out.write('%s %d\n' % (id, idnum))
-    self.zip.writestr('ids.txt', out.getvalue())
-    out.close()
+    self.zip.writestr('ids.txt', ids_text)
+
+    # record in the polyfile the quantum of delta-encoding, if any
+    if self.quantum:
+      self.zip.writestr('quantum.txt', '%d\n' % self.quantum)
+
+    # record in the polyfile the arcs, if any, at each level of detail
+    if self.topology:
+      for prefix, data in zip(prefixes, arcs_members):
+        self.zip.writestr(prefix + 'arcs.bin', data)
+
+    # record in the polyfile the levels of detail, if any
+    if lod_zooms:
+      self.zip.writestr('lods.txt', ''.join('%d %r\n' % (zoom, tolerance)
+          for zoom, tolerance in zip(lod_zooms, tolerances)))
 
     # record in the polyfile the overall bounding box
     logging.debug(' OvaBB %s', ' '.join('%.2f'%x for x in overall_bbox))
-    self.zip.writestr('bbox.bin', encode_bbox(overall_bbox))
+    self.zip.writestr('bbox.bin', struct.pack('<4i', *overall_bbox))
+
+    # record in the polyfile the bounding box of each record, in order
+    self.zip.writestr('bboxes.bin', ''.join(record_bboxes))
+
+    # record in the polyfile the fingerprint of each record, in order
+    self.zip.writestr('fingerprints.bin', ''.join(fingerprints))
 
     self.close()
 
+  def _fingerprints(self, recnos):
+    """ Get the fingerprint (see function fingerprint) of each of some
+    records, in order
+    """
+    result = []
+    for i in xrange(0, len(recnos), self.chunk_size):
+      for rec in self.shp.get_records(recnos[i:i+self.chunk_size]):
+        result.append(fingerprint(rec[0], rec[1:]))
+    return result
+
+  def _reusable(self, fingerprints, lod_zooms, tolerances):
+    """ Find records that the old Polyfile being updated has already.
+
+    Args:
+      fingerprints: the fingerprint of each record to write, in order
+      lod_zooms, tolerances: those of the levels of detail to write
+    Returns:
+      dict from the position of each such record to that of its copy in the
+        old Polyfile (empty if none, or if there's no old Polyfile, or it's
+        made in another way or lacks fingerprints, so it can't be reused)
+    """
+    old = self.old
+    if old is None: return dict()
+    if (old.fingerprints is None or old.version != self.version or
+        old.quantum != self.quantum or old.topology != bool(self.topology) or
+        old.lod_zooms != lod_zooms or old.lod_tolerances != tolerances):
+      logging.info('Polyfile %r not reusable, converting all', self.oufile)
+      return dict()
+    olds_by_fingerprint = dict()
+    for j, fp in enumerate(old.fingerprints):
+      olds_by_fingerprint.setdefault(fp, []).append(j)
+    old_of = dict()
+    for i, fp in enumerate(fingerprints):
+      olds = olds_by_fingerprint.get(fp)
+      if olds: old_of[i] = olds.pop(0)
+    return old_of
+
+  def _merge(self, ids, old_of, converted, lod_zooms):
+    """ Merge the records converted and those copied from the old Polyfile.
+
+    Args:
+      ids: the ID of each record to write, in order
+      old_of: dict from the position of each record to copy to that of its
+        copy in the old Polyfile, as from _reusable
+      converted: iterable of chunks (lists) of converted records, as from
+        _convert_records, for all the records to write but those to copy
+      lod_zooms: the zooms of the levels of detail
+    Returns:
+      iterator on chunks (lists) of all the records to write, in order, like
+        _convert_records would make them (with topology, the parts of those
+        copied are read back from the old Polyfile)
+    """
+    old = self.old
+    old_bboxes = old.get_bboxes()
+    prefixes = [''] + ['z%d/' % z for z in lod_zooms]
+    converted = (record for chunk in converted for record in chunk)
+    chunk = []
+    for i, id in enumerate(ids):
+      if i not in old_of:
+        chunk.append(converted.next())
+      else:
+        j = old_of[i]
+        if self.topology:
+          data, offset, size = old._record_data(0, j)
+          refs_lengths, refs = old._decode(data, offset, size, 0)[3:]
+          starts, lengths, meters = old._resolve(0, refs_lengths, refs)
+          meters = meters.astype('<i4')
+          members = [meters[s:s+l] for s, l in zip(starts, lengths)]
+        elif self.version == 2:
+          members = []
+          for level in range(len(prefixes)):
+            data, offset, size = old._record_data(level, j)
+            members.append(data[offset:offset+size])
+        else:
+          members = [_read_deflated(old.zip, prefix + old.filenames[j])
+                     for prefix in prefixes]
+        chunk.append((id, list(old_bboxes[j]), members))
+      if len(chunk) == self.chunk_size:
+        yield chunk
+        chunk = []
+    if chunk: yield chunk
+
+
+  def _make_topology(self, converted, tolerances, compress):
+    """ Break the rings of all records into arcs, and make their members.
+
+    Args:
+      converted: iterable of chunks (lists) of (ID, bbox, parts) per record,
+        as from _convert_records with topology
+      tolerances: meters of tolerance for each level of detail to make
+      compress: true to compress records' members (for a Polyfile v1)
+    Returns:
+      tuple: list of one chunk of (ID, bbox, members) per record, where
+        members has just the str data of the record's member (or, if
+        compress, (uncompressed size, crc, compressed data)); bbox of all the
+        arcs; list with the str data of the arcs for the full records then
+        for each level of detail (each arc simplified just once, keeping its
+        end points, so neighbours' outlines still match exactly)
+    """
+    records = [record for chunk in converted for record in chunk]
+    arcs, refs = build_arcs([part for id, bbox, parts in records
+                             for part in parts])
+    logging.info('%d rings broken into %d arcs', len(refs), len(arcs))
+    chunk = []
+    first = 0
+    for id, bbox, parts in records:
+      parts_refs = refs[first:first+len(parts)]
+      first += len(parts)
+      data = _member(self.idnum_by_idvalue[id], bbox,
+                     numpy.array([len(r) for r in parts_refs], '<u4'),
+                     numpy.array([r for rs in parts_refs for r in rs], '<i4'))
+      if compress: data = (len(data),) + _deflate(data)
+      chunk.append((id, bbox, [data]))
+
+    arcs_lengths = numpy.array([len(arc) for arc in arcs], '<u4')
+    arcs_data = numpy.concatenate(arcs)
+    xs, ys = arcs_data[0::2], arcs_data[1::2]
+    arcs_bbox = [int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max())]
+    arcs_members = [_member(0, arcs_bbox, arcs_lengths, arcs_data,
+                            self.quantum)]
+    for tolerance in tolerances:
+      lod_lengths, lod_data = _simplify(arcs_lengths, arcs_data, tolerance)
+      arcs_members.append(_member(0, arcs_bbox, lod_lengths, lod_data,
+                                  self.quantum))
+    return [chunk], arcs_bbox, arcs_members
+
 
 def setlogging(level=logging.DEBUG):
   """ Set logging config and level (to INFO, default, or DEBUG). """
@@ -209,34 +1049,340 @@ class PolyReader(object):
   """ Read a Polyfile conveniently (by iteration). """
   # class-overridable data and methods
   infile = 'cont_us_state.ply'
+  # zoom level the records will be drawn at (None: draw at full detail)
+  zoom = None
+  # if not None, read only records whose bboxes intersect this one (meters)
+  select_bbox = None
 
   def __init__(self, **kwds):
-    self.__dict__.update(kwds)
     """ Open the Polyfile, read and prepare preliminary data """
-    self.zip = zipfile.ZipFile(self.infile, 'r')
+    self.__dict__.update(kwds)
+    with open(self.infile, 'rb') as f:
+      if f.read(len(MAGIC2)) == MAGIC2:
+        self.version = 2
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      else:
+        self.version = 1
+    if self.version == 2:
+      header = _header2.unpack_from(self._map)
+      magic, self._num_records, num_lods, ids_len, self.quantum = header[:5]
+      self._bbox = header[5:9]
+      self._dir_at = header[9]
+      self._arcs_at = header[11]
+      self.topology = bool(self._arcs_at)
+      names_and_nums = self._map[_header2.size:_header2.size+ids_len]
+      lods_at = _align8(_header2.size + ids_len)
+      lods = [_lod2.unpack_from(self._map, lods_at + i*_lod2.size)
+              for i in range(num_lods)]
+      self.lod_zooms = [zoom for zoom, tolerance in lods]
+      self.lod_tolerances = [tolerance for zoom, tolerance in lods]
+      # the fingerprints, if any, fill the room before the directory
+      fingerprints_at = _align8(lods_at + num_lods*_lod2.size)
+      if self._dir_at - fingerprints_at >= 20*self._num_records > 0:
+        self.fingerprints = [self._map[fingerprints_at+20*i:
+                                       fingerprints_at+20*i+20]
+                             for i in range(self._num_records)]
+      else:
+        self.fingerprints = None
+    else:
+      self.zip = zipfile.ZipFile(self.infile, 'r')
+      names_and_nums = self.zip.read('ids.txt')
+      # zooms of the levels of detail (if any), in increasing order
+      try: lods = self.zip.read('lods.txt').splitlines()
+      except KeyError: lods = []
+      self.lod_zooms = [int(line.split()[0]) for line in lods]
+      self.lod_tolerances = [float(line.split()[1]) for line in lods]
+      try: self.quantum = int(self.zip.read('quantum.txt'))
+      except KeyError: self.quantum = 0
+      self.topology = 'arcs.bin' in self.zip.namelist()
+    if self.quantum and numpy is None:
+      raise ImportError, 'Reading delta-encoded Polyfiles needs numpy'
+    if self.topology and numpy is None:
+      raise ImportError, 'Reading Polyfiles with topology needs numpy'
+    # the arcs (if topology) at each level of detail read so far, by level
+    self._arcs = dict()
+    self._rtree = None
     self._closed = False
-    names_and_nums = self.zip.read('ids.txt').splitlines()
     self.name_by_num = dict()
-    for line in names_and_nums:
+    for line in names_and_nums.splitlines():
       name, num = line.split()
       self.name_by_num[int(num)] = name
-    self.filenames = [s for s in self.zip.namelist() if s.endswith('.pol')]
+    if self.version == 2:
+      self.filenames = ['%s_%d.pol' % (self.name_by_num[self._entry(0, i)[2]],
+                                       i) for i in range(self._num_records)]
+    else:
+      self.filenames = [s for s in self.zip.namelist()
+                        if s.endswith('.pol') and '/' not in s]
+      try: filedata = self.zip.read('fingerprints.bin')
+      except KeyError: self.fingerprints = None
+      else:
+        self.fingerprints = [filedata[i:i+20]
+                             for i in range(0, len(filedata), 20)]
+
+  def _entry(self, level, i):
+    """ Get the directory entry of a Polyfile v2 for the i-th record at a level
+    of detail (0 for full detail): offset, size, idnum, bbox (4 ints)
+    """
+    return _entry2.unpack_from(self._map, self._dir_at +
+        _entry2.size * (level*self._num_records + i))
+
+  def _lod_level(self, zoom):
+    """ Get the level of detail to draw at a zoom level (None: full detail)
+
+    Returns:
+      0 for the full detail records, else i+1 for the coarsest level of detail
+        that's good for zoom, self.lod_zooms[i]
+    """
+    if zoom is None: return 0
+    for i, lod_zoom in enumerate(self.lod_zooms):
+      if lod_zoom >= zoom: return i + 1
+    return 0
+
+  def lod_prefix(self, zoom):
+    """ Get the prefix of members with enough detail to draw at a zoom level.
+
+    Args:
+      zoom: the zoom level (None means full detail)
+    Returns:
+      '' for the full detail records, else 'z<lodzoom>/' for the coarsest
+        level of detail that's good for zoom
+    """
+    level = self._lod_level(zoom)
+    if not level: return ''
+    return 'z%d/' % self.lod_zooms[level-1]
+
+  def set_select_tiles(self, tiles_range, zoom, margin=1.0):
+    """ Select for reading only the records that may be drawn on some tiles.
+
+    Args:
+      tiles_range: tuple mintx, minty, maxtx, maxty (TMS tile coordinates)
+      zoom: zoom level of the tiles
+      margin: also select records within this many pixels of the tiles (the
+        default, 1.0, allows for the rounding done in drawing the outlines)
+    Side Effects:
+      sets self.select_bbox to the tiles' bounding box, widened by margin
+    """
+    mintx, minty, maxtx, maxty = tiles_range
+    pad = margin * m.Resolution(zoom)
+    minx, miny = m.TileBounds(mintx, minty, zoom)[:2]
+    maxx, maxy = m.TileBounds(maxtx, maxty, zoom)[2:]
+    self.select_bbox = minx - pad, miny - pad, maxx + pad, maxy + pad
+
+  def get_bboxes(self):
+    """ Get the bounding boxes of all records, in order.
+
+    Returns:
+      list with a tuple of 4 ints (meters) per record, minx, miny, maxx, maxy,
+        or None if the Polyfile lacks them (i.e., a Polyfile v1 with no
+        bboxes.bin member)
+    """
+    if self.version == 2:
+      return [self._entry(0, i)[3:] for i in range(self._num_records)]
+    try: filedata = self.zip.read('bboxes.bin')
+    except KeyError: return None
+    ints = array.array('i')
+    ints.fromstring(filedata)
+    normalize_arrays(ints)
+    return [tuple(ints[i:i+4]) for i in range(0, len(ints), 4)]
+
+  def _get_rtree(self):
+    """ Get the spindex.PackedRTree of the records' bboxes, or None if the
+    Polyfile lacks them (i.e., a Polyfile v1 with no bboxes.bin member)
+    """
+    if self._rtree is None:
+      bboxes = self.get_bboxes()
+      if bboxes is None: return None
+      self._rtree = spindex.PackedRTree(spindex.pack(bboxes))
+    return self._rtree
+
+  def _record_data(self, level, i):
+    """ Get the i-th record's data at a level of detail (0 for full detail):
+    str data, offset of the record's data in it, length of it
+    """
+    if self.version == 2:
+      offset, size = self._entry(level, i)[:2]
+      return self._map, offset, size
+    # with topology, records' members serve at all levels of detail
+    if level and not self.topology:
+      name = 'z%d/%s' % (self.lod_zooms[level-1], self.filenames[i])
+    else:
+      name = self.filenames[i]
+    filedata = self.zip.read(name)
+    return filedata, 0, len(filedata)
+
+  def _members(self, zoom, select_bbox=None):
+    """ Iterate on records' data at the detail needed for a zoom level,
+    yielding str data, offset of the record's data in it, length of it
+    (only for records whose bboxes intersect select_bbox, if not None)
+    """
+    rtree = None
+    if select_bbox is None: selected = range(len(self.filenames))
+    else:
+      rtree = self._get_rtree()
+      if rtree is None: selected = range(len(self.filenames))
+      else: selected = rtree.search(select_bbox)
+    level = self._lod_level(zoom)
+    for i in selected:
+      data, offset, size = self._record_data(level, i)
+      if select_bbox is not None and rtree is None:
+        # no bboxes table: check the bbox in the record's own data instead
+        xmin, ymin, xmax, ymax = select_bbox
+        bx0, by0, bx1, by1 = struct.unpack_from('<4i', data, offset + 12)
+        if bx0 > xmax or bx1 < xmin or by0 > ymax or by1 < ymin: continue
+      yield data, offset, size
 
   def __iter__(self):
-    """ Offer by-record iteration on the Polyfile (via a generator) """
+    """ Offer by-record iteration on the Polyfile (at detail for self.zoom,
+    and only on records intersecting self.select_bbox, if not None)
+    """
+    return self._records(self.zoom, self.select_bbox)
+
+  def iter_arrays(self):
+    """ Iterate on the Polyfile's records (at detail for self.zoom) as arrays.
+
+    Like iterating on self, but starts, lengths, meters (and bbox) are each a
+    read-only numpy array, for a Polyfile v2 a view on the memory-mapped file
+    (valid only until self is closed), so that no data gets copied -- except
+    for meters in a Polyfile with a quantum, which are decoded (all at once).
+    """
+    if numpy is None:
+      raise ImportError, 'iter_arrays needs numpy'
+    return self._arrays(self.zoom, self.select_bbox)
+
+  def _decode(self, data, offset, size, quantum):
+    """ Get the contents of a record's data as numpy arrays: idnum, bbox,
+    starts, lengths, ints (meters or, if quantum is None, references to arcs)
+    """
+    idnum, numparts, totleng = struct.unpack_from('<III', data, offset)
+    ints = numpy.frombuffer(data, '<i4', 4 + 2*numparts, offset + 12)
+    points_at = offset + 28 + 8*numparts
+    if quantum:
+      meters = decode_varint_deltas(data, totleng, points_at,
+                                    offset + size - points_at)
+      meters *= quantum
+    else:
+      meters = numpy.frombuffer(data, '<i4', totleng, points_at)
+    return (idnum, ints[:4], ints[4:4+numparts].view('<u4'),
+            ints[4+numparts:4+2*numparts].view('<u4'), meters)
+
+  def _get_arcs(self, level):
+    """ Get the arcs of a Polyfile with topology at a level of detail (0 for
+    full detail) as numpy arrays: starts, lengths, meters
+    """
+    if level not in self._arcs:
+      if self.version == 2:
+        offset, size = _entry2.unpack_from(self._map,
+            self._arcs_at + _entry2.size*level)[:2]
+        data = self._map
+      else:
+        if level: prefix = 'z%d/' % self.lod_zooms[level-1]
+        else: prefix = ''
+        data = self.zip.read(prefix + 'arcs.bin')
+        offset, size = 0, len(data)
+      self._arcs[level] = self._decode(data, offset, size, self.quantum)[2:]
+    return self._arcs[level]
+
+  def _resolve(self, level, lengths, refs):
+    """ Get the points of a record of a Polyfile with topology, from its
+    references to arcs (and numbers of them per part), as numpy arrays:
+    starts, lengths, meters (arcs joined at their shared end points)
+    """
+    arcs_starts, arcs_lengths, arcs_meters = self._get_arcs(level)
+    refs = numpy.asarray(refs, int)
+    reverse = refs < 0
+    arcs = numpy.where(reverse, ~refs, refs)
+    firsts = arcs_starts[arcs] // 2
+    sizes = (arcs_lengths[arcs] // 2).astype(int)
+    # each arc but the first of its part skips its first point (the last one
+    # of the arc before it)
+    skips = numpy.ones(len(refs), int)
+    skips[numpy.cumsum(lengths) - lengths] = 0
+    counts = sizes - skips
+    # index within its arc of each point to take, then within all arcs
+    ends = numpy.cumsum(counts)
+    within = numpy.arange(ends[-1] if len(ends) else 0)
+    within += numpy.repeat(skips - ends + counts, counts)
+    within = numpy.where(numpy.repeat(reverse, counts),
+                         numpy.repeat(sizes - 1, counts) - within, within)
+    points = arcs_meters.reshape(-1, 2)[numpy.repeat(firsts, counts) + within]
+    # each part ends after the last point of its last arc
+    parts_ends = ends[numpy.cumsum(lengths) - 1]
+    parts_lengths = 2 * numpy.diff(numpy.append(0, parts_ends))
+    parts_starts = 2 * numpy.append(0, parts_ends[:-1])
+    return parts_starts, parts_lengths, points.ravel()
+
+  def _arrays(self, zoom, select_bbox=None):
+    """ Iterate on records at the level of detail needed for a zoom level as
+    numpy arrays (only on records intersecting select_bbox, if not None)
+    """
+    level = self._lod_level(zoom)
+    for data, offset, size in self._members(zoom, select_bbox):
+      if self.topology:
+        idnum, bbox, starts, lengths, refs = self._decode(data, offset, size,
+                                                          0)
+        starts, lengths, meters = self._resolve(level, lengths, refs)
+      else:
+        idnum, bbox, starts, lengths, meters = self._decode(data, offset, size,
+                                                            self.quantum)
+      yield self.name_by_num[idnum], bbox, starts, lengths, meters
+
+  def iter_arcs(self):
+    """ Iterate on the outlines to draw the Polyfile's records (at detail for
+    self.zoom, and only records intersecting self.select_bbox, if not None).
+
+    For a Polyfile with topology, yields each arc (that some of the records
+    have) just once, else each part of each of the records; either way, as a
+    list of int meters, x, y, x, y, ...
+    """
+    return self._iter_arcs(self.zoom, self.select_bbox)
+
+  def _iter_arcs(self, zoom, select_bbox=None):
+    """ Iterate on the arcs of records at the detail needed for a zoom level
+    (of records intersecting select_bbox, if not None), see iter_arcs
+    """
+    if not self.topology:
+      for name, bbox, starts, lengths, meters in self._records(zoom,
+                                                               select_bbox):
+        for s, l in zip(starts, lengths): yield meters[s:s+l]
+      return
+    starts, lengths, meters = self._get_arcs(self._lod_level(zoom))
+    if select_bbox is None: arcs = range(len(starts))
+    else:
+      refs = [self._decode(data, offset, size, 0)[4]
+              for data, offset, size in self._members(zoom, select_bbox)]
+      if not refs: return
+      refs = numpy.concatenate(refs)
+      arcs = numpy.unique(numpy.where(refs < 0, ~refs, refs)).tolist()
+    for i in arcs:
+      yield meters[starts[i]:starts[i]+lengths[i]].tolist()
+
+  def _records(self, zoom, select_bbox=None):
+    """ Iterate on records at the level of detail needed for a zoom level
+    (only on records intersecting select_bbox, if not None)
+    """
     def prg():
       """ Iterate on self, yielding tuples w/name and lists of numbers. """
-      for name in self.filenames:
-        filedata = self.zip.read(name)
+      if self.topology:
+        for record in self._arrays(zoom, select_bbox):
+          yield (record[0],) + tuple(a.tolist() for a in record[1:])
+        return
+      for data, offset, size in self._members(zoom, select_bbox):
+        filedata = data[offset:offset+size]
         idnum, numparts, totleng = struct.unpack('<III', filedata[:12])
-        bbox = array.array('l')
+        bbox = array.array('i')
         bbox.fromstring(filedata[12:28])
-        starts = array.array('L')
+        starts = array.array('I')
         starts.fromstring(filedata[28:28+4*numparts])
-        lengths = array.array('L')
+        lengths = array.array('I')
         lengths.fromstring(filedata[28+4*numparts:28+8*numparts])
-        meters = array.array('l')
-        meters.fromstring(filedata[28+8*numparts:28+8*numparts+4*totleng])
+        if self.quantum:
+          meters = decode_varint_deltas(filedata, totleng, 28+8*numparts)
+          meters = (meters * self.quantum).tolist()
+        else:
+          meters = array.array('i')
+          meters.fromstring(filedata[28+8*numparts:28+8*numparts+4*totleng])
+          normalize_arrays(meters)
+        normalize_arrays(bbox, starts, lengths)
         yield (self.name_by_num[idnum], list(bbox),
                list(starts), list(lengths), list(meters))
     return prg()
@@ -244,14 +1390,19 @@ class PolyReader(object):
   def close(self):
     """ Close the open file (noop if called more than once). """
     if self._closed: return
-    self.zip.close()
+    if self.version == 2: self._map.close()
+    else: self.zip.close()
     self._closed = True
 
   def get_tiles_ranges(self, zoom):
     """ Get tile ranges needed to paint this Polyfile at given zoom level """
-    bb = array.array('l')
-    filedata = self.zip.read('bbox.bin')
-    bb.fromstring(filedata)
+    if self.version == 2:
+      bb = self._bbox
+    else:
+      bb = array.array('i')
+      filedata = self.zip.read('bbox.bin')
+      bb.fromstring(filedata)
+      normalize_arrays(bb)
     logging.debug('BB: %s', list(bb))
     minpx, minpy = m.MetersToPixels(bb[0], bb[1], zoom) 
     maxpx, maxpy = m.MetersToPixels(bb[2], bb[3], zoom) 
@@ -260,6 +1411,23 @@ class PolyReader(object):
     mintx, minty = m.MetersToTile(bb[0], bb[1], zoom) 
     maxtx, maxty = m.MetersToTile(bb[2], bb[3], zoom) 
     return mintx, minty, maxtx, maxty
+
+  def get_tiles_cover(self, zoom, margin=1.0):
+    """ Get the set of (TMS) tiles the outlines in this Polyfile touch.
+
+    All records are considered, whatever self.select_bbox.
+
+    Args:
+      zoom: zoom level of the tiles
+      margin: also get tiles within this many pixels of an outline (the
+        default, 1.0, allows for the rounding done in drawing the outlines)
+    Returns:
+      set of (tx, ty) tuples, the tiles that will have content at zoom
+    """
+    cover = set()
+    for meters in self._iter_arcs(zoom):
+      m.MetersTilesCover(meters, zoom, margin, cover)
+    return cover
  
 
 if __name__ == '__main__':
@@ -267,10 +1435,10 @@ if __name__ == '__main__':
   def main():
     """ Example running of Converter and reader on US state boundaries """
     setlogging()
-    c = Converter()
+    c = Converter(lod_zooms=(4, 6, 8, 10, 12))
     c.doit()
-    r = PolyReader()
-    bb = r.get_tiles_ranges()
+    r = PolyReader(zoom=3)
+    bb = r.get_tiles_ranges(r.zoom)
     print 'zoom %s: tiles %s' % (r.zoom, bb)
 
   main()
@@ -40,15 +40,28 @@ import array
 import collections
 import contextlib
 import doctest
+import mmap
 import struct
 import sys
 import dbfUtils
+import spindex
+try: import numpy
+except ImportError: numpy = None
 
 
 # determine the endianness of the machine we're running on
 big_endian = struct.unpack('>i', struct.pack('=i', 23)) == (23,)
 # print 'Machine is', ('little', 'big')[big_endian], 'endian'
 
+# precompiled layouts of a record's header and of the start of its contents
+_rec_header = struct.Struct('>LL')
+_rec_type_bbox = struct.Struct('<i4d')
+_rec_counts = struct.Struct('<II')
+
+# result of Shp.read_columns: the geometry of many records in a few arrays
+Columns = collections.namedtuple('Columns',
+    'recnos ids coords record_offsets part_offsets ring_offsets')
+
 
 def dobox(sw, ne, magnify=1.0):
   """ Get xmin/ymin/xmax/ymax bounding box for given SW/NE + magnify-factor.
@@ -207,6 +220,111 @@ def read_one(fp, typecode):
   return read_some(fp, typecode, 1)[0]
 
 
+def as_doubles(part):
+  """ Get an array.array of doubles for a data part of any kind.
+
+  Data parts come as array.array's of doubles from a file-reading Shp, but as
+  zero-copy buffers (raw little-endian bytes) from a memory-mapped Shp; this
+  function gives an array.array of doubles in either case.
+
+  >>> list(as_doubles(buffer(struct.pack('<ddd', 2.5, 4.5, 6.5), 8)))
+  [4.5, 6.5]
+  >>> a = array.array('d', [1.5])
+  >>> as_doubles(a) is a
+  True
+  >>>
+
+  Args:
+    part: array.array of doubles, or buffer/str of little-endian doubles
+  Returns:
+    array.array of doubles (part itself, if it already is one)
+  """
+  if isinstance(part, array.array): return part
+  data = array.array('d')
+  data.fromstring(part)
+  if big_endian: data.byteswap()
+  return data
+
+
+def _decode_data(buf, pos, datalen, data, copy):
+  """ Decode the data of a record from a buffer (str, buffer or mmap).
+
+  Args:
+    buf: the buffer holding the record
+    pos: offset in buf of the record's number of parts (just after its bbox)
+    datalen: bool, should result include the tot len of data?
+    data: bool, should result include the record data?
+    copy: bool, should each part be an array.array (else, a buffer on buf)?
+  Returns:
+    list with the requested info, as get_next_record would give
+  """
+  result = []
+  numparts, numpoints = _rec_counts.unpack_from(buf, pos)
+  pos += _rec_counts.size
+  if datalen: result.append(numpoints)
+  if data:
+    parts_begin = struct.unpack_from('<%di' % numparts, buf, pos)
+    pos += 4*numparts
+    # each part is 16 bytes per point
+    for th, nx in zip(parts_begin, parts_begin[1:]+(numpoints,)):
+      part = buffer(buf, pos+16*th, 16*(nx-th))
+      if copy: part = as_doubles(part)
+      result.append(part)
+  return result
+
+
+def _next_mapped(reader, shp, themap, id, recno, bbox, datalen, data):
+  """ Memory-mapped version of Shp.get_next_record.
+
+  Args:
+    reader: the Shp or ShpCursor whose reading position is to be used
+    shp: the Shp whose indexes are to be used
+    themap: mapping of the .SHP file
+    id, recno, bbox, datalen, data: as for Shp.get_next_record
+  Returns:
+    as Shp.get_next_record
+  """
+  pos = reader._pos
+  maxpos = len(themap) - _rec_header.size
+  hits = reader._hits
+  while True:
+    if hits is not None:
+      # visit only records the spatial index selected
+      if not hits: break
+      pos = hits.popleft()
+    elif pos > maxpos: break
+    the_recno, reclen_words = _rec_header.unpack_from(themap, pos)
+    pos += _rec_header.size
+    endrec = pos + 2*reclen_words
+    the_id = shp.get_id(the_recno)
+    if the_id is None:
+      pos = endrec
+      continue
+    elif the_id is False:
+      msg = 'Internal error at rec %r: no id?' % the_recno
+      raise SyntaxError, msg
+    type_and_bbox = _rec_type_bbox.unpack_from(themap, pos)
+    assert type_and_bbox[0] in (3, 5)
+    the_bbox = type_and_bbox[1:]
+    if reader.all_out(the_bbox):
+      pos = endrec
+      continue
+    # record OK, prepare and return result
+    reader._pos = endrec
+    reader._last_read_id = the_id
+    reader._last_read_recno = the_recno
+    result = []
+    if id: result.append(the_id)
+    if recno: result.append(the_recno)
+    if bbox: result.append(the_bbox)
+    if data or datalen:
+      result.extend(_decode_data(themap, pos + _rec_type_bbox.size,
+                                 datalen, data, False))
+    return result
+  reader._pos = pos
+  return None
+
+
 class Shp(object):
 
   def get_id(self, record_number):
@@ -219,11 +337,19 @@ class Shp(object):
       None if the given record's ID does not satisfy the check
       otherwise, str with the ID attribute for the record
     """
-    try: id = self._db[record_number-1]
-    except IndexError: return False
+    if not 1 <= record_number <= self._numids: return False
+    id = self._id_of(record_number)
     if not self._id_check(id): return None
     return id
 
+  def _id_of(self, record_number):
+    """ Get the (unchecked) ID attribute for an existing record number. """
+    end = record_number * self._idsize
+    id = self._ids[end-self._idsize:end]
+    if self._id_type not in 'CM':
+      id = dbfUtils.convert(self._id_type, self._id_deci, id)
+    return id
+
   def all_out(self, bb, cb=None):
     """ Check if a bounding box is entirely outside the select-bbox (if any)
 
@@ -248,13 +374,25 @@ class Shp(object):
           showbb(self.overall_bbox), showbb(select_bbox))
       raise StopIteration, msg
     self._select_bbox = select_bbox
+    # records the spatial index selected for the old select-bbox don't do for
+    # the new one: read on sequentially from here (until rewind)
+    self._hits = None
 
   def __init__(self, filename, select_bbox=None,
-      id_field_name='ZTCA5CE00', id_check=str.isdigit):
+      id_field_name='ZTCA5CE00', id_check=str.isdigit, use_mmap=False,
+      index_sidecar=True, write_shx=False):
     """ Collect relevant info from .SHP, .DBF and .SHX files in the shapefile.
 
-    Keeps the .SHP file open, but the info from the .DBF (and .SHX, if present)
-    is kept in memory instead.
+    Keeps the .SHP file open, but the info from the .DBF and .SHX is kept in
+    memory instead.  If the .SHX file is missing, the same info (the offset
+    and length of each record) is synthesized by one pass over the .SHP file,
+    reading just the 8-bytes header of each record (and, if write_shx is
+    true, it's also saved as a .SHX file, so later runs can just load it).
+
+    With use_mmap true, the .SHP file is memory-mapped instead: record headers
+    are decoded straight from the mapping, and each part of a record's data
+    comes back as a zero-copy buffer into the mapping (raw little-endian
+    doubles -- see function as_doubles) rather than as a new array.array.
 
     Args:
       filename: path to the .shp file, including the extension
@@ -263,8 +401,15 @@ class Shp(object):
       id_field_name: the name of the DBF attribute that's the primary ID
         (duplicates ARE allowed: record-number is the only UNIQUE identifier!)
       id_check: callable with one arg (an id) returning true for "good" ids
+      use_mmap: if true, memory-map the .shp file rather than read() it
+      index_sidecar: if true, the spatial index of records' bboxes (used for
+        iterations with a select-bbox) is kept in a sidecar file with the same
+        dir & basename and extension .rtx, so it's built only once (and again
+        whenever the .shp changes), then just memory-mapped by later runs
+      write_shx: if true, and the .shx file is missing, write one
     Raises:
-      IOError (propagated) for missing .shp or .dbf files
+      IOError (propagated) for missing .shp or .dbf files, or for failing
+              to write the .shx file when write_shx is true
       ValueError if the shape type is anything but 3 or 5 (poly lines/gons), or
                  if the DBF has no attribute with the name given for the ID
       StopIteration if the shapefile's bbox doesn't interest the select one, or
@@ -273,62 +418,119 @@ class Shp(object):
     # get basic shapefile configuration
     self.filename = filename
     fp = self._fp = open(filename, 'rb')
+    if use_mmap:
+      self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+      self._map = None
+    # mapping for cursors (when self._map is None), only made if needed
+    self._cursor_map = None
     fp.seek(32)
     shp_type = read_one(fp, 'i')
     if shp_type not in (3, 5):
       msg = 'SHP file %r shapetype %r, not 3 or 5' % (filename, shp_type)
       raise ValueError, msg
+    self._shp_type = shp_type
     self.overall_bbox = read_doubles(fp, 4)
     self.set_select_bbox(select_bbox)
 
-    # position at first record
-    self.rewind()
-
-    # open dbf file and get records as a list
+    # open dbf file and get the primary-ID field of the records, packing
+    # their raw fixed-width values into one str
     dbf_file = filename[:-4] + '.dbf'
     with open(dbf_file, 'rb') as dbf:
-      dbr = dbfUtils.dbfreader(dbf)
+      dbr = dbfUtils.dbfprojector(dbf, [id_field_name], converting=False)
       field_names = dbr.next()
       field_specs = dbr.next()
-      self._db = list(dbr)
-    # identify index primary-ID field
-    # print>>sys.stderr, 'all fields', field_names
-    for i, field_name in enumerate(field_names):
-      # print 'field:', field_name
-      if field_name == id_field_name: break
-    else:
-      fields = ' '.join(x.strip() for x in field_names)
-      msg = 'DBF file %r has no field named %r' % (dbf_file, id_field_name)
-      msg += '\nAvailable field names are: %s' % fields
-      raise ValueError, msg
-    self._db = [entry[i] for entry in self._db]
+      # print>>sys.stderr, 'all fields', field_names
+      if id_field_name not in field_names:
+        fields = ' '.join(x.strip() for x in field_names)
+        msg = 'DBF file %r has no field named %r' % (dbf_file, id_field_name)
+        msg += '\nAvailable field names are: %s' % fields
+        raise ValueError, msg
+      self._ids = ''.join([entry[0] for entry in dbr])
+    self._id_type, self._idsize, self._id_deci = field_specs[
+        field_names.index(id_field_name)]
+    self._numids = len(self._ids) // self._idsize
     self._id_check = id_check
 
-    # try building an ID -> byte offsets mapping if the .SHX file is present
+    # the record numbers of records with good IDs, sorted by ID (and then
+    # by record number), to look them up by binary search
+    self._recnos_by_id = array.array('i', sorted(
+        (recno for recno in xrange(1, self._numids+1)
+         if self._id_check(self._id_of(recno))), key=self._id_of))
+    self._len = len(self._recnos_by_id)
+
+    # get all records' offsets and lengths (in 2-byte words) from the .SHX
     shx_file = filename[:-4] + '.shx'
     try:
       f = open(shx_file, 'rb')
     except IOError:
-      # survive missing .SHX file (no indexing in this case, though)
-      self._recno_by_id = None
-      self._offset_by_recno = None
-      self._len = sum(1 for id in self._db if self._id_check(id))
+      # survive missing .SHX file by synthesizing its contents
+      self._shx_offsets, self._shx_lengths = self._scan_headers()
+      if write_shx: self._write_shx(shx_file)
     else:
-      self._recno_by_id = collections.defaultdict(list)
-      self._offset_by_recno = {}
       with contextlib.closing(f):
         f.seek(100)
-        shx_offsets_and_lengths = read_ints(f, 2*len(self._db))
+        shx_offsets_and_lengths = read_ints(f, 2*self._numids)
         shx_offsets_and_lengths.byteswap()
-        for recno, (id, offs) in enumerate(
-            zip(self._db, shx_offsets_and_lengths[0::2])):
-          if not self._id_check(id): continue
-          self._recno_by_id[id].append(recno+1)
-          self._offset_by_recno[recno+1] = 2*offs
-        self._len = len(self._offset_by_recno)
+        self._shx_offsets = shx_offsets_and_lengths[0::2]
+        self._shx_lengths = shx_offsets_and_lengths[1::2]
     if not self._len:
       raise StopIteration, "No record ID passes the id-check function"
 
+    # the spatial index over records' bboxes is only built if and when needed
+    self._rtree = None
+    self._index_sidecar = index_sidecar
+    # position at first record
+    self.rewind()
+
+  def _scan_headers(self):
+    """ Get offsets and lengths of all records by reading just their headers.
+
+    Returns:
+      tuple of 2 array.array's, offsets and lengths (in 2-byte words) of the
+      records' contents, just like a .SHX file would hold them
+    """
+    offsets = array.array('i')
+    lengths = array.array('i')
+    if self._map is None:
+      fp = self._fp
+      fp.seek(100)
+      while True:
+        header = fp.read(_rec_header.size)
+        if len(header) < _rec_header.size: break
+        the_recno, reclen_words = _rec_header.unpack(header)
+        offsets.append(fp.tell()//2 - _rec_header.size//2)
+        lengths.append(reclen_words)
+        fp.seek(2*reclen_words, 1)
+    else:
+      themap = self._map
+      pos = 100
+      maxpos = len(themap) - _rec_header.size
+      while pos <= maxpos:
+        the_recno, reclen_words = _rec_header.unpack_from(themap, pos)
+        offsets.append(pos//2)
+        lengths.append(reclen_words)
+        pos += _rec_header.size + 2*reclen_words
+    return offsets, lengths
+
+  def _write_shx(self, shx_file):
+    """ Write a .SHX file with the records' offsets and lengths. """
+    fp = self._fp
+    fp.seek(0)
+    header = fp.read(100)
+    # the .SHX header is the .SHP one, except for the file length (in words)
+    numrecs = len(self._shx_offsets)
+    header = header[:24] + struct.pack('>i', 50 + 4*numrecs) + header[28:]
+    index = array.array('i')
+    for offs, length in zip(self._shx_offsets, self._shx_lengths):
+      index.append(offs)
+      index.append(length)
+    # .SHX offsets and lengths are big-endian
+    if not big_endian: index.byteswap()
+    with open(shx_file, 'wb') as f:
+      f.write(header)
+      index.tofile(f)
+
   def __len__(self):
     """ Returns the number of records with valid IDs. """
     return self._len
@@ -341,25 +543,108 @@ class Shp(object):
   def _seek_to(self, offs):
     """ Seek the SHP file to an offset and reset the last-read variables.
     """
-    self._fp.seek(offs)
+    if self._map is None: self._fp.seek(offs)
+    else: self._pos = offs
     self._last_read_id = None
     self._last_read_recno = None
+    self._hits = None
 
   def rewind(self):
     """ Re-start reading the shapefile from the first record.
+
+    If a select-bbox is set, reading will then visit only the records the
+    spatial index gives as possibly intersecting the select-bbox, rather than
+    scanning every record in the file.
     """
     self._seek_to(100)
+    if self._select_bbox is not None:
+      self._hits = self._hit_offsets(self._select_bbox)
+
+  def _hit_offsets(self, select_bbox):
+    """ Get a deque of offsets of records the spatial index selects. """
+    hits = self._get_rtree().search(select_bbox)
+    return collections.deque(2*self._shx_offsets[i] for i in hits)
+
+  def _shared_map(self):
+    """ Get a read-only mapping of the .SHP file (make it if needed). """
+    if self._map is not None: return self._map
+    if self._cursor_map is None:
+      self._cursor_map = mmap.mmap(self._fp.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+    return self._cursor_map
+
+  def cursor(self, select_bbox=None):
+    """ Get a new, independent reading position on this shapefile.
+
+    Cursors share self's indexes, and read from a memory-mapping of the .SHP
+    file (without ever moving a shared file position), so each thread in a
+    pool can use its own cursor on one open Shp, with no locking.  Building
+    the spatial index is the only work that two cursors might happen to
+    duplicate (harmlessly) if they first need it at the same time.
+
+    Args:
+      select_bbox: if not None, only records intersecting this box matter
+    Returns:
+      a ShpCursor positioned at the first record
+    Raises:
+      StopIteration if the shapefile's bbox doesn't interest the select one
+    """
+    return ShpCursor(self, self._shared_map(), select_bbox)
 
-  def _set_next(self, key, keyname, check, offs_dict):
+  def _get_rtree(self):
+    """ Get the spatial index of all records' bboxes (build it if needed).
+
+    Returns:
+      a spindex.PackedRTree whose item i is the record with number i+1
+    """
+    if self._rtree is not None: return self._rtree
+    rtree = None
+    if self._index_sidecar:
+      sidecar = self.filename[:-4] + '.rtx'
+      stamp = spindex.file_stamp(self.filename)
+      rtree = spindex.load(sidecar, stamp)
+      if rtree is not None and len(rtree) == len(self._shx_offsets):
+        self._rtree = rtree
+        return rtree
+    # each record's bbox follows its 8-bytes header and 4-bytes shapetype;
+    # use a mapping if there is one, since cursors may be building too
+    themap = self._map if self._map is not None else self._cursor_map
+    if themap is None:
+      fp = self._fp
+      where = fp.tell()
+      bboxes = []
+      for offs in self._shx_offsets:
+        fp.seek(2*offs + 12)
+        bboxes.append(read_doubles(fp, 4))
+      fp.seek(where)
+    else:
+      bboxes = [_rec_type_bbox.unpack_from(themap, 2*offs + 8)[1:]
+                for offs in self._shx_offsets]
+    data = spindex.pack(bboxes)
+    if self._index_sidecar:
+      # an unwritable directory just means the index can't persist
+      try: spindex.save(sidecar, stamp, data)
+      except (IOError, OSError): pass
+    rtree = self._rtree = spindex.PackedRTree(data)
+    return rtree
+
+  def _set_next(self, key, keyname, check, offset_of):
     """ Utility method for set_next_... methods """
     if not check(key):
       raise ValueError, 'Invalid %s: %r' % (keyname, key)
-    elif offs_dict is None:
-      raise AttributeError, 'SHX was not present, SHP not indexable'
-    try: offs = offs_dict[key]
+    try: offs = offset_of(key)
     except KeyError: raise KeyError, '%s %r not in index' % (keyname, key)
     else: self._seek_to(offs)
 
+  def _offset_of_recno(self, recno):
+    """ Get the byte offset of a record with a good ID, else raise KeyError """
+    if not self.get_id(recno): raise KeyError, recno
+    return 2*self._shx_offsets[recno-1]
+
+  def _record_size(self, recno):
+    """ Get the total size in bytes (header included) of an indexed record """
+    return _rec_header.size + 2*self._shx_lengths[recno-1]
+
   def recnos_by_id(self, id):
     """ Get the record numbers of all fields with the given ID
 
@@ -369,15 +654,24 @@ class Shp(object):
       list of 1+ record numbers (in sorted order) with the given ID
     Raises:
       ValueError if id doesn't pass the good-id test
-      AttributeError if the SHX file was not present (SHP not indexable)
       KeyError if there is no record with the requested id
     """
     if not self._id_check(id):
       raise ValueError, 'Invalid ID: %r' % id
-    elif self._recno_by_id is None:
-      raise AttributeError, 'SHX was not present, SHP not indexable'
-    try: return self._recno_by_id[id]
-    except KeyError: raise KeyError, 'ID %r not in index' % id
+    # binary search for the first entry in the table with an ID >= id
+    table = self._recnos_by_id
+    id_of = self._id_of
+    lo, hi = 0, len(table)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if id_of(table[mid]) < id: lo = mid + 1
+      else: hi = mid
+    result = []
+    while lo < len(table) and id_of(table[lo]) == id:
+      result.append(table[lo])
+      lo += 1
+    if not result: raise KeyError, 'ID %r not in index' % id
+    return result
 
   def set_next_recno(self, recno):
     """ Seek the SHP file to just before a record with the given record #.
@@ -386,12 +680,11 @@ class Shp(object):
       recno: the SHP record number (1 and up)
     Raises:
       ValueError if recno < 1
-      AttributeError if the SHX file was not present (SHP not indexable)
       KeyError if there is no record with the requested record number
         (record number too high, or record w/that number has bad id)
     """
     self._set_next(recno, 'Record Number', lambda x: x>=1,
-                   self._offset_by_recno)
+                   self._offset_of_recno)
 
   # read-only properties for important internal attributes
   for _at in 'last_read_id last_read_recno select_bbox'.split():
@@ -401,6 +694,8 @@ class Shp(object):
 
   def close(self):
     """ Close the shapefile. """
+    if self._map is not None: self._map.close()
+    if self._cursor_map is not None: self._cursor_map.close()
     self._fp.close()
 
   def get_next_record(self, id=1, recno=0, bbox=0, datalen=0, data=1):
@@ -418,9 +713,16 @@ class Shp(object):
     Returns:
       None if no succeeding record is acceptable, else a list with all
         the requested info; data, if requested, is given as 1+ array.array's
-        of doubles, in long/lat/long/lat/... order.
+        of doubles, in long/lat/long/lat/... order (as 1+ buffers into the
+        mapping, if memory-mapped: see function as_doubles).
     """
+    if self._map is not None:
+      return _next_mapped(self, self, self._map, id, recno, bbox, datalen, data)
     while True:
+      if self._hits is not None:
+        # visit only records the spatial index selected
+        if not self._hits: return None
+        self._fp.seek(self._hits.popleft())
       try: the_recno, reclen_words = read_and_unpack(self._fp, '>LL')
       except struct.error:
         # print 'EOF on', self._fp, 'at offset', self._fp.tell()
@@ -464,12 +766,254 @@ class Shp(object):
       self._fp.seek(endrec)
       return result
 
+  def get_records(self, recnos, fields=('id', 'data'), maxgap=4096,
+                  maxrun=1<<20):
+    """ Get many records, by record number, with few large reads.
+
+    The requested records are sorted by offset in the file, and runs of them
+    that are close together (no more than maxgap bytes apart) are read with
+    one read each (or sliced from the mapping, if memory-mapped), then
+    decoded; a run ends before its span in the file would exceed maxrun
+    bytes (unless it's just one record, larger than that).  The current position of iteration on self is not affected.
+
+    Args:
+      recnos: sequence of record numbers (1 and up) in any order
+      fields: which of 'id', 'recno', 'bbox', 'datalen', 'data' should be in
+        the results (each result has them in just that order, whatever the
+        order in fields, as would be returned by get_next_record)
+      maxgap: max number of bytes between records that are read together
+      maxrun: max number of bytes read at once (but a whole record is)
+    Returns:
+      list of results, one per entry of recnos (in the same order), each a
+        list with the requested info like get_next_record would return
+    Raises:
+      ValueError if fields has some unknown name
+      KeyError if a requested record number is too high or has a bad id
+    """
+    return self._get_records(recnos, fields, maxgap, maxrun, self._map)
+
+  def _get_records(self, recnos, fields, maxgap, maxrun, themap):
+    """ Implement get_records, slicing themap if not None, else reading. """
+    unknown = set(fields).difference('id recno bbox datalen data'.split())
+    if unknown:
+      raise ValueError, 'Unknown fields: %s' % ' '.join(sorted(unknown))
+    want_id, want_recno, want_bbox, want_datalen, want_data = [
+        x in fields for x in 'id recno bbox datalen data'.split()]
+    by_offset = sorted((self._offset_of_recno(recno), recno)
+                       for recno in set(recnos))
+    # coalesce records into runs [first:last] of records to read together
+    runs = []
+    first = 0
+    for i in xrange(len(by_offset)):
+      end = by_offset[i][0] + self._record_size(by_offset[i][1])
+      if (i+1 == len(by_offset) or by_offset[i+1][0] - end > maxgap or
+          by_offset[i+1][0] + self._record_size(by_offset[i+1][1]) -
+          by_offset[first][0] > maxrun):
+        runs.append((first, i, end))
+        first = i+1
+    if themap is None:
+      where = self._fp.tell()
+    results = {}
+    for first, last, end in runs:
+      start = by_offset[first][0]
+      if themap is None:
+        self._fp.seek(start)
+        buf = self._fp.read(end - start)
+        base = start
+      else:
+        buf = themap
+        base = 0
+      for offs, the_recno in by_offset[first:last+1]:
+        pos = offs - base + _rec_header.size
+        result = []
+        if want_id: result.append(self.get_id(the_recno))
+        if want_recno: result.append(the_recno)
+        if want_bbox:
+          result.append(_rec_type_bbox.unpack_from(buf, pos)[1:])
+        if want_datalen or want_data:
+          result.extend(_decode_data(buf, pos + _rec_type_bbox.size,
+                                     want_datalen, want_data, themap is None))
+        results[the_recno] = result
+    if themap is None:
+      self._fp.seek(where)
+    return [results[recno] for recno in recnos]
+
+  def read_columns(self, bbox=None, ids=None):
+    """ Get the geometry of many records at once, as a few NumPy arrays.
+
+    The layout is GeoArrow-like: all points, for all selected records, are in
+    one contiguous array of coordinates, and three arrays of offsets nest them
+    into rings, parts and records.  A "ring" is a part in the shapefile's own
+    sense; for polygons, a "part" is one polygon (an outer, clockwise ring and
+    the holes following it), for polylines it's one line (i.e., one ring).
+    The current position of iteration on self is not affected.
+
+    Args:
+      bbox: if not None, only records whose bbox intersects this one are read
+      ids: if not None, only records with one of these ids are read
+    Returns:
+      a Columns namedtuple, with records in the shapefile's order:
+        recnos: int32 array of the record numbers
+        ids: list of the records' ids
+        coords: float64 array of shape (numpoints, 2), long/lat per point
+        record_offsets: int64 array (numrecords+1) of offsets into parts
+        part_offsets: int64 array (numparts+1) of offsets into rings
+        ring_offsets: int64 array (numrings+1) of offsets into coords
+    Raises:
+      ImportError if NumPy is not available
+      ValueError, KeyError as recnos_by_id, for bad or absent ids
+    """
+    if numpy is None:
+      raise ImportError, 'read_columns needs NumPy'
+    # select the numbers of the records to read, in order
+    if ids is not None:
+      recnos = sorted(set(r for id in ids for r in self.recnos_by_id(id)))
+    elif bbox is not None:
+      recnos = [i+1 for i in self._get_rtree().search(bbox)]
+    else:
+      recnos = xrange(1, len(self._shx_offsets)+1)
+    # read each selected record's points, and the starts of its rings
+    themap = self._map
+    if themap is None:
+      where = self._fp.tell()
+    the_recnos = []
+    the_ids = []
+    blocks = []
+    ring_starts = []
+    rings_per_record = []
+    numcoords = 0
+    for recno in recnos:
+      the_id = self.get_id(recno)
+      if not the_id: continue
+      pos = 2*self._shx_offsets[recno-1] + _rec_header.size
+      if themap is None:
+        self._fp.seek(pos)
+        head = self._fp.read(_rec_type_bbox.size + _rec_counts.size)
+        type_and_bbox = _rec_type_bbox.unpack_from(head)
+        numparts, numpoints = _rec_counts.unpack_from(head,
+                                                      _rec_type_bbox.size)
+      else:
+        type_and_bbox = _rec_type_bbox.unpack_from(themap, pos)
+        numparts, numpoints = _rec_counts.unpack_from(themap,
+                                                      pos+_rec_type_bbox.size)
+      if bbox is not None and self.all_out(type_and_bbox[1:], bbox): continue
+      pos += _rec_type_bbox.size + _rec_counts.size
+      if themap is None:
+        data = self._fp.read(4*numparts + 16*numpoints)
+      else:
+        data = buffer(themap, pos, 4*numparts + 16*numpoints)
+      parts_begin = numpy.frombuffer(data, '<i4', numparts)
+      ring_starts.append(parts_begin + numcoords)
+      blocks.append(numpy.frombuffer(data, '<f8', 2*numpoints, 4*numparts))
+      rings_per_record.append(numparts)
+      numcoords += numpoints
+      the_recnos.append(recno)
+      the_ids.append(the_id)
+    if themap is None:
+      self._fp.seek(where)
+    coords = numpy.concatenate(blocks or [numpy.zeros(0)])
+    coords = coords.astype(numpy.float64, copy=False).reshape(-1, 2)
+    ring_offsets = numpy.concatenate(ring_starts + [[numcoords]])
+    ring_offsets = ring_offsets.astype(numpy.int64)
+    record_rings = numpy.zeros(len(rings_per_record)+1, numpy.int64)
+    numpy.cumsum(rings_per_record, out=record_rings[1:])
+    # a part starts with each record's first ring, and for polygons also with
+    # each outer ring: clockwise, i.e., with a negative signed area
+    starts_part = numpy.zeros(len(ring_offsets)-1, bool)
+    starts_part[record_rings[:-1][record_rings[:-1] < len(starts_part)]] = True
+    if self._shp_type == 3:
+      starts_part[:] = True
+    elif len(coords):
+      # each ring's own sum of cross-products of its points, taken relative
+      # to its first point, so that small rings far from (0, 0) keep their
+      # sign (cross-products of lon/lat would mostly cancel out)
+      firsts = numpy.minimum(ring_offsets[:-1], len(coords)-1)
+      sizes = numpy.diff(ring_offsets)
+      rel = coords - numpy.repeat(coords[firsts], sizes, axis=0)
+      x, y = rel[:, 0], rel[:, 1]
+      terms = numpy.zeros(len(coords))
+      terms[:-1] = x[:-1]*y[1:] - x[1:]*y[:-1]
+      # no cross-product from the last point of a ring to the next ring's
+      terms[ring_offsets[1:][sizes > 0] - 1] = 0
+      area2 = numpy.add.reduceat(terms, firsts)
+      area2[sizes == 0] = 0
+      starts_part |= area2 < 0
+    part_rings = numpy.flatnonzero(starts_part)
+    part_offsets = numpy.append(part_rings, len(starts_part))
+    record_offsets = numpy.searchsorted(part_rings, record_rings)
+    return Columns(numpy.array(the_recnos, numpy.int32), the_ids, coords,
+                   record_offsets.astype(numpy.int64),
+                   part_offsets.astype(numpy.int64), ring_offsets)
+
   def next(self):
     result = self.get_next_record()
     if result is None: raise StopIteration
     else: return result
 
 
+class ShpCursor(object):
+  """ An independent reading position on a Shp (see method Shp.cursor).
+
+  A cursor reads just like a Shp does (methods rewind, set_next_recno,
+  get_next_record, get_records, iteration, and the read-only properties),
+  always from the memory-mapping of the file, so that different cursors on
+  the same Shp, each used by a single thread, never interfere.
+  """
+
+  def __init__(self, shp, themap, select_bbox=None):
+    self._shp = shp
+    self._map = themap
+    self.filename = shp.filename
+    self.overall_bbox = shp.overall_bbox
+    self.set_select_bbox(select_bbox)
+    self.rewind()
+
+  # the same reading logic as Shp's, just on different state
+  all_out = Shp.__dict__['all_out']
+  set_select_bbox = Shp.__dict__['set_select_bbox']
+  __iter__ = Shp.__dict__['__iter__']
+  next = Shp.__dict__['next']
+  last_read_id = Shp.last_read_id
+  last_read_recno = Shp.last_read_recno
+  select_bbox = Shp.select_bbox
+
+  def __len__(self):
+    """ Returns the number of records with valid IDs. """
+    return len(self._shp)
+
+  def _seek_to(self, offs):
+    """ Move to an offset and reset the last-read variables. """
+    self._pos = offs
+    self._last_read_id = None
+    self._last_read_recno = None
+    self._hits = None
+
+  def rewind(self):
+    """ Re-start reading the shapefile from the first record. """
+    self._seek_to(100)
+    if self._select_bbox is not None:
+      self._hits = self._shp._hit_offsets(self._select_bbox)
+
+  def set_next_recno(self, recno):
+    """ Move to just before a record with the given record # (as Shp's). """
+    if not recno >= 1:
+      raise ValueError, 'Invalid Record Number: %r' % recno
+    try: offs = self._shp._offset_of_recno(recno)
+    except KeyError: raise KeyError, 'Record Number %r not in index' % recno
+    else: self._seek_to(offs)
+
+  def get_next_record(self, id=1, recno=0, bbox=0, datalen=0, data=1):
+    """ Get the next acceptable record (as Shp's, data being buffers). """
+    return _next_mapped(self, self._shp, self._map, id, recno, bbox, datalen,
+                        data)
+
+  def get_records(self, recnos, fields=('id', 'data'), maxgap=4096,
+                  maxrun=1<<20):
+    """ Get many records by record number (as Shp's, data being buffers). """
+    return self._shp._get_records(recnos, fields, maxgap, maxrun,
+                                  self._map)
+
+
 def _test():
     numfailures, numtests = doctest.testmod()
     if numfailures == 0:
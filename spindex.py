@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+""" Packed R-trees: static spatial indices over many bounding boxes.
+
+Copyright (C) 2008 Alex Martelli, aleaxit@gmail.com
+Licensed under Apache License 2.0, http://www.apache.org/licenses/LICENSE-2.0
+
+A packed R-tree is bulk-loaded once from a sequence of bounding boxes (using
+the Sort-Tile-Recursive, STR, ordering for its leaves) and never changes
+afterwards; in exchange, it's compact, fast to build, and fast to query: a
+search costs time logarithmic in the number of boxes, plus the number of hits.
+
+The tree lives in one flat str of little-endian data, and is queried in place
+(never deserialized into Python objects), so the same code also serves for a
+tree that's in a memory-mapped file (see functions save and load, which deal
+with such "sidecar" files, kept next to the data file they index and stamped
+with its size and modification time so a stale index is never used).  The
+layout of the data is:
+  header: 8-bytes magic string, then 4 unsigned ints: node_size, num_items,
+    num_nodes, num_levels; then 8 bytes of padding (32 bytes in all)
+  level bounds: num_levels unsigned ints, the end (exclusive) node-position of
+    each level, padded to a multiple of 8 bytes
+  boxes: num_nodes bounding boxes, each 4 doubles (xmin, ymin, xmax, ymax)
+  indices: num_nodes unsigned ints
+Level 0 has one node per item (in STR order, with its index being the item's
+number); each node in higher levels encloses up to node_size consecutive nodes
+of the level below (with its index being the position of the first of them).
+The last node is the root.  All bounding boxes are 4 numbers in order: xmin,
+ymin, xmax, ymax, just like in module shpextract.
+"""
+from __future__ import with_statement
+
+import array
+import doctest
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+MAGIC = 'GEPYRTR1'
+_header = struct.Struct('<8sIIII8x')
+_box = struct.Struct('<4d')
+# a sidecar file starts with magic, source file's size and mtime, padding
+SIDECAR_MAGIC = 'GEPYRTX1'
+_sidecar_header = struct.Struct('<8sQd8x')
+
+
+def _tostring(typecode, items):
+  """ Get the little-endian str encoding of items as an array of typecode. """
+  data = array.array(typecode, items)
+  if sys.byteorder == 'big': data.byteswap()
+  return data.tostring()
+
+
+def pack(bboxes, node_size=16):
+  """ Bulk-load a packed R-tree, returning the str that encodes it.
+
+  >>> t = PackedRTree(pack([(0, 0, 1, 1), (2, 2, 3, 3), (0, 2, 1, 3)]))
+  >>> len(t)
+  3
+  >>> t.search((0.5, 0.5, 2.5, 2.5))
+  [0, 1, 2]
+  >>> t.search((1.5, 0, 3, 1.5))
+  []
+  >>>
+
+  Args:
+    bboxes: sequence of bounding boxes (xmin, ymin, xmax, ymax), the items
+    node_size: max number of children for each node of the tree (2 and up)
+  Returns:
+    str with the encoding of the tree (see module docstring)
+  """
+  assert node_size >= 2
+  n = len(bboxes)
+  # STR: sort items by x-center, cut in vertical slices, sort each by y-center
+  order = sorted(xrange(n), key=lambda i: bboxes[i][0] + bboxes[i][2])
+  leaves = int(math.ceil(n / float(node_size)))
+  slice_size = node_size * max(1, int(math.ceil(math.sqrt(leaves))))
+  for start in xrange(0, n, slice_size):
+    order[start:start+slice_size] = sorted(order[start:start+slice_size],
+        key=lambda i: bboxes[i][1] + bboxes[i][3])
+  boxes = [tuple(bboxes[i]) for i in order]
+  indices = order
+  level_bounds = [n]
+  # each higher level groups node_size consecutive nodes from the level below
+  level_start = 0
+  while level_bounds[-1] - level_start > 1:
+    level_end = level_bounds[-1]
+    for first in xrange(level_start, level_end, node_size):
+      children = boxes[first:min(first+node_size, level_end)]
+      boxes.append((min(b[0] for b in children), min(b[1] for b in children),
+                    max(b[2] for b in children), max(b[3] for b in children)))
+      indices.append(first)
+    level_start = level_end
+    level_bounds.append(len(boxes))
+  num_levels = len(level_bounds) if n else 0
+  if num_levels % 2: level_bounds.append(0)
+  return ''.join((
+      _header.pack(MAGIC, node_size, n, len(boxes), num_levels),
+      _tostring('I', level_bounds[:num_levels + num_levels%2]),
+      _tostring('d', [x for b in boxes for x in b]),
+      _tostring('I', indices)))
+
+
+class PackedRTree(object):
+  """ A packed R-tree, queried in place on its str (or mmap) encoding. """
+
+  def __init__(self, data, offset=0):
+    """ Check the header of the encoded tree and locate its sections.
+
+    Args:
+      data: str, buffer or mmap holding the encoding made by function pack
+      offset: byte offset at which the encoding starts within data
+    Raises:
+      ValueError if data does not hold a packed R-tree at offset
+    """
+    if len(data) < offset + _header.size or (
+        data[offset:offset+len(MAGIC)] != MAGIC):
+      raise ValueError, 'No packed R-tree at offset %d' % offset
+    fields = _header.unpack_from(data, offset)
+    magic, self.node_size, self._len, self._num_nodes, num_levels = fields
+    self._data = data
+    bounds_at = offset + _header.size
+    self._level_bounds = struct.unpack_from('<%dI' % num_levels, data,
+                                            bounds_at)
+    self._boxes_at = bounds_at + 4 * (num_levels + num_levels%2)
+    self._indices_at = self._boxes_at + _box.size * self._num_nodes
+    # total length in bytes of the tree's encoding
+    self.nbytes = self._indices_at + 4*self._num_nodes - offset
+    if len(data) < offset + self.nbytes:
+      raise ValueError, 'Truncated packed R-tree at offset %d' % offset
+
+  def __len__(self):
+    """ Returns the number of items (bounding boxes) in the tree. """
+    return self._len
+
+  def search(self, bbox):
+    """ Find all items whose bounding boxes intersect a given bounding box.
+
+    Args:
+      bbox: the bounding box to check (xmin, ymin, xmax, ymax)
+    Returns:
+      sorted list of the numbers (0 and up) of intersecting items
+    """
+    if not self._len: return []
+    xmin, ymin, xmax, ymax = bbox
+    data = self._data
+    boxes_at = self._boxes_at
+    indices_at = self._indices_at
+    level_bounds = self._level_bounds
+    node_size = self.node_size
+    hits = []
+    # each entry in the stack: level, position of a node intersecting bbox
+    stack = [(len(level_bounds)-1, self._num_nodes-1)]
+    while stack:
+      level, pos = stack.pop()
+      # level 0 is only ever on the stack as the root of a 1-item tree
+      if level:
+        first, = struct.unpack_from('<I', data, indices_at + 4*pos)
+        count = min(node_size, level_bounds[level-1] - first)
+      else:
+        first, count = pos, 1
+      coords = struct.unpack_from('<%dd' % (4*count), data,
+                                  boxes_at + _box.size*first)
+      for i in xrange(count):
+        bx0, by0, bx1, by1 = coords[4*i:4*i+4]
+        if bx0 > xmax or bx1 < xmin or by0 > ymax or by1 < ymin: continue
+        if level > 1: stack.append((level-1, first+i))
+        else: hits.append(first+i)
+    hits = [struct.unpack_from('<I', data, indices_at + 4*pos)[0]
+            for pos in hits]
+    hits.sort()
+    return hits
+
+
+def file_stamp(filename):
+  """ Get the stamp (size, modification time) that sidecars of a file carry.
+
+  Args:
+    filename: path to an existing file
+  Returns:
+    tuple of int size in bytes, float modification time
+  """
+  st = os.stat(filename)
+  return st.st_size, st.st_mtime
+
+
+def save(filename, stamp, data):
+  """ Write (atomically) a sidecar file holding a packed R-tree.
+
+  >>> import shutil
+  >>> tmpdir = tempfile.mkdtemp()
+  >>> fn = os.path.join(tmpdir, 'x.rtx')
+  >>> save(fn, (23, 45.5), pack([(0, 0, 1, 1), (2, 2, 3, 3)]))
+  >>> t = load(fn, (23, 45.5))
+  >>> len(t), t.search((2, 2, 4, 4))
+  (2, [1])
+  >>> load(fn, (23, 45.75)) is None
+  True
+  >>> load(fn + 'z', (23, 45.5)) is None
+  True
+  >>> shutil.rmtree(tmpdir)
+  >>>
+
+  Args:
+    filename: path of the sidecar file to (over)write
+    stamp: the file_stamp of the file the tree indexes
+    data: str with the encoding of the tree (as made by function pack)
+  Raises:
+    IOError or OSError (propagated) if the file can't be written
+  """
+  size, mtime = stamp
+  fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename) or '.')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(_sidecar_header.pack(SIDECAR_MAGIC, size, mtime))
+      f.write(data)
+    try: os.rename(tmpname, filename)
+    except OSError:
+      # e.g. on Windows, rename does not replace an existing file
+      os.remove(filename)
+      os.rename(tmpname, filename)
+  except:
+    if os.path.exists(tmpname): os.remove(tmpname)
+    raise
+
+
+def load(filename, stamp):
+  """ Memory-map a sidecar file and get its tree, unless missing or stale.
+
+  Args:
+    filename: path of the sidecar file
+    stamp: the current file_stamp of the file the tree indexes
+  Returns:
+    PackedRTree queried in place on the memory-mapped file, or None if the file
+      is missing or unreadable or was not made for a file with the given stamp
+  """
+  try:
+    with open(filename, 'rb') as f:
+      themap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  except (IOError, OSError, ValueError, mmap.error):
+    return None
+  try:
+    if len(themap) < _sidecar_header.size: raise ValueError
+    magic, size, mtime = _sidecar_header.unpack_from(themap)
+    if magic != SIDECAR_MAGIC or (size, mtime) != tuple(stamp):
+      raise ValueError
+    return PackedRTree(themap, _sidecar_header.size)
+  except ValueError:
+    themap.close()
+    return None
+
+
+def _test():
+    numfailures, numtests = doctest.testmod()
+    if numfailures == 0:
+      print '%d tests passed successfully' % numtests
+    # if there are any failures, doctest does its own reporting!-)
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,152 @@
+""" Tests of partition module: clipping polylines, and Partfiles made from
+    small synthetic Polyfiles (see test_shp2polys).
+"""
+import doctest
+import math
+import os
+import random
+import shutil
+
+import numpy
+
+import partition
+import shp2polys
+import test_shp2polys
+import tile
+
+m = tile.GlobalMercator()
+
+
+def test_clip_polyline():
+  """
+  >>> def clip(points, bbox):
+  ...   return partition.clip_polyline(points[0::2], points[1::2], bbox)
+  >>> clip([0, 0, 4, 0, 4, 4, 0, 4, 0, 0], (1, 1, 3, 3))
+  []
+  >>> clip([2, 2, 6, 2, 6, 6, 2, 6, 2, 2], (1, 1, 3, 3))
+  [(0, 2), (3, 5)]
+  >>> clip([0, 2, 2, 2, 4, 2, 4, 4, 2, 4, 2, 0], (1, 1, 3, 3))
+  [(0, 3), (4, 6)]
+  >>> clip([1, 1, 2, 2, 1, 3], (0, 0, 5, 5))
+  [(0, 3)]
+  >>> clip([3, 0, 3, 5], (1, 1, 3, 3))
+  [(0, 2)]
+  >>> clip([4, 0, 4, 5], (1, 1, 3, 3))
+  []
+  >>> clip([0, 0, 2, 2, 4, 4, 2, 4, 2, 2, 0, 0], (1, 1, 3, 3))
+  [(0, 3), (3, 6)]
+  """
+
+def test_partition():
+  """
+  >>> rng = random.Random(23)
+  >>> records = []
+  >>> for i in range(8):
+  ...   x, y = -120 + i%4*2, 35 + i//4*2
+  ...   ring = [(x + math.cos(k*math.pi/100) * rng.uniform(0.9, 1.1),
+  ...            y + math.sin(k*math.pi/100)) for k in range(200)]
+  ...   records.append(('%05d' % i, [ring + ring[:1]]))
+  >>> tmpdir = test_shp2polys.setup_polyfile(records, lod_zooms=(8,))
+  >>> infile = os.path.join(tmpdir, 'grid.ply')
+  >>> partfile = os.path.join(tmpdir, 'grid.ptn')
+  >>> partition.Partitioner(infile=infile, oufile=partfile, zooms=(9, 5)).doit()
+  >>> pr = partition.PartitionReader(infile=partfile)
+  >>> pr.zooms, pr.margin, [pr.partition_zoom(z) for z in (5, 8, 9, 15)]
+  ([5, 9], 1.0, [5, 5, 9, 9])
+  >>> pr.get_fragments(0, 0, 4)
+  Traceback (most recent call last):
+     ...
+  ValueError: No partition for zoom 4
+  >>> r = shp2polys.PolyReader(infile=infile)
+  >>> for zoom in (5, 6, 7, 9, 11):
+  ...   r.zoom = 8 if zoom < 9 else None
+  ...   tiles = r.get_tiles_cover(zoom)
+  ...   minx, miny = min(t[0] for t in tiles) - 1, min(t[1] for t in tiles) - 1
+  ...   maxx, maxy = max(t[0] for t in tiles) + 1, max(t[1] for t in tiles) + 1
+  ...   nonempty = 0
+  ...   for tx in range(minx, maxx+1):
+  ...     for ty in range(miny, maxy+1):
+  ...       got = pr.get_fragments(tx, ty, zoom)
+  ...       nonempty += bool(got)
+  ...       if (tx, ty) in tiles and not got: print 'Missing', tx, ty
+  ...       if not check_fragments(r, got, tx, ty, zoom):
+  ...         print 'Bad', tx, ty, zoom
+  ...   print zoom, len(tiles) <= nonempty,
+  5 True 6 True 7 True 9 True 11 True
+  >>> pr.close()
+  >>> r.close()
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_partition_topology():
+  """
+  >>> records = test_shp2polys.neighbours_records()
+  >>> for topology in (False, True):
+  ...   tmpdir = test_shp2polys.setup_polyfile(records, topology=topology,
+  ...                                          lod_zooms=(8,))
+  ...   infile = os.path.join(tmpdir, 'grid.ply')
+  ...   partfile = os.path.join(tmpdir, 'grid.ptn')
+  ...   partition.Partitioner(infile=infile, oufile=partfile,
+  ...                         zooms=(9, 5)).doit()
+  ...   pr = partition.PartitionReader(infile=partfile)
+  ...   r = shp2polys.PolyReader(infile=infile)
+  ...   for zoom in (5, 7, 9, 11):
+  ...     r.zoom = 8 if zoom < 9 else None
+  ...     tiles = sorted(r.get_tiles_cover(zoom))
+  ...     got = [pr.get_fragments(tx, ty, zoom) for tx, ty in tiles]
+  ...     names = set(name for fragments in got for name, meters in fragments)
+  ...     print zoom, len(names), all(
+  ...         check_fragments(r, fragments, tx, ty, zoom, named=not topology)
+  ...         for fragments, (tx, ty) in zip(got, tiles)),
+  ...     print sum(duplicated_segments(fragments) for fragments in got) > 0
+  ...   pr.close()
+  ...   r.close()
+  ...   shutil.rmtree(tmpdir)
+  5 10 True True
+  7 10 True True
+  9 10 True True
+  11 10 True True
+  5 1 True False
+  7 1 True False
+  9 1 True False
+  11 1 True False
+  """
+
+def duplicated_segments(fragments):
+  """ Count the segments of fragments that are in them more than once (in
+  either direction)
+  """
+  segments = []
+  for name, meters in fragments:
+    points = zip(meters[0::2], meters[1::2])
+    segments.extend(frozenset(s) for s in zip(points[:-1], points[1:]))
+  return len(segments) - len(set(segments))
+
+def check_fragments(r, fragments, tx, ty, zoom, named=True):
+  """ Check fragments of a tile vs the records of r
+
+  The fragments must be made of points of the records (at the level of
+  detail for r.zoom), and include all of those within the tile's bbox; unless
+  named, fragments' names are None (as for arcs) rather than their records'.
+  """
+  minx, miny, maxx, maxy = m.TileBounds(tx, ty, zoom)
+  points = set()
+  for name, meters in fragments:
+    points.update((name, x, y) for x, y in zip(meters[0::2], meters[1::2]))
+  for name, bbox, starts, lengths, meters in r:
+    if not named: name = None
+    for x, y in zip(meters[0::2], meters[1::2]):
+      points.discard((name, x, y))
+      if minx <= x <= maxx and miny <= y <= maxy and not any(
+          (name, x, y) == (n, fx, fy) for n, fm in fragments
+          for fx, fy in zip(fm[0::2], fm[1::2])): return False
+  return not points
+
+def _test():
+    numfailures, numtests = doctest.testmod()
+    if numfailures == 0:
+      print '%d tests passed successfully' % numtests
+    # if there are any failures, doctest does its own reporting!-)
+
+if __name__ == "__main__":
+    _test()
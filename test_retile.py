@@ -0,0 +1,217 @@
+""" Tests of retile module: dirty tiles, re-rendering and updating archives of
+    tiles, for small synthetic Polyfiles (see test_shp2polys).
+"""
+from __future__ import with_statement
+
+import cPickle
+import doctest
+import os
+import shutil
+import tempfile
+import zipfile
+
+import addazoom
+import retile
+import shp2polys
+import test_shp2polys
+import test_shpe
+import tile
+
+m = tile.GlobalMercator()
+
+
+def test_dirty_tiles():
+  """
+  >>> records = test_shp2polys.polygon_records()
+  >>> changed = [('00098', [test_shpe.square(-102, 42)])]
+  >>> changed += records[:5] + records[6:]
+  >>> changed[12] = (changed[12][0], [test_shpe.square(-100, 40)])
+  >>> for topology in (False, True):
+  ...   kwds = dict(version=2, topology=topology, lod_zooms=(4,))
+  ...   tmpdir = test_shp2polys.setup_polyfile(records, **kwds)
+  ...   infile = os.path.join(tmpdir, 'grid.ply')
+  ...   oldfile = os.path.join(tmpdir, 'old.ply')
+  ...   shutil.copy(infile, oldfile)
+  ...   c = test_shp2polys.update_polyfile(tmpdir, changed, **kwds)
+  ...   old, new = [shp2polys.PolyReader(infile=f) for f in (oldfile, infile)]
+  ...   dirty = retile.dirty_tiles(old, new, range(3, 8))
+  ...   for zoom in range(3, 8):
+  ...     before, after = mosaic(old, zoom), mosaic(new, zoom)
+  ...     differing = set(t for t in set(before).union(after)
+  ...                     if before.get(t) != after.get(t))
+  ...     print zoom, len(differing), len(dirty[zoom]),
+  ...     print differing <= dirty[zoom],
+  ...     print dirty[zoom] <= retile.bbox_tiles(c.changed_bboxes, zoom)
+  ...   old.close()
+  ...   new.close()
+  ...   shutil.rmtree(tmpdir)
+  3 2 2 True True
+  4 3 3 True True
+  5 6 6 True True
+  6 6 6 True True
+  7 6 6 True True
+  3 2 2 True True
+  4 3 3 True True
+  5 6 6 True True
+  6 6 6 True True
+  7 6 6 True True
+  """
+
+def test_retile():
+  """
+  >>> records = test_shp2polys.polygon_records()
+  >>> changed = records[:20] + records[21:]
+  >>> changed[3] = (changed[3][0], [test_shpe.square(-115, 32, 0.5)])
+  >>> kwds = dict(version=1, topology=True, lod_zooms=(4,))
+  >>> tmpdir = test_shp2polys.setup_polyfile(records, **kwds)
+  >>> infile = os.path.join(tmpdir, 'grid.ply')
+  >>> oldfile = os.path.join(tmpdir, 'old.ply')
+  >>> shutil.copy(infile, oldfile)
+  >>> c = test_shp2polys.update_polyfile(tmpdir, changed, **kwds)
+  >>> old, new = [shp2polys.PolyReader(infile=f) for f in (oldfile, infile)]
+  >>> archive = make_archive(tmpdir, old, range(3, 8))
+  >>> archive.zooms()
+  [3, 4, 5, 6, 7]
+  >>> retile.retile(old, new, archive)
+  10
+  >>> archive = retile.TileArchive('GRID', tmpdir)
+  >>> fresh = dict()
+  >>> for zoom in range(3, 8):
+  ...   for (tx, ty), data in mosaic(new, zoom).iteritems():
+  ...     fresh['%s_%s_%s' % ((zoom,) + m.GoogleTile(tx, ty, zoom))] = data
+  >>> read_archive(archive) == fresh
+  True
+  >>> old.close()
+  >>> new.close()
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_retile_theme():
+  """
+  >>> records = test_shp2polys.polygon_records()
+  >>> changed = records[:20] + records[21:]
+  >>> changed[3] = (changed[3][0], [test_shpe.square(-115, 32, 0.5)])
+  >>> tmpdir = test_shp2polys.setup_polyfile(records)
+  >>> polyfile = os.path.join(tmpdir, 'grid.ply')
+  >>> test_shp2polys.strip_polyfile(polyfile)
+  >>> r = shp2polys.PolyReader(infile=polyfile)
+  >>> archive = make_archive(tmpdir, r, range(3, 8))
+  >>> r.close()
+  >>> basename = os.path.join(tmpdir, 'grid2')
+  >>> test_shpe.write_shapefile(basename, changed)
+  >>> partfile = os.path.join(tmpdir, 'grid.ptn')
+  >>> open(partfile, 'wb').close()
+  >>> meta = addazoom.ThemeData(infile=basename + '.shp', oufile=polyfile,
+  ...     nameid='ZCTA', valid=str.isdigit, partfile=partfile)
+  >>> tempdir = tempfile.tempdir
+  >>> tempfile.tempdir = os.path.join(tmpdir, 'tmp')
+  >>> os.mkdir(tempfile.tempdir)
+  >>> retile.retile_theme('GRID', meta, directory=tmpdir)
+  9
+  >>> os.listdir(tempfile.tempdir), os.path.exists(partfile)
+  ([], False)
+  >>> tempfile.tempdir = tempdir
+  >>> fresh = dict()
+  >>> r = shp2polys.PolyReader(infile=polyfile)
+  >>> for zoom in range(3, 8):
+  ...   for (tx, ty), data in mosaic(r, zoom).iteritems():
+  ...     fresh['%s_%s_%s' % ((zoom,) + m.GoogleTile(tx, ty, zoom))] = data
+  >>> r.close()
+  >>> read_archive(retile.TileArchive('GRID', tmpdir)) == fresh
+  True
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_tile_archive():
+  """
+  >>> tmpdir = tempfile.mkdtemp()
+  >>> def tiles(zxys, size=0):
+  ...   return dict((zxy, zxy + ' ' * size) for zxy in zxys)
+  >>> for named in (False, True):
+  ...   with open(os.path.join(tmpdir, 'T_dict.pik'), 'wb') as f:
+  ...     cPickle.dump({'0_0_0': 'T_1.zip' if named else 1}, f)
+  ...   zipfile.ZipFile(os.path.join(tmpdir, 'T_1.zip'), 'w').writestr(
+  ...       'tile_T_0_0_0.png', '0_0_0')
+  ...   archive = retile.TileArchive('T', tmpdir)
+  ...   archive.update([], tiles(['1_0_0', '1_0_1']))
+  ...   archive.update(['1_0_0', '9_9_9'], tiles(['0_0_0', '1_1_1']))
+  ...   archive = retile.TileArchive('T', tmpdir)
+  ...   print sorted(archive.index.items())
+  ...   print read_archive(archive) == tiles(['0_0_0', '1_0_1', '1_1_1'])
+  ...   print archive.zooms()
+  [('0_0_0', 1), ('1_0_1', 1), ('1_1_1', 1)]
+  True
+  [0, 1]
+  [('0_0_0', 'T_1.zip'), ('1_0_1', 'T_1.zip'), ('1_1_1', 'T_1.zip')]
+  True
+  [0, 1]
+  >>> max_size = retile.MAX_SIZE
+  >>> retile.MAX_SIZE = 4000
+  >>> added = tiles(['2_%d_%d' % (x, y) for x in range(4) for y in range(4)],
+  ...               size=1000)
+  >>> for zxy in added:
+  ...   added[zxy] = os.urandom(1000)
+  >>> archive.update([], added)
+  >>> archive.update(['2_0_0'], tiles(['0_0_0'], size=2000))
+  >>> archive = retile.TileArchive('T', tmpdir)
+  >>> sorted(set(archive.index.values()))
+  ['T_1.zip', 'T_2.zip', 'T_3.zip', 'T_4.zip', 'T_5.zip', 'T_6.zip']
+  >>> archive.index['0_0_0']
+  'T_6.zip'
+  >>> expected = tiles(['1_0_1', '1_1_1'])
+  >>> expected.update(added)
+  >>> del expected['2_0_0']
+  >>> expected.update(tiles(['0_0_0'], size=2000))
+  >>> read_archive(archive) == expected
+  True
+  >>> all(os.path.getsize(os.path.join(tmpdir, name)) < 5000
+  ...     for name in set(archive.index.values()))
+  True
+  >>> retile.MAX_SIZE = max_size
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def mosaic(r, zoom):
+  """ Render all tiles a Polyfile may have content on, at a zoom level;
+  return a dict from (tx, ty) to PNG data
+  """
+  r.zoom = zoom
+  tiles = r.get_tiles_cover(zoom)
+  data_by_name = retile.render_tiles(r, zoom, tiles)
+  result = dict()
+  for tx, ty in tiles:
+    name = '%s_%s_%s' % ((zoom,) + m.GoogleTile(tx, ty, zoom))
+    if name in data_by_name: result[tx, ty] = data_by_name[name]
+  return result
+
+def make_archive(tmpdir, r, zooms):
+  """ Make the archive of theme GRID in tmpdir, with the tiles of a Polyfile
+  at some zoom levels; return the TileArchive for it
+  """
+  with open(os.path.join(tmpdir, 'GRID_dict.pik'), 'wb') as f:
+    cPickle.dump(dict(), f)
+  archive = retile.TileArchive('GRID', tmpdir)
+  added = dict()
+  for zoom in zooms:
+    added.update(retile.render_tiles(r, zoom, r.get_tiles_cover(zoom)))
+  archive.update([], added)
+  return archive
+
+def read_archive(archive):
+  """ Get a dict from 'z_x_y' to the data of each tile in a TileArchive """
+  result = dict()
+  for zxy, value in archive.index.iteritems():
+    name = os.path.join(archive.directory,
+                        '%s_%s.zip' % (archive.theme, archive._zipnum(value)))
+    with open(name, 'rb') as f:
+      result[zxy] = zipfile.ZipFile(f).read(archive._member(zxy))
+  return result
+
+def _test():
+    numfailures, numtests = doctest.testmod()
+    if numfailures == 0:
+      print '%d tests passed successfully' % numtests
+    # if there are any failures, doctest does its own reporting!-)
+
+if __name__ == "__main__":
+    _test()
@@ -0,0 +1,590 @@
+""" Tests of shp2polys module: Converter and PolyReader on small synthetic
+    Shapefiles written to temporary directories (see test_shpe).
+"""
+from __future__ import with_statement
+
+import array
+import doctest
+import math
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+
+import numpy
+
+import shp2polys
+import test_shpe
+import tile
+
+m = tile.GlobalMercator()
+
+
+def polygon_records():
+  """ Records with duplicate and invalid ids, and some multi-part polygons. """
+  records = []
+  for i in range(40):
+    id = '%05d' % (i % 30)
+    if id.endswith('7'): id = id[:4] + 'X'
+    x, y = -120.0 + i%8 * 1.5, 30.0 + i//8 * 1.5
+    parts = [test_shpe.square(x, y)]
+    if i % 3 == 0: parts.append(test_shpe.square(x + 1.1, y + 1.1, 0.3))
+    records.append((id, parts))
+  return records
+
+
+def setup_polyfile(records, **kwds):
+  """ Write grid.shp &c and convert them to grid.ply; return the tmpdir. """
+  tmpdir = tempfile.mkdtemp()
+  basename = os.path.join(tmpdir, 'grid')
+  test_shpe.write_shapefile(basename, records)
+  c = shp2polys.Converter(infile=basename + '.shp', oufile=basename + '.ply',
+                          nameid='ZCTA', valid=str.isdigit, **kwds)
+  c.doit()
+  return tmpdir
+
+
+def expected_meters(parts):
+  """ Project parts, scalar way, to the flat list of int meters x, y, ... """
+  result = []
+  for part in parts:
+    for lon, lat in part:
+      result.extend(int(v) for v in m.LatLonToMeters(lat, lon))
+  return result
+
+
+def test_convert_and_read():
+  """
+  >>> records = polygon_records()
+  >>> tmpdir = setup_polyfile(records)
+  >>> r = shp2polys.PolyReader(infile=os.path.join(tmpdir, 'grid.ply'))
+  >>> got = list(r)
+  >>> valid = [(id, parts) for id, parts in records if id.isdigit()]
+  >>> len(got), len(valid), len(set(id for id, parts in valid))
+  (36, 36, 27)
+  >>> for (name, bbox, starts, lengths, meters), (id, parts) in zip(got, valid):
+  ...   exp = expected_meters(parts)
+  ...   if (name != id or meters != exp or
+  ...       bbox != [min(exp[0::2]), min(exp[1::2]),
+  ...                max(exp[0::2]), max(exp[1::2])] or
+  ...       lengths != [2*len(p) for p in parts] or
+  ...       starts != [0, 10][:len(parts)]): print 'Bad', id
+  >>> ids = r.zip.read('ids.txt').split()
+  >>> sorted(ids[0::2]) == ids[0::2] == sorted(set(id for id, parts in valid))
+  True
+  >>> sorted(map(int, ids[1::2])) == range(27)
+  True
+  >>> allm = [x for name, bbox, starts, lengths, meters in got for x in meters]
+  >>> r.get_tiles_ranges(6) == (
+  ...     m.MetersToTile(min(allm[0::2]), min(allm[1::2]), 6) +
+  ...     m.MetersToTile(max(allm[0::2]), max(allm[1::2]), 6))
+  True
+  >>> r.close()
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_parallel_convert():
+  """
+  >>> records = polygon_records() * 3
+  >>> contents = []
+  >>> for processes in (1, 2, None):
+  ...   tmpdir = setup_polyfile(records, processes=processes, chunk_size=7)
+  ...   z = zipfile.ZipFile(os.path.join(tmpdir, 'grid.ply'))
+  ...   print z.testzip(), len(z.namelist()),
+  ...   contents.append([(name, z.read(name)) for name in z.namelist()])
+  ...   z.close()
+  ...   shutil.rmtree(tmpdir)
+  None 112 None 112 None 112
+  >>> contents[0] == contents[1] == contents[2]
+  True
+  >>> contents = []
+  >>> for processes in (1, 2):
+  ...   tmpdir = setup_polyfile(neighbours_records(), processes=processes,
+  ...                           chunk_size=3, topology=True)
+  ...   z = zipfile.ZipFile(os.path.join(tmpdir, 'grid.ply'))
+  ...   contents.append([(name, z.read(name)) for name in z.namelist()])
+  ...   z.close()
+  ...   shutil.rmtree(tmpdir)
+  >>> contents[0] == contents[1]
+  True
+  >>> build_arcs = shp2polys.build_arcs
+  >>> def failing_build_arcs(parts):
+  ...   raise ValueError, 'No arcs'
+  >>> shp2polys.build_arcs = failing_build_arcs
+  >>> tmpdir = tempfile.mkdtemp()
+  >>> basename = os.path.join(tmpdir, 'grid')
+  >>> test_shpe.write_shapefile(basename, neighbours_records())
+  >>> shp2polys.Converter(infile=basename + '.shp', oufile=basename + '.ply',
+  ...     nameid='ZCTA', valid=str.isdigit, processes=2, chunk_size=3,
+  ...     topology=True).doit()
+  Traceback (most recent call last):
+     ...
+  ValueError: No arcs
+  >>> shp2polys.build_arcs = build_arcs
+  >>> shutil.rmtree(tmpdir)
+  >>> multiprocessing.active_children()
+  []
+  """
+
+def test_project_record():
+  """
+  >>> lonlat = [-120, 35, -119, 35, -119, 36, -120, 35]
+  >>> packed = [struct.pack('<8d', *lonlat), struct.pack('<6d', *lonlat[:6])]
+  >>> arrays = [array.array('d', lonlat), array.array('d', lonlat[:6])]
+  >>> bbox, lengths, meters = shp2polys.project_record(0, packed)
+  >>> bbox, list(lengths), list(meters[:2])
+  ([-13358338, 4163881, -13247019, 4300621], [8, 6], [-13358338, 4163881])
+  >>> bbox2, lengths2, meters2 = shp2polys.project_record(0, arrays)
+  >>> bbox2 == bbox, list(lengths2) == list(lengths), all(meters2 == meters)
+  (True, True, True)
+  """
+
+def test_simplify_mask():
+  """
+  >>> xs = numpy.array([0, 1, 2, 3, 4, 5, 6, 0, 0, 5, 5, 0])
+  >>> ys = numpy.array([0, 0.1, -0.1, 5, 6, 7, 6.1, 0, 0, 0, 5, 0])
+  >>> keep = shp2polys.simplify_mask(xs, ys, 0.5, [7, 12])
+  >>> zip(xs[keep], ys[keep])
+  [(0, 0.0), (2, -0.1), (3, 5.0), (5, 7.0), (6, 6.1), (0, 0.0), (5, 0.0), (5, 5.0), (0, 0.0)]
+  >>> list(shp2polys.simplify_mask(xs, ys, 10))
+  [True, False, False, False, False, False, False, False, False, False, False, True]
+  """
+
+def test_levels_of_detail():
+  """
+  >>> records = [('00001', [[(-120 + 0.5*math.cos(-k*math.pi/500),
+  ...                         35 + 0.3*math.sin(-k*math.pi/500)*(1 + k%2*0.01))
+  ...                        for k in range(1001)]]),
+  ...            ('00002', [test_shpe.square(-119, 35), test_shpe.square(-118,
+  ...                        35, 0.001)])]
+  >>> tmpdir = setup_polyfile(records, lod_zooms=(9, 5))
+  >>> r = shp2polys.PolyReader(infile=os.path.join(tmpdir, 'grid.ply'))
+  >>> r.lod_zooms, [r.lod_prefix(z) for z in (None, 2, 5, 6, 9, 10)]
+  ([5, 9], ['', 'z5/', 'z5/', 'z9/', 'z9/', ''])
+  >>> full = list(r)
+  >>> for zoom in (12, 9, 7, 5, 3):
+  ...   r.zoom = zoom
+  ...   recs = list(r)
+  ...   print zoom, [map(int, rec[3]) for rec in recs]
+  ...   tolerance = 0.5 * m.Resolution(max(zoom, 5))
+  ...   if zoom > 9: continue
+  ...   for rec, fullrec in zip(recs, full):
+  ...     if rec[:2] != fullrec[:2]: print 'Bad', rec[:2]
+  ...     for i in range(len(rec[2])):
+  ...       part = rec[4][rec[2][i]:rec[2][i]+rec[3][i]]
+  ...       orig = fullrec[4][fullrec[2][i]:fullrec[2][i]+fullrec[3][i]]
+  ...       if part[:2] != orig[:2] or part[-2:] != orig[-2:]: print 'Ends'
+  ...       if max_distance(orig, part) > tolerance: print 'Far'
+  12 [[2002], [10, 10]]
+  9 [[1270], [10, 6]]
+  7 [[1270], [10, 6]]
+  5 [[34], [10, 4]]
+  3 [[34], [10, 4]]
+  >>> r.get_tiles_cover(12) == r.get_tiles_cover(12, 1.0)
+  True
+  >>> r.close()
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_polyfile_v2():
+  """
+  >>> records = polygon_records()
+  >>> readers = []
+  >>> for version in (1, 2):
+  ...   tmpdir = setup_polyfile(records, version=version, lod_zooms=(4,))
+  ...   readers.append(shp2polys.PolyReader(
+  ...       infile=os.path.join(tmpdir, 'grid.ply')))
+  ...   print open(os.path.join(tmpdir, 'grid.ply')).read(8),
+  PK\x03\x04\x14\x00\x00\x00 GEPYPLY2
+  >>> r1, r2 = readers
+  >>> r2.version, r2.lod_zooms, r2.name_by_num == r1.name_by_num
+  (2, [4], True)
+  >>> r2.filenames == r1.filenames
+  True
+  >>> r2.get_tiles_ranges(6) == r1.get_tiles_ranges(6)
+  True
+  >>> for zoom in (None, 3, 5):
+  ...   r1.zoom = r2.zoom = zoom
+  ...   recs = list(r2)
+  ...   print len(recs), recs == list(r1),
+  ...   print recs == [tuple([name] + [list(a) for a in arrays])
+  ...                  for name, arrays in ((x[0], x[1:]) for x in
+  ...                                       r2.iter_arrays())],
+  ...   print [tuple(map(list, x[1:])) for x in r1.iter_arrays()] == [
+  ...       tuple(map(list, x[1:])) for x in r2.iter_arrays()]
+  36 True True True
+  36 True True True
+  36 True True True
+  >>> name, bbox, starts, lengths, meters = next(r2.iter_arrays())
+  >>> meters.dtype, meters.flags.owndata, meters.flags.writeable
+  (dtype('int32'), False, False)
+  >>> r2.get_tiles_cover(5) == r1.get_tiles_cover(5)
+  True
+  >>> for r in readers:
+  ...   r.close()
+  ...   shutil.rmtree(os.path.dirname(r.infile))
+  >>> shp2polys.Converter(version=3)
+  Traceback (most recent call last):
+     ...
+  ValueError: No Polyfile version 3
+  """
+
+def test_varint_deltas():
+  """
+  >>> data = shp2polys.encode_varint_deltas([10, -3, 11, -3, 11, 200, -54, 203])
+  >>> [ord(c) for c in data]
+  [20, 5, 2, 0, 0, 150, 3, 129, 1, 6]
+  >>> list(shp2polys.decode_varint_deltas(data, 8))
+  [10, -3, 11, -3, 11, 200, -54, 203]
+  >>> list(shp2polys.decode_varint_deltas('x' + data + 'y', 8, 1, len(data)))
+  [10, -3, 11, -3, 11, 200, -54, 203]
+  >>> shp2polys.decode_varint_deltas(data, 6)
+  Traceback (most recent call last):
+     ...
+  ValueError: Corrupt encoding of 6 ints
+  >>> shp2polys.encode_varint_deltas([]), shp2polys.decode_varint_deltas('', 0)
+  ('', array([], dtype=int64))
+  >>> rng = numpy.random.RandomState(23)
+  >>> values = rng.randint(-2**31, 2**31, 10000)
+  >>> values[5000:] = values[5000] + rng.randint(-300, 300, 5000).cumsum()
+  >>> data = shp2polys.encode_varint_deltas(values)
+  >>> (shp2polys.decode_varint_deltas(data, len(values)) == values).all()
+  True
+  """
+
+def test_quantum():
+  """
+  >>> records = polygon_records()
+  >>> contents = []
+  >>> for version in (1, 2):
+  ...   for quantum in (0, 1, 10):
+  ...     tmpdir = setup_polyfile(records, version=version, quantum=quantum,
+  ...                             lod_zooms=(4,))
+  ...     r = shp2polys.PolyReader(infile=os.path.join(tmpdir, 'grid.ply'))
+  ...     contents.append((r.quantum, list(r),
+  ...         [tuple(map(list, x[1:])) for x in r.iter_arrays()]))
+  ...     r.zoom = 3
+  ...     contents.append((r.quantum, list(r),
+  ...         [tuple(map(list, x[1:])) for x in r.iter_arrays()]))
+  ...     r.close()
+  ...     shutil.rmtree(tmpdir)
+  >>> [c[0] for c in contents]
+  [0, 0, 1, 1, 10, 10, 0, 0, 1, 1, 10, 10]
+  >>> contents[0][1] == contents[2][1] == contents[6][1] == contents[8][1]
+  True
+  >>> contents[1][1] == contents[3][1] == contents[7][1] == contents[9][1]
+  True
+  >>> contents[4] == contents[10] and contents[5] == contents[11]
+  True
+  >>> all(c[2] == [tuple(x[1:]) for x in c[1]] for c in contents)
+  True
+  >>> for (name, bbox, starts, lengths, meters), exact in zip(contents[4][1],
+  ...                                                        contents[0][1]):
+  ...   if (max(abs(a - b) for a, b in zip(meters, exact[4])) > 5 or
+  ...       [x % 10 for x in meters + bbox] != [0] * (len(meters) + 4) or
+  ...       bbox != [min(meters[0::2]), min(meters[1::2]),
+  ...                max(meters[0::2]), max(meters[1::2])]): print 'Bad', name
+  >>> for topology in (False, True):
+  ...   tmpdir = setup_polyfile(records, version=2, quantum=10, lod_zooms=(4,),
+  ...                           topology=topology)
+  ...   r = shp2polys.PolyReader(infile=os.path.join(tmpdir, 'grid.ply'))
+  ...   offsets = [r._entry(level, i)[0] for level in (0, 1)
+  ...              for i in range(len(r.filenames))]
+  ...   offsets += [struct.unpack_from('<Q', r._map, r._arcs_at + 32*level)[0]
+  ...               for level in (0, 1) if topology]
+  ...   print len(offsets), set(offset % 4 for offset in offsets),
+  ...   r.close()
+  ...   shutil.rmtree(tmpdir)
+  72 set([0]) 74 set([0])
+  """
+
+def test_select_bbox():
+  """
+  >>> records = polygon_records()
+  >>> tmpdirs = [setup_polyfile(records, version=v) for v in (1, 2)]
+  >>> # a Polyfile v1 as made before they had per-record bboxes
+  >>> old = zipfile.ZipFile(os.path.join(tmpdirs[0], 'grid.ply'))
+  >>> new = zipfile.ZipFile(os.path.join(tmpdirs[0], 'old.ply'), 'w')
+  >>> for name in old.namelist():
+  ...   if name != 'bboxes.bin': new.writestr(name, old.read(name))
+  >>> old.close(); new.close()
+  >>> readers = [shp2polys.PolyReader(infile=os.path.join(tmpdir, name))
+  ...            for tmpdir, name in zip(tmpdirs + tmpdirs[:1],
+  ...                                    ('grid.ply', 'grid.ply', 'old.ply'))]
+  >>> allrecs = list(readers[0])
+  >>> def intersecting(bb):
+  ...   return [rec for rec in allrecs if not (rec[1][0] > bb[2] or
+  ...           rec[1][2] < bb[0] or rec[1][1] > bb[3] or rec[1][3] < bb[1])]
+  >>> x0, y0 = m.LatLonToMeters(31, -119)
+  >>> x1, y1 = m.LatLonToMeters(33.4, -116)
+  >>> for r in readers:
+  ...   r.select_bbox = x0, y0, x1, y1
+  ...   recs = list(r)
+  ...   print len(recs), recs == intersecting(r.select_bbox),
+  ...   print [x[0] for x in r.iter_arrays()] == [x[0] for x in recs],
+  ...   r.set_select_tiles((22, 75, 22, 76), 7)
+  ...   recs = list(r)
+  ...   print len(recs), recs == intersecting(r.select_bbox),
+  ...   r.select_bbox = None
+  ...   print list(r) == allrecs,
+  ...   print r.get_tiles_cover(6) == readers[0].get_tiles_cover(6)
+  6 True True 8 True True True
+  6 True True 8 True True True
+  6 True True 8 True True True
+  >>> tx0, ty0 = m.MetersToTile(x0, y0, 9)
+  >>> tx1, ty1 = m.MetersToTile(x1, y1, 9)
+  >>> r.set_select_tiles((tx0, ty0, tx1, ty1), 9)
+  >>> bb = m.TileBounds(tx0, ty0, 9)[:2] + m.TileBounds(tx1, ty1, 9)[2:]
+  >>> abs(bb[0] - r.select_bbox[0] - m.Resolution(9)) < 1e-6
+  True
+  >>> bb[0] <= x0 <= x1 <= bb[2] and bb[1] <= y0 <= y1 <= bb[3]
+  True
+  >>> for r in readers: r.close()
+  >>> for tmpdir in tmpdirs: shutil.rmtree(tmpdir)
+  """
+
+def test_topology():
+  """
+  >>> records = neighbours_records()
+  >>> for version in (1, 2):
+  ...   for quantum in (0, 10):
+  ...     readers = []
+  ...     for topology in (False, True):
+  ...       tmpdir = setup_polyfile(records, version=version, quantum=quantum,
+  ...                               lod_zooms=(6,), topology=topology)
+  ...       readers.append(shp2polys.PolyReader(
+  ...           infile=os.path.join(tmpdir, 'grid.ply')))
+  ...     r0, r = readers
+  ...     full = list(r0)
+  ...     recs = list(r)
+  ...     print r0.topology, r.topology,
+  ...     print points(r0.iter_arcs()), points(r.iter_arcs()),
+  ...     print len(list(r.iter_arcs())),
+  ...     print recs == [(x[0],) + tuple(map(list, x[1:]))
+  ...                    for x in r.iter_arrays()],
+  ...     print [rings(rec) for rec in recs] == [rings(rec) for rec in full],
+  ...     print r.get_tiles_cover(7) == r0.get_tiles_cover(7),
+  ...     r0.zoom = r.zoom = 5
+  ...     print shared_mismatches(full, list(r0)) > 0,
+  ...     print shared_mismatches(full, list(r)),
+  ...     r.set_select_tiles(m.MetersToTile(*m.LatLonToMeters(35.5, -119.5) +
+  ...                                       (8,)) * 2, 8)
+  ...     print len(list(r)), len(list(r.iter_arcs()))
+  ...     if version == 1 and not quantum:
+  ...       print sorted(n for n in r.zip.namelist() if '_' not in n)
+  ...     for r in readers:
+  ...       r.close()
+  ...       shutil.rmtree(os.path.dirname(r.infile))
+  False True 163 121 21 True True True True 0 5 12
+  ['arcs.bin', 'bbox.bin', 'bboxes.bin', 'fingerprints.bin', 'ids.txt', 'lods.txt', 'z6/arcs.bin']
+  False True 163 121 21 True True True True 0 5 12
+  False True 163 121 21 True True True True 0 5 12
+  False True 163 121 21 True True True True 0 5 12
+  >>> arcs, refs = shp2polys.build_arcs([numpy.array(x) for x in (
+  ...     [0, 0, 0, 2, 2, 2, 2, 0, 0, 0], [2, 0, 2, 2, 4, 2, 4, 0, 2, 0],
+  ...     [4, 2, 2, 2, 2, 4])])
+  >>> for arc in arcs: print list(arc),
+  [2, 2, 2, 0] [2, 0, 0, 0, 0, 2, 2, 2] [2, 2, 4, 2] [4, 2, 4, 0, 2, 0] [2, 2, 2, 4]
+  >>> refs == [[0, 1], [~0, 2, 3], [~2, 4]]
+  True
+  """
+
+def test_update():
+  """
+  >>> records = polygon_records()
+  >>> changed = [('00098', [test_shpe.square(-102, 42)])]
+  >>> changed += records[:5] + records[6:]
+  >>> changed[12] = (changed[12][0], [test_shpe.square(-100, 40)])
+  >>> changed.append(('00099', [test_shpe.square(-101, 41)]))
+  >>> project_record = shp2polys.project_record
+  >>> counts = []
+  >>> def counting_project_record(*args):
+  ...   counts.append(args[0])
+  ...   return project_record(*args)
+  >>> shp2polys.project_record = counting_project_record
+  >>> for version in (1, 2):
+  ...   for topology in (False, True):
+  ...     kwds = dict(version=version, topology=topology, lod_zooms=(4,))
+  ...     tmpdir = setup_polyfile(records, **kwds)
+  ...     r = shp2polys.PolyReader(infile=os.path.join(tmpdir, 'grid.ply'))
+  ...     old_bboxes, old_nums = r.get_bboxes(), r.name_by_num
+  ...     r.close()
+  ...     del counts[:]
+  ...     c = update_polyfile(tmpdir, changed, **kwds)
+  ...     print len(counts), len(c.changed_bboxes),
+  ...     fresh = setup_polyfile(changed, **kwds)
+  ...     r1, r2 = [shp2polys.PolyReader(infile=os.path.join(d, 'grid.ply'))
+  ...               for d in (tmpdir, fresh)]
+  ...     print sorted(c.changed_bboxes) == sorted(old_bboxes[5:6] +
+  ...         old_bboxes[11:12] + [r2.get_bboxes()[i] for i in (0, 11, -1)]),
+  ...     print r1.fingerprints == r2.fingerprints,
+  ...     print r1.filenames == r2.filenames,
+  ...     for zoom in (None, 3):
+  ...       r1.zoom = r2.zoom = zoom
+  ...       print [rings(x) for x in r1] == [rings(x) for x in r2],
+  ...     print all(r1.name_by_num[num] == name for num, name in
+  ...               old_nums.iteritems() if name != '00005'),
+  ...     print sorted(r1.name_by_num)[-2:], len(os.listdir(tmpdir))
+  ...     for r in r1, r2:
+  ...       r.close()
+  ...       shutil.rmtree(os.path.dirname(r.infile))
+  3 5 True True True True True True [27, 28] 7
+  3 5 True True True True True True [27, 28] 7
+  3 5 True True True True True True [27, 28] 7
+  3 5 True True True True True True [27, 28] 7
+  >>> tmpdir = setup_polyfile(records)
+  >>> del counts[:]
+  >>> c = update_polyfile(tmpdir, changed, quantum=10)
+  >>> len(counts), len(c.changed_bboxes)
+  (37, 73)
+  >>> shp2polys.project_record = project_record
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_update_old_format():
+  """
+  >>> records = polygon_records()
+  >>> changed = records[:5] + records[6:]
+  >>> tmpdir = setup_polyfile(records)
+  >>> polyfile = os.path.join(tmpdir, 'grid.ply')
+  >>> r = shp2polys.PolyReader(infile=polyfile)
+  >>> old_bboxes = r.get_bboxes()
+  >>> r.close()
+  >>> strip_polyfile(polyfile)
+  >>> r = shp2polys.PolyReader(infile=polyfile)
+  >>> r.get_bboxes(), r.fingerprints
+  (None, None)
+  >>> r.close()
+  >>> before = set(os.listdir(tmpdir))
+  >>> project_record = shp2polys.project_record
+  >>> def failing_project_record(*args):
+  ...   raise ValueError, 'Bad record %d' % args[0]
+  >>> shp2polys.project_record = failing_project_record
+  >>> update_polyfile(tmpdir, changed)
+  Traceback (most recent call last):
+     ...
+  ValueError: Bad record 0
+  >>> shp2polys.project_record = project_record
+  >>> sorted(set(os.listdir(tmpdir)) - before)
+  ['grid2.dbf', 'grid2.shp', 'grid2.shx']
+  >>> c = update_polyfile(tmpdir, changed)
+  >>> r = shp2polys.PolyReader(infile=polyfile)
+  >>> new_bboxes = r.get_bboxes()
+  >>> len(new_bboxes), len(c.changed_bboxes)
+  (35, 71)
+  >>> sorted(c.changed_bboxes) == sorted(old_bboxes + new_bboxes)
+  True
+  >>> fresh = setup_polyfile(changed)
+  >>> r2 = shp2polys.PolyReader(infile=os.path.join(fresh, 'grid.ply'))
+  >>> [rings(x) for x in r] == [rings(x) for x in r2]
+  True
+  >>> for r in r, r2:
+  ...   r.close()
+  ...   shutil.rmtree(os.path.dirname(r.infile))
+  """
+
+def strip_polyfile(polyfile):
+  """ Make a Polyfile v1 like those made before bboxes and fingerprints were
+  in Polyfiles, by removing their members
+  """
+  tmpname = polyfile + '.tmp'
+  with open(polyfile, 'rb') as f:
+    old = zipfile.ZipFile(f)
+    new = zipfile.ZipFile(tmpname, 'w', zipfile.ZIP_DEFLATED)
+    for name in old.namelist():
+      if name not in ('bboxes.bin', 'fingerprints.bin'):
+        new.writestr(name, old.read(name))
+    new.close()
+  os.rename(tmpname, polyfile)
+
+def update_polyfile(tmpdir, records, **kwds):
+  """ Write grid2.shp &c in tmpdir and update grid.ply from them; return the
+  Converter that did the updating.
+  """
+  basename = os.path.join(tmpdir, 'grid2')
+  test_shpe.write_shapefile(basename, records)
+  c = shp2polys.Converter(infile=basename + '.shp',
+                          oufile=os.path.join(tmpdir, 'grid.ply'),
+                          nameid='ZCTA', valid=str.isdigit, update=True, **kwds)
+  c.doit()
+  return c
+
+def neighbours_records(n=3, k=4):
+  """ n*n records, each a cell of a wavy grid with k points per side, so that
+  neighbours share their boundaries; the middle one has a hole, filled by one
+  more record (an island, whose ring is the hole's reversed)
+  """
+  def point(gx, gy):
+    return (-120 + gx*0.25 + 0.05*math.sin(gy*1.3 + gx),
+            35 + gy*0.25 + 0.05*math.cos(gx*0.7 + gy))
+  records = []
+  for i in range(n*n):
+    gx, gy = i%n * k, i//n * k
+    ring = ([point(gx + t, gy) for t in range(k)] +
+            [point(gx + k, gy + t) for t in range(k)] +
+            [point(gx + k - t, gy + k) for t in range(k)] +
+            [point(gx, gy + k - t) for t in range(k)])
+    records.append(('%05d' % i, [ring[::-1] + ring[-1:]]))
+  x, y = point(n//2 * k + 1, n//2 * k + 1)
+  island = test_shpe.square(x, y, 0.3)
+  records[n*n//2][1].append(island[::-1])
+  records.append(('%05d' % (n*n), [island]))
+  return records
+
+def rings(record):
+  """ Get a record's parts, each as a list of its points starting from its
+  lowest one (so that the same ring, from whichever point, is the same list)
+  """
+  name, bbox, starts, lengths, meters = record
+  result = []
+  for s, l in zip(starts, lengths):
+    ring = zip(meters[s:s+l:2], meters[s+1:s+l:2])[:-1]
+    first = ring.index(min(ring))
+    result.append(ring[first:] + ring[:first])
+  return name, bbox, result
+
+def points(arcs):
+  """ Get the number of points of some arcs. """
+  return sum(len(arc) // 2 for arc in arcs)
+
+def shared_mismatches(full, lod):
+  """ Count pairs of records, in full and simplified versions, which have
+  some point of their shared boundary the one kept but the other not.
+  """
+  def pointset(record):
+    return set(zip(record[4][0::2], record[4][1::2]))
+  mismatches = 0
+  for i in range(len(full)):
+    for j in range(i):
+      shared = pointset(full[i]) & pointset(full[j])
+      if pointset(lod[i]) & shared != pointset(lod[j]) & shared:
+        mismatches += 1
+  return mismatches
+
+def max_distance(orig, part):
+  """ Get the max distance of the points of polyline orig from polyline part.
+  """
+  worst = 0
+  for i in range(0, len(orig), 2):
+    x, y = orig[i:i+2]
+    best = None
+    for j in range(0, len(part) - 2, 2):
+      ax, ay, bx, by = part[j:j+4]
+      dx, dy = bx - ax, by - ay
+      seglen2 = float(dx*dx + dy*dy)
+      t = seglen2 and max(0, min(1, ((x-ax)*dx + (y-ay)*dy) / seglen2))
+      d = math.hypot(x - ax - t*dx, y - ay - t*dy)
+      if best is None or d < best: best = d
+    worst = max(worst, best or 0)
+  return worst
+
+def _test():
+    numfailures, numtests = doctest.testmod()
+    if numfailures == 0:
+      print '%d tests passed successfully' % numtests
+    # if there are any failures, doctest does its own reporting!-)
+
+if __name__ == "__main__":
+    _test()
@@ -1,9 +1,90 @@
 """ Tests of shpextract module using ca/zt06_d00 Shapefile (5-digits ZCTAs
-    in CA, freely supplied by the US Census as a TIGER/Line [TM] file).
+    in CA, freely supplied by the US Census as a TIGER/Line [TM] file), and
+    small synthetic Shapefiles written to temporary directories.
 """
+from __future__ import with_statement
+
 import doctest
+import math
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+
+import dbfUtils
 import shpextract
 
+
+def write_shapefile(basename, records, field_name='ZCTA', shapetype=5):
+  """ Write a small .shp/.shx/.dbf Shapefile for tests.
+
+  Args:
+    basename: path of the files to write, without extension
+    records: list of (id, parts), each part a list of (lon, lat) tuples
+    field_name: name of the (only) DBF attribute, holding the ids
+    shapetype: 3 (polylines) or 5 (polygons)
+  """
+  def bbox_of(points):
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return min(xs), min(ys), max(xs), max(ys)
+  bodies = []
+  for recno, (id, parts) in enumerate(records):
+    points = [p for part in parts for p in part]
+    starts = [0]
+    for part in parts[:-1]: starts.append(starts[-1] + len(part))
+    body = struct.pack('<i4d2i', shapetype, *(bbox_of(points) +
+                       (len(parts), len(points))))
+    body += struct.pack('<%di' % len(parts), *starts)
+    body += ''.join(struct.pack('<2d', *p) for p in points)
+    bodies.append(struct.pack('>2i', recno+1, len(body)//2) + body)
+  allpoints = [p for id, parts in records for part in parts for p in part]
+  def header(words):
+    return (struct.pack('>7i', 9994, 0, 0, 0, 0, 0, words) +
+            struct.pack('<2i8d', 1000, shapetype,
+                        *(bbox_of(allpoints) + (0, 0, 0, 0))))
+  with open(basename + '.shp', 'wb') as f:
+    f.write(header(50 + sum(len(b) for b in bodies)//2))
+    f.write(''.join(bodies))
+  with open(basename + '.shx', 'wb') as f:
+    f.write(header(50 + 4*len(bodies)))
+    offset = 50
+    for body in bodies:
+      f.write(struct.pack('>2i', offset, len(body)//2 - 4))
+      offset += len(body)//2
+  width = max(len(id) for id, parts in records)
+  with open(basename + '.dbf', 'wb') as f:
+    dbfUtils.dbfwriter(f, [field_name], [('C', width, 0)],
+                       [(id,) for id, parts in records])
+
+
+def square(x, y, side=1.0):
+  """ A closed ring (list of lon, lat tuples) for a square with SW at x, y. """
+  return [(x, y), (x, y+side), (x+side, y+side), (x+side, y), (x, y)]
+
+
+def grid_records(n=10):
+  """ n*n records, ids '00000' and up, each a unit square on a lon/lat grid.
+
+  Every record whose id ends in '7' is given an invalid (non-digits) id.
+  """
+  records = []
+  for i in range(n*n):
+    id = '%05d' % i
+    if id.endswith('7'): id = id[:4] + 'X'
+    records.append((id, [square(-120.0 + i%n, 30.0 + i//n)]))
+  return records
+
+
+def setup_grid(n=10):
+  """ Make a temp dir holding grid.shp &c per grid_records, return its path. """
+  tmpdir = tempfile.mkdtemp()
+  write_shapefile(os.path.join(tmpdir, 'grid'), grid_records(n))
+  return tmpdir
+
+
 def test_some_metas():
   """ 
   >>> s = shpextract.Shp('ca/zt06_d00.shp', id_field_name='ZCTA')
@@ -42,6 +123,302 @@ def test_some_metas():
   >>>
   """
 
+def test_mmap_mode():
+  """
+  >>> tmpdir = setup_grid()
+  >>> shpfile = os.path.join(tmpdir, 'grid.shp')
+  >>> s = shpextract.Shp(shpfile, id_field_name='ZCTA')
+  >>> m = shpextract.Shp(shpfile, id_field_name='ZCTA', use_mmap=True)
+  >>> len(m)
+  90
+  >>> fromfile = list(s)
+  >>> frommap = list(m)
+  >>> [r[0] for r in frommap] == [r[0] for r in fromfile]
+  True
+  >>> type(frommap[0][1])
+  <type 'buffer'>
+  >>> [list(shpextract.as_doubles(r[1])) for r in frommap] == [
+  ...     list(r[1]) for r in fromfile]
+  True
+  >>> m.set_next_recno(45)
+  >>> r = m.get_next_record(id=1, recno=1, bbox=1, datalen=1, data=0)
+  >>> print r[0], r[1], r[3], shpextract.showbb(r[2])
+  00044 45 5 -116.0000   34.0000 -115.0000   35.0000
+  >>> m.set_select_bbox((-115.5, 34.5, -113.5, 35.5))
+  >>> m.rewind()
+  >>> ' '.join(r[0] for r in m)
+  '00044 00045 00046 00054 00055 00056'
+  >>> m.last_read_recno
+  57
+  >>> s.close(); m.close()
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_spatial_index():
+  """
+  >>> tmpdir = setup_grid(30)
+  >>> shpfile = os.path.join(tmpdir, 'grid.shp')
+  >>> for use_mmap in (False, True):
+  ...   s = shpextract.Shp(shpfile, id_field_name='ZCTA', use_mmap=use_mmap)
+  ...   for bb in [(-119.5, 31.5, -117.5, 32.5), (-101, 45, -80, 70),
+  ...              (-130, 20, -60, 70), (-112.9, 30.1, -112.8, 30.2)]:
+  ...     s.set_select_bbox(bb)
+  ...     s.rewind()
+  ...     indexed = [r[0] for r in s]
+  ...     # set_next_recno makes reading scan all records sequentially
+  ...     s.set_next_recno(1)
+  ...     scanned = [r[0] for r in s]
+  ...     print use_mmap, len(indexed), indexed == scanned
+  ...   s.close()
+  False 6 True
+  False 176 True
+  False 810 True
+  False 0 True
+  True 6 True
+  True 176 True
+  True 810 True
+  True 0 True
+  >>> for use_mmap in (False, True):
+  ...   s = shpextract.Shp(shpfile, id_field_name='ZCTA', use_mmap=use_mmap)
+  ...   s.set_select_bbox((-119.5, 31.5, -117.5, 32.5))
+  ...   s.rewind()
+  ...   first = [s.get_next_record()[0] for i in range(2)]
+  ...   # changing the select-bbox midway drops the old one's index hits
+  ...   s.set_select_bbox((-101, 45, -80, 70))
+  ...   rest = [r[0] for r in s]
+  ...   s.set_next_recno(int(first[-1]) + 2)
+  ...   print first, len(rest), rest == [r[0] for r in s]
+  ...   s.close()
+  ['00030', '00031'] 176 True
+  ['00030', '00031'] 176 True
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_index_sidecar():
+  """
+  >>> tmpdir = setup_grid(30)
+  >>> basename = os.path.join(tmpdir, 'grid')
+  >>> os.path.exists(basename + '.rtx')
+  False
+  >>> def count(bb):
+  ...   s = shpextract.Shp(basename + '.shp', bb, id_field_name='ZCTA')
+  ...   result = len(list(s))
+  ...   s.close()
+  ...   return result
+  >>> count((-101, 45, -80, 70))
+  176
+  >>> os.path.exists(basename + '.rtx')
+  True
+  >>> count((-101, 45, -80, 70))
+  176
+  >>> # a changed .shp makes the sidecar stale, so the index gets rebuilt
+  >>> write_shapefile(basename, grid_records(10))
+  >>> os.utime(basename + '.shp', (1, 1))
+  >>> count((-115.5, 34.5, -113.5, 35.5))
+  6
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_read_columns():
+  """
+  >>> tmpdir = setup_grid(4)
+  >>> basename = os.path.join(tmpdir, 'grid')
+  >>> # add a record with two polygons, the first one with a (CCW) hole
+  >>> outer = square(0, 0, 10)
+  >>> hole = list(reversed(square(2, 2, 2)))
+  >>> write_shapefile(basename, grid_records(4) + [
+  ...     ('99999', [outer, hole, square(20, 0, 5)])])
+  >>> s = shpextract.Shp(basename + '.shp', id_field_name='ZCTA')
+  >>> c = s.read_columns()
+  >>> len(c.recnos), c.ids[-2:], c.coords.shape
+  (16, ['00015', '99999'], (90, 2))
+  >>> list(c.record_offsets[-3:]), list(c.part_offsets[-3:])
+  ([14, 15, 17], [15, 17, 18])
+  >>> c = s.read_columns(bbox=(1, 1, 3, 3))
+  >>> c.ids, list(c.record_offsets), list(c.part_offsets)
+  (['99999'], [0, 2], [0, 2, 3])
+  >>> list(c.ring_offsets), c.coords[c.ring_offsets[1]].tolist()
+  ([0, 5, 10, 15], [2.0, 2.0])
+  >>> c = s.read_columns(ids=['00003', '00001'])
+  >>> c.ids, c.recnos.tolist(), c.coords[:2].tolist()
+  (['00001', '00003'], [2, 4], [[-119.0, 30.0], [-119.0, 31.0]])
+  >>> s.get_next_record()[0]
+  '00000'
+  >>> s.close()
+  >>> # tiny holes, after a large ring of many points, are still holes
+  >>> rng = random.Random(1)
+  >>> big = [(-100 + 50*math.cos(-k*math.pi/5000), 30*math.sin(-k*math.pi/5000))
+  ...        for k in range(10000)]
+  >>> holes = [list(reversed(square(rng.uniform(-110.9, -110.1),
+  ...                               rng.uniform(40.1, 40.9), 1e-7)))
+  ...          for k in range(50)]
+  >>> write_shapefile(basename, [('00001', [big + big[:1]]),
+  ...                            ('99999', [square(-111, 40)] + holes)])
+  >>> s = shpextract.Shp(basename + '.shp', id_field_name='ZCTA')
+  >>> c = s.read_columns()
+  >>> list(c.record_offsets), list(c.part_offsets)
+  ([0, 1, 2], [0, 1, 52])
+  >>> s.close()
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_id_lookup():
+  """
+  >>> tmpdir = tempfile.mkdtemp()
+  >>> basename = os.path.join(tmpdir, 'dups')
+  >>> ids = '30 10 20 10 2X 30 10'.split()
+  >>> write_shapefile(basename, [(id, [square(i, 0)])
+  ...                            for i, id in enumerate(ids)])
+  >>> s = shpextract.Shp(basename + '.shp', id_field_name='ZCTA')
+  >>> len(s)
+  6
+  >>> s.recnos_by_id('10'), s.recnos_by_id('20'), s.recnos_by_id('30')
+  ([2, 4, 7], [3], [1, 6])
+  >>> s.recnos_by_id('15')
+  Traceback (most recent call last):
+     ...
+  KeyError: "ID '15' not in index"
+  >>> s.get_id(5), s.get_id(6), s.get_id(8)
+  (None, '30', False)
+  >>> s.set_next_recno(5)
+  Traceback (most recent call last):
+     ...
+  KeyError: 'Record Number 5 not in index'
+  >>> s.set_next_recno(6)
+  >>> s.get_next_record(id=1, recno=1, data=0)
+  ['30', 6]
+  >>> s.close()
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_get_records():
+  """
+  >>> tmpdir = setup_grid(10)
+  >>> shpfile = os.path.join(tmpdir, 'grid.shp')
+  >>> recnos = [50, 3, 99, 4, 50, 1]
+  >>> fields = 'id recno bbox datalen data'.split()
+  >>> for use_mmap in (False, True):
+  ...   s = shpextract.Shp(shpfile, id_field_name='ZCTA', use_mmap=use_mmap)
+  ...   s.rewind()
+  ...   s.get_next_record()[0]
+  ...   got = s.get_records(recnos, fields, maxgap=200)
+  ...   s.get_next_record()[0]
+  ...   expected = []
+  ...   for recno in recnos:
+  ...     s.set_next_recno(recno)
+  ...     expected.append(s.get_next_record(*[1]*5))
+  ...   print [r[:2] + [list(r[2]), r[3]] + map(shpextract.as_doubles, r[4:])
+  ...          for r in got] == [
+  ...          r[:2] + [list(r[2]), r[3]] + map(shpextract.as_doubles, r[4:])
+  ...          for r in expected]
+  ...   print s.get_records([7, 5], ['recno', 'id'])
+  ...   s.close()
+  '00000'
+  '00001'
+  True
+  [['00006', 7], ['00004', 5]]
+  '00000'
+  '00001'
+  True
+  [['00006', 7], ['00004', 5]]
+  >>> s.get_records([7, 8])
+  Traceback (most recent call last):
+     ...
+  KeyError: 8
+  >>> s = shpextract.Shp(shpfile, id_field_name='ZCTA')
+  >>> sizes = []
+  >>> class CountingFile(object):
+  ...   def __init__(self, fp): self.fp = fp
+  ...   def __getattr__(self, name): return getattr(self.fp, name)
+  ...   def read(self, size):
+  ...     sizes.append(size)
+  ...     return self.fp.read(size)
+  >>> s._fp = CountingFile(s._fp)
+  >>> recnos = [recno for recno in range(1, 101) if s.get_id(recno)]
+  >>> whole = s.get_records(recnos, ['id', 'bbox'])
+  >>> len(sizes), max(sizes)
+  (1, 13600)
+  >>> del sizes[:]
+  >>> s.get_records(recnos, ['id', 'bbox'], maxrun=1000) == whole
+  True
+  >>> len(sizes), max(sizes)
+  (14, 952)
+  >>> s.close()
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_missing_shx():
+  """
+  >>> tmpdir = setup_grid(10)
+  >>> basename = os.path.join(tmpdir, 'grid')
+  >>> with open(basename + '.shx', 'rb') as f: shx = f.read()
+  >>> for use_mmap in (False, True):
+  ...   os.remove(basename + '.shx')
+  ...   s = shpextract.Shp(basename + '.shp', id_field_name='ZCTA',
+  ...                      use_mmap=use_mmap, write_shx=True)
+  ...   with open(basename + '.shx', 'rb') as f: print f.read() == shx
+  ...   s.set_next_recno(s.recnos_by_id('00044')[0])
+  ...   print s.get_next_record(id=1, recno=1, data=0)
+  ...   s.set_select_bbox((-115.5, 34.5, -113.5, 35.5))
+  ...   s.rewind()
+  ...   print ' '.join(r[0] for r in s)
+  ...   s.close()
+  True
+  ['00044', 45]
+  00044 00045 00046 00054 00055 00056
+  True
+  ['00044', 45]
+  00044 00045 00046 00054 00055 00056
+  >>> shutil.rmtree(tmpdir)
+  """
+
+def test_cursors():
+  """
+  >>> tmpdir = setup_grid(10)
+  >>> shpfile = os.path.join(tmpdir, 'grid.shp')
+  >>> s = shpextract.Shp(shpfile, id_field_name='ZCTA')
+  >>> c1 = s.cursor()
+  >>> c2 = s.cursor((-115.5, 34.5, -113.5, 35.5))
+  >>> c1.next()[0], c2.next()[0], c1.next()[0], c2.last_read_recno
+  ('00000', '00044', '00001', 45)
+  >>> s.get_next_record()[0], c1.last_read_id, len(c1)
+  ('00000', '00001', 90)
+  >>> print ' '.join(r[0] for r in c2)
+  00045 00046 00054 00055 00056
+  >>> c1.set_next_recno(100)
+  >>> c1.get_next_record(recno=1, data=0), c1.get_next_record()
+  (['00099', 100], None)
+  >>> c2.get_records([9, 2], ['recno'])
+  [[9], [2]]
+  >>> c2.set_next_recno(8)
+  Traceback (most recent call last):
+     ...
+  KeyError: 'Record Number 8 not in index'
+  >>> s.cursor((10, 10, 11, 11))   # doctest: +IGNORE_EXCEPTION_DETAIL
+  Traceback (most recent call last):
+     ...
+  StopIteration: out of select bbox
+  >>> def by_id(reader):
+  ...   return dict((r[0], shpextract.as_doubles(r[1])) for r in reader)
+  >>> expected = by_id(s.cursor())
+  >>> boxes = [(-119.75+i, 30.25, -119.25+i, 39.75) for i in range(10)] * 4
+  >>> results = [None] * len(boxes)
+  >>> def work(i):
+  ...   results[i] = by_id(s.cursor(boxes[i]))
+  >>> threads = [threading.Thread(target=work, args=(i,))
+  ...            for i in range(len(boxes))]
+  >>> for t in threads: t.start()
+  >>> for t in threads: t.join()
+  >>> print all(sorted(r.items()) == sorted((k, expected[k])
+  ...           for k in r if int(k) % 10 == i % 10)
+  ...           for i, r in enumerate(results))
+  True
+  >>> sum(map(len, results))
+  360
+  >>> s.close()
+  >>> shutil.rmtree(tmpdir)
+  """
+
 def _test():
     numfailures, numtests = doctest.testmod()
     if numfailures == 0:
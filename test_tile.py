@@ -0,0 +1,187 @@
+""" Tests of tile module: batch (array) transforms of GlobalMercator vs the
+    scalar ones they vectorize, integer tile IDs, and tile covers.
+"""
+import array
+import doctest
+import math
+import random
+
+import tile
+
+
+def random_lonlat(n, seed=23):
+  """ Get a list of n random points as (lon, lat) pairs. """
+  rng = random.Random(seed)
+  return [(rng.uniform(-180, 180), rng.uniform(-85, 85)) for i in range(n)]
+
+
+def test_array_transforms():
+  """
+  >>> m = tile.GlobalMercator()
+  >>> points = random_lonlat(1000)
+  >>> lons = [p[0] for p in points]
+  >>> lats = array.array('d', [p[1] for p in points])
+  >>> mx, my = m.LatLonToMetersArray(lats, lons)
+  >>> expected = [m.LatLonToMeters(lat, lon) for lon, lat in points]
+  >>> max(abs(mx - [e[0] for e in expected]).max(),
+  ...     abs(my - [e[1] for e in expected]).max()) < 1e-6
+  True
+  >>> lat, lon = m.MetersToLatLonArray(mx, my)
+  >>> max(abs(lat - lats).max(), abs(lon - lons).max()) < 1e-9
+  True
+  >>> for zoom in (0, 7, 18):
+  ...   px, py = m.MetersToPixelsArray(mx, my, zoom)
+  ...   pixels = [m.MetersToPixels(x, y, zoom) for x, y in expected]
+  ...   print max(abs(px - [p[0] for p in pixels]).max(),
+  ...             abs(py - [p[1] for p in pixels]).max()) < 1e-6,
+  ...   tx, ty = m.PixelsToTileArray(px, py)
+  ...   print [m.GoogleTile(*m.PixelsToTile(x, y) + (zoom,)) for x, y in
+  ...          pixels] == zip(*m.GoogleTileArray(tx, ty, zoom)),
+  ...   print list(tx) == list(m.LatLonToTileArray(lats, lons, zoom)[0]),
+  ...   x, y = m.PixelsToMetersArray(px, py, zoom)
+  ...   print max(abs(x - mx).max(), abs(y - my).max()) < 1e-6
+  True True True True
+  True True True True
+  True True True True
+  >>> for zoom in (0, 7, 18):
+  ...   tx, ty = m.LatLonToTileArray(lats, lons, zoom)
+  ...   for scalar, vector in ((m.TileBounds, m.TileBoundsArray),
+  ...                          (m.TileLatLonBounds, m.TileLatLonBoundsArray)):
+  ...     expected = [scalar(x, y, zoom) for x, y in zip(tx, ty)]
+  ...     print max(abs(v - [e[i] for e in expected]).max()
+  ...               for i, v in enumerate(vector(tx, ty, zoom))) < 1e-6,
+  True True True True True True
+  """
+
+def test_lonlat_to_pixels():
+  """
+  >>> m = tile.GlobalMercator()
+  >>> lonlat = array.array('d', [x for p in random_lonlat(1000) for x in p])
+  >>> for zoom in (0, 7, 18):
+  ...   px, py = m.MetersToPixelsArray(*m.LatLonToMetersArray(lonlat[1::2],
+  ...                                                         lonlat[0::2]) +
+  ...                                  (zoom,))
+  ...   pixels = m.LonLatToPixelsArray(lonlat, zoom)
+  ...   print len(pixels) == len(lonlat),
+  ...   print max(abs(pixels[0::2] - px).max(),
+  ...             abs(pixels[1::2] - py).max()) < 1e-6,
+  ...   raster = m.LonLatToPixelsArray(buffer(lonlat), zoom, raster=True)
+  ...   print abs(raster[1::2] - m.PixelsToRasterArray(px, py, zoom)[1]
+  ...            ).max() < 1e-6
+  True True True
+  True True True
+  True True True
+  """
+
+def test_tile_ids():
+  """
+  >>> m = tile.GlobalMercator()
+  >>> tid = tile.tile_id(3, 5, 2)
+  >>> tile.tile_zxy(tid), tile.id_to_quadkey(tid), m.QuadTree(5, 5, 3)
+  ((3, 5, 2), '121', '121')
+  >>> tid == tile.quadkey_to_id('121') == m.TileToId(5, 5, 3)
+  True
+  >>> m.IdToTile(tid)
+  (5, 5, 3)
+  >>> tile.tile_zxy(tile.tile_parent(tid))
+  (2, 2, 1)
+  >>> [tile.id_to_quadkey(c) for c in tile.tile_children(tid)]
+  ['1210', '1211', '1212', '1213']
+  >>> corner = tile.tile_id(3, 0, 0)
+  >>> [tile.tile_zxy(n)[1:] for n in tile.tile_neighbours(corner)]
+  [(1, 0), (0, 1), (1, 1), (7, 0), (7, 1)]
+  >>> tile.tile_neighbours(tile.tile_id(0, 0, 0))
+  []
+  >>> tile.tile_id(2, 4, 0)
+  Traceback (most recent call last):
+     ...
+  ValueError: No tile 4/0 at zoom 2
+  >>> tile.tile_parent(tile.tile_id(0, 0, 0))
+  Traceback (most recent call last):
+     ...
+  ValueError: Tile at zoom 0 has no parent
+  >>> rng = random.Random(23)
+  >>> tiles = []
+  >>> for i in range(1000):
+  ...   zoom = rng.randint(0, tile.MAX_ZOOM)
+  ...   tiles.append((zoom, rng.randrange(2**zoom), rng.randrange(2**zoom)))
+  >>> tids = [tile.tile_id(*t) for t in tiles]
+  >>> [tile.tile_zxy(t) for t in tids] == tiles
+  True
+  >>> all(tile.quadkey_to_id(m.QuadTree(x, 2**z-1-y, z)) == t
+  ...     for (z, x, y), t in zip(tiles, tids))
+  True
+  >>> sorted(tids) == [tile.tile_id(*t) for t in
+  ...                  sorted(tiles, key=lambda t: (t[0], quadkey(*t)))]
+  True
+  >>> arr = tile.tile_id_array(*zip(*tiles))
+  >>> list(arr) == tids
+  True
+  >>> zip(*tile.tile_zxy_array(arr)) == tiles
+  True
+  >>> deep = [t for t in tids if t >> tile.ZOOM_SHIFT >= 2]
+  >>> list(tile.tile_parent_array(deep, 2)) == [
+  ...     tile.tile_parent(tile.tile_parent(t)) for t in deep]
+  True
+  """
+
+def test_tiles_cover():
+  """
+  >>> m = tile.GlobalMercator()
+  >>> tx, ty = m.LatLonToTile(37.4, -122.1, 10)
+  >>> west, south, east, north = m.TileBounds(tx, ty, 10)
+  >>> size = east - west
+  >>> line = [west + size/4, south + size/4, west + 2.5*size, south + size/2]
+  >>> sorted((x-tx, y-ty) for x, y in m.MetersTilesCover(line, 10))
+  [(0, 0), (1, 0), (2, 0)]
+  >>> diagonal = [west + size/2, south + size/2, west - size, south - size]
+  >>> sorted((x-tx, y-ty) for x, y in m.MetersTilesCover(diagonal, 10))
+  [(-1, -1), (-1, 0), (0, 0)]
+  >>> near = [west + 1, south + size/2, west + 2, south + size/2]
+  >>> sorted((x-tx, y-ty) for x, y in m.MetersTilesCover(near, 10))
+  [(0, 0)]
+  >>> sorted((x-tx, y-ty) for x, y in m.MetersTilesCover(near, 10, margin=1))
+  [(-1, 0), (0, 0)]
+  >>> lonlat = [-122.1, 37.4, -100.3, 45.6, -80.2, 27.3]
+  >>> sorted(m.LonLatTilesCover(lonlat, 3))
+  [(1, 4), (1, 5), (2, 4)]
+  >>> m.LonLatTilesCover([-179.9, -85.05, -170, -89.9], 1)
+  set([(0, 0)])
+  >>> rng = random.Random(23)
+  >>> for i in range(300):
+  ...   xs = [rng.uniform(-5, 5) for j in range(4)]
+  ...   ys = [rng.uniform(-5, 5) for j in range(4)]
+  ...   cover = set()
+  ...   tile._grid_cover(xs, ys, cover)
+  ...   if sample_cover(xs, ys) - cover: print 'Missed', xs, ys
+  ...   cells = [(int(math.floor(x)), int(math.floor(y)))
+  ...            for x, y in zip(xs, ys)]
+  ...   if len(cover) > 1 + sum(abs(cells[j][0] - cells[j-1][0]) +
+  ...                           abs(cells[j][1] - cells[j-1][1])
+  ...                           for j in range(1, 4)): print 'Extra', xs, ys
+  >>>
+  """
+
+def sample_cover(xs, ys, samples=1000):
+  """ Get the cells a polyline goes through, the slow way (by sampling) """
+  cover = set()
+  for i in range(1, len(xs)):
+    for k in range(samples+1):
+      t = k / float(samples)
+      cover.add((int(math.floor(xs[i-1] + t*(xs[i]-xs[i-1]))),
+                 int(math.floor(ys[i-1] + t*(ys[i]-ys[i-1])))))
+  return cover
+
+def quadkey(zoom, gx, gy):
+  """ Get the quadkey of a Google tile, the slow way (digit by digit). """
+  return ''.join(str(((gx >> i) & 1) + 2*((gy >> i) & 1))
+                 for i in range(zoom-1, -1, -1))
+
+def _test():
+    numfailures, numtests = doctest.testmod()
+    if numfailures == 0:
+      print '%d tests passed successfully' % numtests
+    # if there are any failures, doctest does its own reporting!-)
+
+if __name__ == "__main__":
+    _test()
@@ -11,9 +11,214 @@ See also:
   http://msdn.microsoft.com/en-us/library/bb259689.aspx
   http://code.google.com/apis/maps/documentation/overlays.html#\
          Google_Maps_Coordinates
+Methods whose names end in Array are batch versions of the like-named ones:
+they need numpy, take arrays (numpy arrays, array.array's of doubles, or
+buffers of native doubles, such as shpextract may return), and return numpy
+arrays, doing each transform in a few ufunc calls whatever the number of
+points.
+Functions tile_id and friends deal with integer tile IDs: a tile's zoom in the
+top bits of an int, then the Morton code (bit-interleaving) of its Google tile
+coordinates, which is also its quadkey read as a base-4 number.  Tile IDs thus
+sort by zoom, then along a Z-order curve (so that tiles close in the order are
+mostly close on the map), and take O(1) bit operations to make or take apart.
 """
 import math
 
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# the zoom of a tile ID is in its bits from ZOOM_SHIFT up; highest zoom allowed
+ZOOM_SHIFT = 58
+MAX_ZOOM = 29
+_MORTON_MASK = (1 << ZOOM_SHIFT) - 1
+
+
+def _spread_bits(v):
+  """ Move bit i of v (up to 32 bits) to bit 2*i (works on ints and arrays) """
+  v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+  v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+  v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+  v = (v | (v << 2)) & 0x3333333333333333
+  return (v | (v << 1)) & 0x5555555555555555
+
+
+def _compact_bits(v):
+  """ Move bit 2*i of v to bit i, dropping odd bits (undoes _spread_bits) """
+  v = v & 0x5555555555555555
+  v = (v | (v >> 1)) & 0x3333333333333333
+  v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+  v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+  v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+  return (v | (v >> 16)) & 0x00000000FFFFFFFF
+
+
+def tile_id(zoom, gx, gy):
+  """ Get the integer ID of the tile with Google coordinates gx, gy at zoom.
+
+  Args:
+    zoom: zoom level, 0 to MAX_ZOOM
+    gx, gy: Google tile coordinates, 0 to 2**zoom - 1
+  Returns:
+    int tile ID
+  Raises:
+    ValueError if zoom or tile coordinates are out of range
+  """
+  if not 0 <= zoom <= MAX_ZOOM or not 0 <= gx < 2**zoom or (
+      not 0 <= gy < 2**zoom):
+    raise ValueError, 'No tile %s/%s at zoom %s' % (gx, gy, zoom)
+  return int((zoom << ZOOM_SHIFT) | _spread_bits(gx) | (_spread_bits(gy) << 1))
+
+
+def tile_zxy(tid):
+  """ Get zoom, Google gx, Google gy of the tile with the given ID. """
+  morton = tid & _MORTON_MASK
+  return int(tid >> ZOOM_SHIFT), int(_compact_bits(morton)), int(
+      _compact_bits(morton >> 1))
+
+
+def tile_parent(tid):
+  """ Get the ID of the tile (one zoom level up) that contains a given one.
+
+  Raises:
+    ValueError for a tile at zoom 0
+  """
+  zoom = tid >> ZOOM_SHIFT
+  if not zoom: raise ValueError, 'Tile at zoom 0 has no parent'
+  return int(((zoom-1) << ZOOM_SHIFT) | ((tid & _MORTON_MASK) >> 2))
+
+
+def tile_children(tid):
+  """ Get the IDs of the 4 tiles (one zoom level down) a given one contains.
+
+  Raises:
+    ValueError for a tile at zoom MAX_ZOOM
+  """
+  zoom = tid >> ZOOM_SHIFT
+  if zoom >= MAX_ZOOM: raise ValueError, 'Tile at zoom %s too deep' % zoom
+  first = ((zoom+1) << ZOOM_SHIFT) | ((tid & _MORTON_MASK) << 2)
+  return [int(first | quadrant) for quadrant in range(4)]
+
+
+def tile_neighbours(tid):
+  """ Get the IDs of the up to 8 tiles around a given one, at its zoom.
+
+  Along x, tiles wrap around the antimeridian; along y, there are no tiles
+  beyond the polar edges of the map (so, fewer than 8 neighbours).
+  """
+  zoom, gx, gy = tile_zxy(tid)
+  n = 2**zoom
+  result = []
+  for dy in (-1, 0, 1):
+    if not 0 <= gy+dy < n: continue
+    for dx in (-1, 0, 1):
+      if dx or dy:
+        result.append(tile_id(zoom, (gx+dx) % n, gy+dy))
+  # on tiny maps, wrapping around may get the same tile more than once
+  return sorted(set(result) - set([tid]))
+
+
+def quadkey_to_id(quadkey):
+  """ Get the tile ID from a Microsoft quadkey (e.g. as made by QuadTree). """
+  zoom = len(quadkey)
+  if zoom > MAX_ZOOM: raise ValueError, 'Quadkey %r too long' % quadkey
+  return (zoom << ZOOM_SHIFT) | (int(quadkey, 4) if quadkey else 0)
+
+
+def id_to_quadkey(tid):
+  """ Get the Microsoft quadkey of the tile with the given ID. """
+  zoom = tid >> ZOOM_SHIFT
+  morton = tid & _MORTON_MASK
+  return ''.join(str((morton >> 2*i) & 3) for i in range(zoom-1, -1, -1))
+
+
+def _ints(a):
+  """ Get a numpy array of int64 from an array or sequence. """
+  if numpy is None:
+    raise ImportError, 'Array tile IDs need numpy'
+  return numpy.asarray(a, numpy.int64)
+
+
+def tile_id_array(zoom, gx, gy):
+  """ Array version of tile_id (zoom may be an int or an array; no checks) """
+  return (_ints(zoom) << ZOOM_SHIFT) | _spread_bits(_ints(gx)) | (
+      _spread_bits(_ints(gy)) << 1)
+
+
+def tile_zxy_array(tids):
+  """ Array version of tile_zxy, returns 3 arrays: zooms, gx's, gy's """
+  tids = _ints(tids)
+  morton = tids & _MORTON_MASK
+  return tids >> ZOOM_SHIFT, _compact_bits(morton), _compact_bits(morton >> 1)
+
+
+def tile_parent_array(tids, levels=1):
+  """ Array version of tile_parent, going up any number of levels (no checks)
+
+  Args:
+    tids: array of tile IDs, all at zooms >= levels
+    levels: number of zoom levels to go up
+  Returns:
+    array of the IDs of the ancestor tiles, levels zoom levels up
+  """
+  tids = _ints(tids)
+  zooms = (tids >> ZOOM_SHIFT) - levels
+  return (zooms << ZOOM_SHIFT) | ((tids & _MORTON_MASK) >> (2*levels))
+
+
+def _grid_cover(xs, ys, cover):
+  """ Add to set cover the unit grid cells that a polyline passes through.
+
+  Walks each segment cell by cell, as in Amanatides and Woo's "fast voxel
+  traversal" (a DDA on the grid), so the work is proportional to the number
+  of cells visited, however long the segment.  (Where a segment goes exactly
+  through a grid corner, one of the two cells that only touch the segment at
+  that corner gets in the cover, as well as the one diagonally across).
+
+  Args:
+    xs, ys: sequences of the x and y coordinates of the polyline's vertices,
+      in units of grid cells (cell i, j holds i <= x <= i+1, j <= y <= j+1)
+    cover: set to which (i, j) tuples of int cell coordinates get added
+  """
+  floor = math.floor
+  inf = float('inf')
+  x1 = y1 = None
+  for x, y in zip(xs, ys):
+    x0, y0, x1, y1 = x1, y1, x, y
+    tx1, ty1 = int(floor(x1)), int(floor(y1))
+    cover.add((tx1, ty1))
+    if x0 is None: continue
+    tx, ty = int(floor(x0)), int(floor(y0))
+    steps = abs(tx1 - tx) + abs(ty1 - ty)
+    if not steps: continue
+    # parameter t (0 at x0, y0, 1 at x1, y1) of next crossing along x, y
+    dx, dy = x1 - x0, y1 - y0
+    if dx > 0: stepx, tnextx, tdeltax = 1, (tx + 1 - x0) / dx, 1.0 / dx
+    elif dx < 0: stepx, tnextx, tdeltax = -1, (tx - x0) / dx, -1.0 / dx
+    else: stepx, tnextx, tdeltax = 0, inf, inf
+    if dy > 0: stepy, tnexty, tdeltay = 1, (ty + 1 - y0) / dy, 1.0 / dy
+    elif dy < 0: stepy, tnexty, tdeltay = -1, (ty - y0) / dy, -1.0 / dy
+    else: stepy, tnexty, tdeltay = 0, inf, inf
+    for i in xrange(steps):
+      if tnextx < tnexty or (tnextx == tnexty and tx != tx1):
+        tx += stepx
+        tnextx += tdeltax
+      else:
+        ty += stepy
+        tnexty += tdeltay
+      cover.add((tx, ty))
+
+
+def _doubles(a):
+  """ Get a numpy array of float64 from an array, sequence, or buffer. """
+  if numpy is None:
+    raise ImportError, 'Array transforms need numpy'
+  if isinstance(a, buffer): return numpy.frombuffer(a, numpy.float64)
+  return numpy.asarray(a, numpy.float64)
+
+
 class GlobalMercator(object):
   """ TMS Global Mercator Profile
 
@@ -176,17 +381,176 @@ class GlobalMercator(object):
 
   def QuadTree(self, tx, ty, zoom ):
     "Converts TMS tile coordinates to Microsoft QuadTree"
-    quadKey = ""
-    ty = (2**zoom - 1) - ty
-    for i in range(zoom, 0, -1):
-      digit = 0
-      mask = 1 << (i-1)
-      if (tx & mask) != 0:
-          digit += 1
-      if (ty & mask) != 0:
-          digit += 2
-      quadKey += str(digit)
-    return quadKey
+    return id_to_quadkey(self.TileToId(tx, ty, zoom))
+
+  def TileToId(self, tx, ty, zoom):
+    "Converts TMS tile coordinates to an integer tile ID (see tile_id)"
+    return tile_id(zoom, *self.GoogleTile(tx, ty, zoom))
+
+  def IdToTile(self, tid):
+    "Converts an integer tile ID to TMS tile coordinates: tx, ty, zoom"
+    zoom, gx, gy = tile_zxy(tid)
+    return gx, (2**zoom - 1) - gy, zoom
+
+  def LatLonToMetersArray(self, lat, lon):
+    "Array version of LatLonToMeters"
+    mx = _doubles(lon) * self._oSd
+    my = numpy.tan((_doubles(lat) + 90) * self._pd2)
+    numpy.log(my, my)
+    my *= self._oSd / self._pd
+    return mx, my
+
+  def MetersToLatLonArray(self, mx, my):
+    "Array version of MetersToLatLon"
+    lon = _doubles(mx) / self._oSd
+    lat = numpy.exp(_doubles(my) * (self._pd / self._oSd))
+    numpy.arctan(lat, lat)
+    lat *= 2 / self._pd
+    lat -= self._p2 / self._pd
+    return lat, lon
+
+  def PixelsToMetersArray(self, px, py, zoom):
+    "Array version of PixelsToMeters"
+    res = self.Resolution(zoom)
+    return (_doubles(px) * res - self.originShift,
+            _doubles(py) * res - self.originShift)
+
+  def MetersToPixelsArray(self, mx, my, zoom):
+    "Array version of MetersToPixels"
+    ires = 1.0 / self.Resolution(zoom)
+    delta = self.originShift * ires
+    return _doubles(mx) * ires + delta, _doubles(my) * ires + delta
+
+  def PixelsToTileArray(self, px, py):
+    "Array version of PixelsToTile (tiles as arrays of int)"
+    its = 1.0 / self.tileSize
+    tx = numpy.ceil(_doubles(px) * its).astype(int)
+    ty = numpy.ceil(_doubles(py) * its).astype(int)
+    tx -= 1
+    ty -= 1
+    return tx, ty
+
+  def PixelsToRasterArray(self, px, py, zoom):
+    "Array version of PixelsToRaster"
+    mapSize = self.tileSize << zoom
+    return _doubles(px), mapSize - _doubles(py)
+
+  def MetersToTileArray(self, mx, my, zoom):
+    "Array version of MetersToTile"
+    px, py = self.MetersToPixelsArray(mx, my, zoom)
+    return self.PixelsToTileArray(px, py)
+
+  def LatLonToTileArray(self, lat, lon, zoom):
+    "Array version of LatLonToTile"
+    mx, my = self.LatLonToMetersArray(lat, lon)
+    return self.MetersToTileArray(mx, my, zoom)
+
+  def GoogleTileArray(self, tx, ty, zoom):
+    "Array version of GoogleTile"
+    return numpy.asarray(tx), (2**zoom - 1) - numpy.asarray(ty)
+
+  def TileBoundsArray(self, tx, ty, zoom):
+    "Array version of TileBounds"
+    tx, ty = _doubles(tx), _doubles(ty)
+    minx, miny = self.PixelsToMetersArray(tx*self.tileSize, ty*self.tileSize,
+                                          zoom)
+    maxx, maxy = self.PixelsToMetersArray((tx+1)*self.tileSize,
+                                          (ty+1)*self.tileSize, zoom)
+    return minx, miny, maxx, maxy
+
+  def TileLatLonBoundsArray(self, tx, ty, zoom):
+    "Array version of TileLatLonBounds"
+    bounds = self.TileBoundsArray(tx, ty, zoom)
+    minLat, minLon = self.MetersToLatLonArray(bounds[0], bounds[1])
+    maxLat, maxLon = self.MetersToLatLonArray(bounds[2], bounds[3])
+    return minLat, minLon, maxLat, maxLon
+
+  def MetersTilesCover(self, meters, zoom, margin=0.0, cover=None):
+    """Returns the set of TMS tiles that a polyline touches at a zoom level.
+
+    Only tiles that the polyline itself goes through are in the cover (for a
+    polygon ring, a tile entirely inside it is not), so the cover is exactly
+    the tiles that an outline drawing of the polyline paints on.
+
+    Args:
+      meters: x, y, x, y, ... EPSG:900913 coordinates of the vertices (for a
+        closed ring, such as Shapefile ones, the first vertex is repeated last)
+      zoom: zoom level of the tiles
+      margin: also cover tiles within this distance in pixels (e.g., 1.0 to
+        allow for the rounding of coordinates done in drawing the lines)
+      cover: set to add tiles to (default: a new set)
+    Returns:
+      the cover, a set of (tx, ty) tuples of TMS tile coordinates
+    """
+    scale = 1.0 / (self.Resolution(zoom) * self.tileSize)
+    xs = [(x + self.originShift) * scale for x in meters[0::2]]
+    ys = [(y + self.originShift) * scale for y in meters[1::2]]
+    return self._TilesCover(xs, ys, zoom, margin, cover)
+
+  def LonLatTilesCover(self, lonlat, zoom, margin=0.0, cover=None):
+    "Like MetersTilesCover, for lon, lat, lon, lat, ... WGS84 coordinates"
+    meters = []
+    for i in xrange(0, len(lonlat), 2):
+      meters.extend(self.LatLonToMeters(lonlat[i+1], lonlat[i]))
+    return self.MetersTilesCover(meters, zoom, margin, cover)
+
+  def _TilesCover(self, xs, ys, zoom, margin, cover):
+    "Implements the ...TilesCover methods given coords in units of tiles"
+    if cover is None: cover = set()
+    if not margin:
+      touched = set()
+      _grid_cover(xs, ys, touched)
+    else:
+      # the tiles within margin of a segment are those touched by one of its
+      # 4 copies, each shifted by margin diagonally (up-right, up-left, ...)
+      touched = set()
+      margin /= float(self.tileSize)
+      for sx in (-margin, margin):
+        sxs = [x + sx for x in xs]
+        for sy in (-margin, margin):
+          _grid_cover(sxs, [y + sy for y in ys], touched)
+    # polar areas are clipped off the map, so tiles beyond them can't exist
+    top = 2**zoom - 1
+    cover.update((tx, ty) for tx, ty in touched
+                 if 0 <= tx <= top and 0 <= ty <= top)
+    return cover
+
+  def TileToIdArray(self, tx, ty, zoom):
+    "Array version of TileToId"
+    return tile_id_array(zoom, *self.GoogleTileArray(tx, ty, zoom))
+
+  def LonLatToPixelsArray(self, lonlat, zoom, raster=False):
+    """Converts interleaved lon/lat WGS84 coordinates to pixels for a zoom.
+
+    Meters are never materialized: the scale factors of the two steps, lat/lon
+    to meters and meters to pixels, are folded together, so that the whole
+    conversion takes a handful of ufunc calls, all but the first in place.
+
+    Args:
+      lonlat: lon, lat, lon, lat, ... (e.g. the data of a shpextract record)
+      zoom: zoom level of the pixel coordinates
+      raster: if true, the y of the result grows down (as in PixelsToRaster)
+    Returns:
+      numpy float64 array of pixels px, py, px, py, ... (same length as lonlat)
+    """
+    ires = 1.0 / self.Resolution(zoom)
+    delta = self.originShift * ires
+    lonlat = _doubles(lonlat)
+    result = numpy.empty_like(lonlat)
+    numpy.multiply(lonlat[0::2], self._oSd * ires, result[0::2])
+    result[0::2] += delta
+    py = result[1::2]
+    numpy.add(lonlat[1::2], 90, py)
+    py *= self._pd2
+    numpy.tan(py, py)
+    numpy.log(py, py)
+    if raster:
+      py *= -self._oSd / self._pd * ires
+      py += (self.tileSize << zoom) - delta
+    else:
+      py *= self._oSd / self._pd * ires
+      py += delta
+    return result
 
 
 if __name__ == "__main__":